@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+
+"""
+Measure the decoding and book building throughput of sbedecoder on synthetic CME MDP3 packets.
+
+The packets are encoded with the vendored mdp3_schema.xml (a subset of the CME schema), so the benchmarks are
+reproducible and don't need a capture or network access.  Results are printed as JSON and can be compared with
+the results of an earlier run:
+
+    mdp_benchmark.py --output before.json
+    ... change something ...
+    mdp_benchmark.py --compare before.json
+"""
+
+from __future__ import print_function
+
+import gc
+import gzip
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sbedecoder
+from sbedecoder import MDPSchema, MDPMessageFactory, SBEParser, SBEMessage
+from sbedecoder.encoder import MDPPacketBuilder
+from mdp.orderbook import PacketProcessor, ArrayOrderBook, OrderBook
+from mdp.secdef import SecDef, SecDefIndex
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+schema_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mdp3_schema.xml')
+
+ENTRY_TYPES = ('Bid', 'Offer')
+UPDATE_ACTIONS = ('New', 'Change', 'Change', 'Change', 'Delete')
+
+
+def book_message(rng, rpt_seqs, security_ids, num_entries):
+    entries = []
+    for _ in range(num_entries):
+        security_id = rng.choice(security_ids)
+        rpt_seqs[security_id] += 1
+        entries.append({'md_entry_px': rng.randint(90000, 100000), 'md_entry_size': rng.randint(1, 500),
+                        'security_id': security_id, 'rpt_seq': rpt_seqs[security_id],
+                        'number_of_orders': rng.randint(1, 50), 'md_price_level': rng.randint(1, 10),
+                        'md_update_action': rng.choice(UPDATE_ACTIONS), 'md_entry_type': rng.choice(ENTRY_TYPES)})
+    fields = {'transact_time': 1500000000000000000, 'match_event_indicator': ['LastQuoteMsg', 'EndOfEvent']}
+    return 32, fields, {'no_md_entries': entries}
+
+
+def trade_message(rng, rpt_seqs, security_ids, num_orders):
+    security_id = rng.choice(security_ids)
+    rpt_seqs[security_id] += 1
+    entry = {'md_entry_px': rng.randint(90000, 100000), 'md_entry_size': num_orders, 'security_id': security_id,
+             'rpt_seq': rpt_seqs[security_id], 'number_of_orders': num_orders,
+             'aggressor_side': rng.randint(0, 2), 'md_update_action': 'New'}
+    orders = [{'order_id': 1000000 + i, 'last_qty': 1} for i in range(num_orders)]
+    fields = {'transact_time': 1500000000000000000, 'match_event_indicator': ['LastTradeMsg', 'EndOfEvent']}
+    return 42, fields, {'no_md_entries': [entry], 'no_order_id_entries': orders}
+
+
+def generate_packets(num_packets, num_securities=100, seed=1):
+    """ Return a list of synthetic MDP3 packets (a mix of book updates and trades) and the security ids used """
+    schema = MDPSchema()
+    schema.parse(schema_filename)
+    builder = MDPPacketBuilder(schema)
+    rng = random.Random(seed)
+    security_ids = list(range(1000, 1000 + num_securities))
+    rpt_seqs = dict((security_id, 0) for security_id in security_ids)
+    packets = []
+    for sequence_number in range(1, num_packets + 1):
+        builder.start(sequence_number, 1500000000000000000 + sequence_number)
+        builder.add(*book_message(rng, rpt_seqs, security_ids, rng.randint(1, 6)))
+        if rng.random() < 0.3:
+            builder.add(*trade_message(rng, rpt_seqs, security_ids, rng.randint(1, 4)))
+        packets.append(bytes(builder.packet()))
+    return packets, security_ids
+
+
+def write_secdef(filename, num_securities):
+    """ Write a synthetic gzipped security definition file with num_securities instruments """
+    with gzip.open(filename, 'wb') as secdef_file:
+        for i in range(num_securities):
+            line = '35=d\x0148={}\x0155=SYM{}\x01207=XCME\x01462=5\x011022=GBX\x01264=10\x011022=GBI\x01264=2\x01\n'
+            secdef_file.write(line.format(1000 + i, i).encode('UTF-8'))
+
+
+def make_parser(**schema_options):
+    schema = MDPSchema(**schema_options)
+    schema.parse(schema_filename)
+    return SBEParser(MDPMessageFactory(schema))
+
+
+class Benchmark(object):
+    """ A benchmark runs a callable processing a number of items (messages, packets, ...) """
+    def __init__(self, name, unit, setup):
+        self.name = name
+        self.unit = unit
+        self.setup = setup  # returns (run, items), run() processes the items once
+
+    def measure(self, repeat, trace_allocations):
+        run, items = self.setup()
+        run()  # warm up caches (record types, compiled decoders, ...)
+        timings = []
+        for _ in range(repeat):
+            gc.collect()
+            start = timeit.default_timer()
+            run()
+            timings.append(timeit.default_timer() - start)
+        best = min(timings)
+        result = {
+            'unit': self.unit,
+            'items': items,
+            'repeat': repeat,
+            'best_seconds': best,
+            'mean_seconds': sum(timings) / len(timings),
+            'items_per_second': items / best if best else None,
+        }
+        if trace_allocations and tracemalloc is not None:
+            gc.collect()
+            tracemalloc.start()
+            run()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result['peak_allocated_bytes'] = peak
+            result['retained_bytes'] = current
+        return result
+
+
+def benchmarks(num_packets, num_securities, secdef_filename, secdef_securities):
+    packets, security_ids = generate_packets(num_packets, num_securities)
+    num_messages = sum(1 for packet in packets for _ in make_parser().parse(packet, offset=12))
+
+    def parse():
+        parser = make_parser()
+
+        def run():
+            for packet in packets:
+                for message in parser.parse(packet, offset=12):
+                    message.transact_time.value
+        return run, num_messages
+
+    def parse_compiled():
+        schema = MDPSchema()
+        schema.parse(schema_filename, compiled=True)
+        parser = SBEParser(MDPMessageFactory(schema))
+
+        def run():
+            for packet in packets:
+                for message in parser.parse(packet, offset=12):
+                    message.transact_time
+        return run, num_messages
+
+    def parse_message():
+        schema = MDPSchema()
+        schema.parse(schema_filename)
+        offset = 12  # the first message of each packet
+
+        def run():
+            for packet in packets:
+                SBEMessage.parse_message(schema, packet, offset).transact_time.value
+        return run, len(packets)
+
+    def group_iteration():
+        parser = make_parser()
+        num_entries = sum(len(message.no_md_entries) for packet in packets
+                          for message in parser.parse(packet, offset=12))
+
+        def run():
+            for packet in packets:
+                for message in parser.parse(packet, offset=12):
+                    for entry in message.no_md_entries:
+                        entry.security_id.value
+                        entry.md_entry_px.value
+                        entry.md_entry_size.value
+        return run, num_entries
+
+    def parse_records():
+        parser = make_parser()
+
+        def run():
+            for packet in packets:
+                for record in parser.parse_records(packet, offset=12):
+                    pass
+        return run, num_messages
+
+    def handle_packet(orderbook_class, **schema_options):
+        def setup():
+            secdef = SecDef()
+            secdef.info = dict((security_id, ('SYM%d' % security_id, 10)) for security_id in security_ids)
+            parser = make_parser(**schema_options)
+
+            def run():
+                processor = PacketProcessor(parser, secdef, orderbook_class=orderbook_class)
+                for packet in packets:
+                    processor.handle_packet(0, packet)
+            return run, len(packets)
+        return setup
+
+    def encode():
+        schema = MDPSchema()
+        schema.parse(schema_filename)
+        builder = MDPPacketBuilder(schema)
+        rng = random.Random(1)
+        rpt_seqs = dict((security_id, 0) for security_id in security_ids)
+        messages = [book_message(rng, rpt_seqs, security_ids, rng.randint(1, 6)) for _ in range(num_packets)]
+
+        def run():
+            for sequence_number, message in enumerate(messages):
+                builder.start(sequence_number, 1500000000000000000)
+                builder.add(*message)
+        return run, len(messages)
+
+    def secdef_load(**load_options):
+        def setup():
+            def run():
+                SecDef().load(secdef_filename, **load_options)
+            return run, secdef_securities
+        return setup
+
+    def secdef_index():
+        index_filename = secdef_filename + '.index'
+        SecDefIndex.build(secdef_filename, index_filename)
+
+        def run():
+            # startup of a book builder: open the index and look up the securities seen
+            secdef = SecDef()
+            secdef.load(secdef_filename, index_filename=index_filename)
+            for security_id in security_ids:
+                secdef.lookup_security_id(security_id)
+            secdef.close()
+        return run, len(security_ids)
+
+    return [
+        Benchmark('parser.parse', 'messages', parse),
+        Benchmark('parser.parse (compiled)', 'messages', parse_compiled),
+        Benchmark('SBEMessage.parse_message', 'messages', parse_message),
+        Benchmark('group iteration', 'entries', group_iteration),
+        Benchmark('parser.parse_records', 'messages', parse_records),
+        Benchmark('PacketProcessor.handle_packet', 'packets', handle_packet(OrderBook)),
+        Benchmark('PacketProcessor.handle_packet (ArrayOrderBook, fixed prices)', 'packets',
+                  handle_packet(ArrayOrderBook, price_mode='fixed')),
+        Benchmark('MDPPacketBuilder.add', 'messages', encode),
+        Benchmark('SecDef.load', 'securities', secdef_load()),
+        Benchmark('SecDef.load (filtered)', 'securities', secdef_load(security_ids=security_ids)),
+        Benchmark('SecDef.load (index) and lookups', 'lookups', secdef_index),
+    ]
+
+
+def compare(results, baseline):
+    print('{:<62} {:>14} {:>14} {:>8}'.format('benchmark', 'baseline/s', 'current/s', 'ratio'), file=sys.stderr)
+    baseline_results = baseline.get('results', {})
+    for name, result in sorted(results['results'].items()):
+        before = baseline_results.get(name, {}).get('items_per_second')
+        after = result['items_per_second']
+        ratio = '{:.2f}x'.format(after / before) if before and after else '-'
+        print('{:<62} {:>14} {:>14.0f} {:>8}'.format(name, '{:.0f}'.format(before) if before else '-', after, ratio),
+              file=sys.stderr)
+
+
+def process_command_line():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description='Measure the throughput of sbedecoder on synthetic CME MDP3 packets.')
+
+    parser.add_argument('-n', '--packets', type=int, default=20000,
+        help='Number of packets generated (default: %(default)s)')
+
+    parser.add_argument('--securities', type=int, default=100000,
+        help='Number of instruments in the generated security definition file (default: %(default)s)')
+
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+        help='Number of timed runs of each benchmark, the best one is reported (default: %(default)s)')
+
+    parser.add_argument('-k', '--filter', default='',
+        help='Only run the benchmarks whose name contains this string')
+
+    parser.add_argument('--no-allocations', action='store_true',
+        help="Don't trace the memory allocated by each benchmark (requires python 3)")
+
+    parser.add_argument('-o', '--output',
+        help='Write the results to this JSON file rather than to stdout')
+
+    parser.add_argument('-c', '--compare',
+        help='JSON results of an earlier run to compare with')
+
+    return parser.parse_args()
+
+
+def main(argv=None):
+    args = process_command_line()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        secdef_filename = os.path.join(temp_dir, 'secdef.dat.gz')
+        write_secdef(secdef_filename, args.securities)
+
+        results = {
+            'python': platform.python_implementation() + ' ' + platform.python_version(),
+            'platform': platform.platform(),
+            'sbedecoder': sbedecoder.__version__,
+            'packets': args.packets,
+            'results': {},
+        }
+        for benchmark in benchmarks(args.packets, 100, secdef_filename, args.securities):
+            if args.filter in benchmark.name:
+                results['results'][benchmark.name] = benchmark.measure(args.repeat, not args.no_allocations)
+                print('{:<62} {:>12.0f} {}/s'.format(benchmark.name,
+                      results['results'][benchmark.name]['items_per_second'], benchmark.unit), file=sys.stderr)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
+    return 0  # success
+
+
+if __name__ == '__main__':
+    status = main()
+    sys.exit(status)
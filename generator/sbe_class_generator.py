@@ -7,6 +7,9 @@ Generate a python file containing the message definitions contained in the provi
 This generated file can then be used to replace the current dynamic file generation that is
 done in the base sbedecoder.
 
+With --compiled, the generated file instead contains specialised decoders (see sbedecoder.codegen),
+which are faster than the dynamic message classes.
+
 """
 
 import os
@@ -15,6 +18,7 @@ import subprocess
 from datetime import datetime
 from mako.template import Template
 from sbedecoder import SBESchema
+from sbedecoder.codegen import generate_source
 from argparse import ArgumentParser
 
 
@@ -51,18 +55,27 @@ def process_command_line():
     arg_parser.add_argument("--use-description-as-message-name", action='store_true',
         help="pass use_description_as_message_name=True to SBESchema", default=False)
 
+    arg_parser.add_argument("--compiled", action='store_true',
+        help="generate compiled decoders instead of message classes (no template is used)", default=False)
+
     args = arg_parser.parse_args()
 
     # check number of arguments, verify values, etc.:
     if not os.path.isfile(args.schema):
         arg_parser.error("sbe schema xml file '{}' not found".format(args.schema))
 
-    if not os.path.isfile(args.template):
+    if not args.compiled and not os.path.isfile(args.template):
         arg_parser.error("class template file '{}' not found".format(args.template))
 
     return args
 
 
+def build_struct_repr(block_struct):
+    if block_struct is None:
+        return 'None'
+    return "Struct('{}')".format(block_struct.format)
+
+
 def build_field_description(field):
     field_description = {'name': field.name, 'type': type(field).__name__, 'kwargs': field.__dict__}
 
@@ -100,6 +113,11 @@ def main(argv=None):
     mdp_schema = SBESchema(include_message_size_header=use_msg_size_header, use_description_as_message_name=use_desc_as_name)
     mdp_schema.parse(schema_file)
 
+    if cmd_line_args.compiled:
+        with open(output_file, 'w') as outfile:
+            outfile.write(generate_source(mdp_schema, generation_date=datetime.now()))
+        return 0
+
     # Translate the message classes into a description that can be converted into a field description
     message_descriptions = []
     for template_id, message_class in mdp_schema.message_map.items():
@@ -107,7 +125,8 @@ def main(argv=None):
                                'base_classes': ','.join([x.__name__ for x in message_class.__bases__]),
                                'attributes': {},
                                'fields': [],
-                               'groups': []}
+                               'groups': [],
+                               'data_fields': []}
         message_attributes = message_description['attributes']
         message_fields = message_description['fields']
         message_groups = message_description['groups']
@@ -116,6 +135,10 @@ def main(argv=None):
         message_attributes['message_id'] = message_class.message_id
         message_attributes['schema_block_length'] = message_class.schema_block_length
         message_attributes['header_size'] = message_class.header_size
+        message_attributes['block_struct'] = build_struct_repr(message_class.block_struct)
+        message_attributes['header_struct'] = build_struct_repr(message_class.header_struct)
+        message_attributes['_layouts'] = '{}'
+        message_attributes['_instance_fields'] = True
 
         # Update the fields
         for field in message_class.fields:
@@ -129,7 +152,9 @@ def main(argv=None):
                                 'id': repeating_group.id,
                                 'type': type(repeating_group).__name__,
                                 'dimension_size': repeating_group.dimension_size,
-                                'since_version': repeating_group.since_version}
+                                'since_version': repeating_group.since_version,
+                                'schema_block_length': repeating_group.schema_block_length,
+                                'block_struct': build_struct_repr(repeating_group.block_struct)}
 
             block_length_field = repeating_group.block_length_field
             group_description['block_length_field'] = {'name': block_length_field.name,
@@ -148,8 +173,14 @@ def main(argv=None):
                 field_description = build_field_description(field)
                 group_fields.append(field_description)
             group_description['fields'] = group_fields
+            group_description['data_fields'] = [build_field_description(data_field)
+                                                for data_field in repeating_group.data_fields]
             message_groups.append(group_description)
 
+        # Update the var data fields
+        for data_field in message_class.data_fields:
+            message_description['data_fields'].append(build_field_description(data_field))
+
         message_descriptions.append(message_description)
 
     template = Template(filename=template_file_path)
@@ -1,16 +1,18 @@
+from __future__ import print_function
+
 from struct import unpack_from
 from datetime import datetime
 import binascii
 from . import prettyprinter
 
-def handle_repeating_groups(group_container, msg_version, indent, skip_fields, secdef):
+def handle_repeating_groups(group_container, msg_version, indent, skip_fields, secdef, out=None):
     for group in group_container.groups:
         if group.since_version > msg_version:
             continue
-        print(':::{} - num_groups: {}'.format(group.name, group.num_groups))
-        for group_field in group.repeating_groups:
+        print('{}{} - num_groups: {}'.format(indent[:-1], group.name, group.num_groups), file=out)
+        for entry in group.repeating_groups:
             group_fields = ''
-            for group_field in group_field.fields:
+            for group_field in entry.fields:
                 if group_field.since_version > msg_version:
                     continue
                 if secdef and group_field.id == '48':
@@ -21,30 +23,34 @@ def handle_repeating_groups(group_container, msg_version, indent, skip_fields, s
                         group_fields += 'security_id: {} [{}] '.format(security_id, symbol)
                         continue
                 group_fields += str(group_field) + ' '
-            print('::::{}'.format(group_fields))
-        handle_repeating_groups(group, msg_version, indent + ':', skip_fields=skip_fields, secdef=secdef)
+            print('{}{}'.format(indent, group_fields), file=out)
+            # nested groups are positioned on the current entry
+            handle_repeating_groups(entry, msg_version, indent + '::', skip_fields=skip_fields, secdef=secdef, out=out)
 
 
-def decode_packet(mdp_parser, timestamp, data, skip_fields, print_data, pretty, secdef, packet_number):
+def decode_packet(mdp_parser, timestamp, data, skip_fields, print_data, pretty, secdef, packet_number, out=None):
+    """ Print the messages of a packet to out (sys.stdout if None) """
+    if mdp_parser.compiled:
+        raise ValueError('decoding requires the message types of a parsed (not compiled) schema')
     if print_data:
-        print('data: {}'.format(binascii.b2a_hex(data)))
+        print('data: {}'.format(binascii.b2a_hex(data)), file=out)
 
     # parse the packet header: http://www.cmegroup.com/confluence/display/EPICSANDBOX/MDP+3.0+-+Binary+Packet+Header
     sequence_number = unpack_from("<i", data, offset=0)[0]
     sending_time = unpack_from("<Q", data, offset=4)[0]
 
     print(':packet {} - timestamp: {} sequence_number: {} sending_time: {} '.format(
-        packet_number, timestamp, sequence_number, sending_time))
+        packet_number, timestamp, sequence_number, sending_time), file=out)
 
     if pretty:
-        # Two-passes on the parse so we can count the messages and print e.g. "Message 3 of 5"
-        #
-        # Cannot store messages from the iteration, as field objects get reused and overwritten
-        # on each round.
-        n = len(list(mdp_parser.parse(data, offset=12)))  # pass 1 to count the msgs in iterable
+        # Messages can't be stored as their field objects get reused on each round, so format
+        # them in a single pass and print once we know the count, e.g. "Message 3 of 5"
+        formatted_messages = [prettyprinter.format_message(mdp_message, secdef)
+                              for mdp_message in mdp_parser.parse(data, offset=12)]
+        n = len(formatted_messages)
 
-        for i, mdp_message in enumerate(mdp_parser.parse(data, offset=12)):  # pass 2 to actually print
-            prettyprinter.pretty_print(mdp_message, i, n, secdef)
+        for i, lines in enumerate(formatted_messages):
+            prettyprinter.print_message(lines, i, n, out)
     else:
         for mdp_message in mdp_parser.parse(data, offset=12):
             message_fields = ''
@@ -60,6 +66,7 @@ def decode_packet(mdp_parser, timestamp, data, skip_fields, print_data, pretty,
                         continue
                 if field.name not in skip_fields:
                     message_fields += ' ' + str(field)
-            print('::{} (tid:{})- {}'.format(mdp_message, mdp_message.template_id.value, message_fields))
-            handle_repeating_groups(mdp_message, mdp_message.version.value, indent='::::', skip_fields=skip_fields, secdef=secdef)
+            print('::{} (tid:{})- {}'.format(mdp_message, mdp_message.template_id.value, message_fields), file=out)
+            handle_repeating_groups(mdp_message, mdp_message.version.value, indent='::::', skip_fields=skip_fields, secdef=secdef,
+                                    out=out)
 
@@ -1,4 +1,8 @@
+from .orderbook import BID, OFFER, NEW, CHANGE, DELETE
 from .orderbook import OrderBookEntry
 from .orderbook import OrderBook
+from .orderbook import OrderBookLevels
+from .orderbook import ArrayOrderBook
 from .packet_processor import PacketProcessor
+from .packet_processor import StreamSequence
 from .orderbook import ConsolePrinter
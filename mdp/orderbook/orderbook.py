@@ -1,3 +1,20 @@
+from array import array
+
+NAN = float('nan')
+
+try:
+    INT64_TYPECODE = array('q').typecode
+except ValueError:  # python 2, 'l' is 64 bits on 64 bit unix, doubles are exact up to 2 ** 53
+    INT64_TYPECODE = 'l' if array('l').itemsize == 8 else 'd'
+
+# The book entry types (sides) and update actions OrderBook dispatches on, PacketProcessor maps the enum codes of
+# the MDP entries to them
+BID, OFFER = 0, 1
+NEW, CHANGE, DELETE = 0, 1, 2
+OUTRIGHT_ENTRY_TYPES = frozenset([BID, OFFER])
+BOOK_UPDATE_ACTIONS = frozenset([NEW, CHANGE, DELETE])
+
+
 class OrderBookEntry(object):
     def __init__(self):
         self.price = None
@@ -21,6 +38,11 @@ class OrderBook(object):
         self.last_price = None
         self.last_size = None
         self.last_aggressor_side = None
+        self.bids = None
+        self.offers = None
+        self.clear_levels()
+
+    def clear_levels(self):
         self.bids = []
         self.offers = []
         for i in range(0, self.levels):
@@ -32,11 +54,7 @@ class OrderBook(object):
         self.received_time = None
         self.stream_sequence = -1
         self.instrument_sequence = -1
-        self.bids = []
-        self.offers = []
-        for i in range(0, self.levels):
-            self.bids.append(OrderBookEntry())
-            self.offers.append(OrderBookEntry())
+        self.clear_levels()
 
     def have_seen_sequence(self, instrument_sequence):
         return instrument_sequence <= self.instrument_sequence
@@ -54,7 +72,7 @@ class OrderBook(object):
         self.instrument_sequence = instrument_sequence
 
     def add(self, level, side, price, size, num_orders):
-        entries = self.bids if side == 'Bid' else self.offers
+        entries = self.bids if side == BID else self.offers
         order_book_entry = OrderBookEntry()
         order_book_entry.price = price
         order_book_entry.size = size
@@ -63,14 +81,14 @@ class OrderBook(object):
         entries.pop()  # delete the last item from the list
 
     def change(self, level, side, price, size, num_orders):
-        entries = self.bids if side == 'Bid' else self.offers
+        entries = self.bids if side == BID else self.offers
         order_book_entry = entries[level-1]
         order_book_entry.price = price
         order_book_entry.size = size
         order_book_entry.num_orders = num_orders
 
     def delete(self, level, side):
-        entries = self.bids if side == 'Bid' else self.offers
+        entries = self.bids if side == BID else self.offers
         del entries[level-1]
         entries.append(OrderBookEntry())  # replace the deleted item with a new one
 
@@ -81,19 +99,19 @@ class OrderBook(object):
             return False
 
         # We only care about outright changes for now
-        if md_entry_type not in ['Bid', 'Offer']:
+        if md_entry_type not in OUTRIGHT_ENTRY_TYPES:
             return False
 
-        if md_update_action not in ['Change', 'New', 'Delete']:
+        if md_update_action not in BOOK_UPDATE_ACTIONS:
             return False
 
         self._update_book_keeping(sending_time,  received_time, stream_sequence, instrument_sequence)
 
-        if md_update_action == 'New':
+        if md_update_action == NEW:
             self.add(level, md_entry_type, price, size, num_orders)
-        elif md_update_action == 'Change':
+        elif md_update_action == CHANGE:
             self.change(level, md_entry_type, price, size, num_orders)
-        elif md_update_action == 'Delete':
+        elif md_update_action == DELETE:
             self.delete(level, md_entry_type)
 
         # return True if the update was relevant (occurred within the display_levels)
@@ -127,6 +145,102 @@ class OrderBook(object):
         return result
 
 
+class OrderBookLevels(object):
+    """ One side of an ArrayOrderBook, stored as parallel arrays of prices, sizes and number of orders
+
+    Indexing returns an OrderBookEntry copy of the level, empty levels have None values.
+    """
+    NULL = -2 ** 31  # sizes and number of orders are int32 on the wire
+    NULL_PRICE = -2 ** 63  # of integer prices
+
+    def __init__(self, levels, integer_prices=False):
+        self.levels = levels
+        self.null_price = self.NULL_PRICE if integer_prices else NAN
+        self.prices = array(INT64_TYPECODE if integer_prices else 'd', [self.null_price] * levels)
+        self.sizes = array('l', [self.NULL] * levels)
+        self.num_orders = array('l', [self.NULL] * levels)
+        self._empty_prices = array(self.prices.typecode, self.prices)
+        self._empty_quantities = array('l', self.sizes)
+
+    def clear(self):
+        self.prices[:] = self._empty_prices
+        self.sizes[:] = self._empty_quantities
+        self.num_orders[:] = self._empty_quantities
+
+    def insert(self, index, price, size, num_orders):
+        if index >= self.levels:
+            return  # beyond the depth of the book
+        # shift the levels below down in place (element by element, slicing would copy), the last one falls
+        # off the book
+        for values in (self.prices, self.sizes, self.num_orders):
+            for i in range(self.levels - 1, index, -1):
+                values[i] = values[i - 1]
+        self.set(index, price, size, num_orders)
+
+    def set(self, index, price, size, num_orders):
+        self.prices[index] = self.null_price if price is None else price
+        self.sizes[index] = self.NULL if size is None else size
+        self.num_orders[index] = self.NULL if num_orders is None else num_orders
+
+    def remove(self, index):
+        if index >= self.levels:
+            return  # beyond the depth of the book
+        # shift the levels below up in place and clear the last one
+        for values in (self.prices, self.sizes, self.num_orders):
+            for i in range(index, self.levels - 1):
+                values[i] = values[i + 1]
+        self.set(self.levels - 1, None, None, None)
+
+    def __len__(self):
+        return self.levels
+
+    def __getitem__(self, index):
+        price = self.prices[index]
+        size = self.sizes[index]
+        num_orders = self.num_orders[index]
+        entry = OrderBookEntry()
+        entry.price = None if price != price or price == self.NULL_PRICE else price
+        entry.size = None if size == self.NULL else size
+        entry.num_orders = None if num_orders == self.NULL else num_orders
+        return entry
+
+    def __iter__(self):
+        for i in range(self.levels):
+            yield self[i]
+
+
+class ArrayOrderBook(OrderBook):
+    """ OrderBook storing its levels in preallocated arrays (see OrderBookLevels)
+
+    Updates shift the levels in place instead of allocating an OrderBookEntry per level, which keeps the
+    allocations (and garbage collections) down when building many books.  Prices are stored as floats, or
+    as 64 bit integers with integer_prices (e.g. for a schema with price_mode='fixed').
+    """
+    def __init__(self, security_id, levels, description, integer_prices=False):
+        self.integer_prices = integer_prices
+        super(ArrayOrderBook, self).__init__(security_id, levels, description)
+
+    def clear_levels(self):
+        if self.bids is None:
+            self.bids = OrderBookLevels(self.levels, self.integer_prices)
+            self.offers = OrderBookLevels(self.levels, self.integer_prices)
+        else:
+            self.bids.clear()
+            self.offers.clear()
+
+    def add(self, level, side, price, size, num_orders):
+        entries = self.bids if side == BID else self.offers
+        entries.insert(level-1, price, size, num_orders)
+
+    def change(self, level, side, price, size, num_orders):
+        entries = self.bids if side == BID else self.offers
+        entries.set(level-1, price, size, num_orders)
+
+    def delete(self, level, side):
+        entries = self.bids if side == BID else self.offers
+        entries.remove(level-1)
+
+
 class ConsolePrinter(object):
     def on_orderbook(self, orderbook):
         print(str(orderbook))
@@ -135,6 +249,9 @@ class ConsolePrinter(object):
             orderbook.description, orderbook.security_id, orderbook.stream_sequence, orderbook.instrument_sequence,
             orderbook.sending_time, orderbook.received_time, orderbook.last_size, orderbook.last_price,
             orderbook.last_aggressor_side))
+    def on_gap(self, channel, first_sequence_number, last_sequence_number):
+        print('warning: stream sequence gap from {} to {} on channel {}'.format(
+            first_sequence_number, last_sequence_number, channel))
 
 
 
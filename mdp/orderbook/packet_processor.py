@@ -1,13 +1,112 @@
 from struct import unpack_from
-from .orderbook import OrderBook
+from .orderbook import OrderBook, BID, OFFER, NEW, CHANGE, DELETE
+from ..secdef import SecDef
+
+
+class StreamSequence(object):
+    """ Arbitrate the packets of a channel, received once or more (e.g. on its A and B feeds), in sequence order
+
+    The first packet to arrive with a given sequence number is accepted, later copies are dropped.  Packets are
+    released in sequence number order: a packet arriving after a missing one is held until the missing packet is
+    filled in (e.g. by the other feed), so that the updates of both are applied in order.  A sequence number is
+    only reported missing once window packets have been received past it, the packets held behind it are then
+    released.
+    """
+    def __init__(self, window=64):
+        self.window = window
+        self.sequence_number = -1  # of the last packet released (or reported missing)
+        self.highest = -1  # highest sequence number received
+        self.pending = {}  # sequence number -> packet held until the missing packets before it arrive
+        self.duplicates = 0
+
+    def in_order(self, sequence_number):
+        """ Return whether a packet would be released as soon as it is received, i.e. not held """
+        return self.sequence_number < 0 or sequence_number == self.sequence_number + 1
+
+    def accept(self, sequence_number, packet):
+        """ Return (released, gaps): the (sequence_number, packet) now released in order and the (first, last)
+        sequence number ranges now missing, which come before the released packets with higher sequence numbers
+
+        Dropped copies release nothing, held packets are released by later calls (or flush()).
+        """
+        if self.sequence_number < 0:
+            # nothing before the first packet is expected
+            self.sequence_number = sequence_number - 1
+        if sequence_number <= self.sequence_number or sequence_number in self.pending:
+            self.duplicates += 1
+            return (), ()
+
+        if sequence_number > self.highest:
+            self.highest = sequence_number
+        if sequence_number != self.sequence_number + 1:
+            self.pending[sequence_number] = packet
+            return self._expire(self.highest - self.window)
+
+        released = [(sequence_number, packet)]
+        self.sequence_number = sequence_number
+        self._release(released)
+        if not self.pending:
+            return released, ()
+        released_later, gaps = self._expire(self.highest - self.window)
+        return released + released_later, gaps
+
+    def _release(self, released):
+        # the packets held that now follow the last packet released
+        pending = self.pending
+        while self.sequence_number + 1 in pending:
+            self.sequence_number += 1
+            released.append((self.sequence_number, pending.pop(self.sequence_number)))
+
+    def _expire(self, limit):
+        # give up on the missing sequence numbers up to limit, releasing the packets held behind them
+        released = []
+        gaps = []
+        while self.pending and self.sequence_number < limit:
+            first = self.sequence_number + 1
+            last = min(min(self.pending) - 1, limit)
+            gaps.append((first, last))
+            self.sequence_number = last
+            self._release(released)
+        return released, gaps
+
+    def flush(self):
+        """ Return (released, gaps) for the packets still held and the sequence numbers missing before them """
+        return self._expire(self.highest)
+
 
 class PacketProcessor(object):
-    def __init__(self, mdp_parser, secdef, security_id_filter=None):
+    # Only the messages handled by handle_message() are decoded
+    template_ids = frozenset([32, 42])
+
+    # Instrument definitions are handed to the secdef, if it handles them (see SecDef.handle_definition())
+    definition_template_ids = SecDef.template_ids
+
+    # The book entry types and update actions handled by OrderBook.handle_update(), by enum value
+    entry_types = {'Bid': BID, 'Offer': OFFER}
+    update_actions = {'New': NEW, 'Change': CHANGE, 'Delete': DELETE}
+
+    def __init__(self, mdp_parser, secdef, security_id_filter=None, channels=None, window=64,
+                 orderbook_class=OrderBook):
+        """ channels maps the (address, port) destination of the feeds to the channel they carry, so that the
+        A and B feeds of a channel are arbitrated together.  Unmapped destinations are their own channel.
+
+        orderbook_class is the class of the books built, e.g. ArrayOrderBook.
+        """
+        if getattr(mdp_parser, 'compiled', False):
+            raise ValueError('PacketProcessor requires the message types of a parsed (not compiled) schema')
         self.mdp_parser = mdp_parser
         self.secdef = secdef
         self.security_id_filter = security_id_filter
+        self.channels = channels or {}
+        self.window = window
+        self.orderbook_class = orderbook_class
+        self.parse_template_ids = self.template_ids
+        if hasattr(secdef, 'handle_definition'):
+            self.parse_template_ids = self.template_ids | self.definition_template_ids
 
-        self.stream_sequence_number = -1  # Note: currently only handles a single stream
+        self._enum_values = {}  # (message type, field name) -> {code: book code} of the enum values handled
+        self.stream_sequences = {}  # channel -> StreamSequence
+        self.stream_sequence_number = -1  # of the last packet processed
         self.sending_time = None
 
         self.orderbook_handler = None
@@ -15,32 +114,82 @@ class PacketProcessor(object):
         # We only keep track of the base books, implieds aren't handled
         self.base_orderbooks = {}
 
-    def handle_packet(self, received_time, mdp_packet):
+    def handle_packet(self, received_time, mdp_packet, destination=None):
+        """ Process a packet received on the (address, port) destination, or a single stream if not given """
+        channel = self.channels.get(destination, destination)
+        stream_sequence = self.stream_sequences.get(channel)
+        if stream_sequence is None:
+            stream_sequence = self.stream_sequences[channel] = StreamSequence(self.window)
+
         sequence_number = unpack_from('<i', mdp_packet, offset=0)[0]
-        if sequence_number <= self.stream_sequence_number:
-            # already have seen this packet
-            return
+        if not stream_sequence.in_order(sequence_number):
+            # held until the packets missing before it arrive, the buffer may be reused by then
+            mdp_packet = bytearray(mdp_packet)
+        released, gaps = stream_sequence.accept(sequence_number, (received_time, mdp_packet))
+        self.handle_released(channel, released, gaps)
 
-        if self.stream_sequence_number + 1 != sequence_number:
-            print('warning: stream sequence gap from {} to {}'.format(self.stream_sequence_number, sequence_number))
+    def handle_released(self, channel, released, gaps):
+        gaps = list(gaps)
+        for sequence_number, (received_time, mdp_packet) in released:
+            while gaps and gaps[0][0] < sequence_number:
+                self.handle_gap(channel, *gaps.pop(0))
+            self.process_packet(sequence_number, received_time, mdp_packet)
+        for first, last in gaps:
+            self.handle_gap(channel, first, last)
 
+    def process_packet(self, sequence_number, received_time, mdp_packet):
         sending_time = unpack_from('<Q', mdp_packet, offset=4)[0]
 
         self.stream_sequence_number = sequence_number
         self.sending_time = sending_time
 
-        for mdp_message in self.mdp_parser.parse(mdp_packet, offset=12):
+        for mdp_message in self.mdp_parser.parse(mdp_packet, offset=12, template_ids=self.parse_template_ids):
             self.handle_message(sequence_number, sending_time, received_time, mdp_message)
 
+    def flush(self):
+        """ Process the packets still held and report the packets missing at the end of the streams """
+        for channel, stream_sequence in self.stream_sequences.items():
+            released, gaps = stream_sequence.flush()
+            self.handle_released(channel, released, gaps)
+
+    def handle_gap(self, channel, first_sequence_number, last_sequence_number):
+        on_gap = getattr(self.orderbook_handler, 'on_gap', None)
+        if on_gap:
+            on_gap(channel, first_sequence_number, last_sequence_number)
+
+    def enum_values(self, message_type, field, values):
+        """ Map the integer codes of an enum field of a message type to the book codes of its values that are in
+        values (a dict of value to book code), so that entries are dispatched on ints without decoding the values
+        (strings) of each entry.  The codes of a field may differ between schemas (or versions), hence the
+        message type. """
+        key = (message_type, field.name)
+        code_to_value = self._enum_values.get(key)
+        if code_to_value is None:
+            code_to_value = dict((code, values[value]) for code, value in field.code_to_enum_description.items()
+                                 if value in values)
+            self._enum_values[key] = code_to_value
+        return code_to_value
+
     def handle_message(self, stream_sequence_number, sending_time, received_time, mdp_message):
         # We only care about the incremental refresh book packets at this point
-        if mdp_message.template_id.value == 32:
+        template_id = mdp_message.template_id.value
+        if template_id == 32:
             self.handle_incremental_refresh_book(stream_sequence_number, sending_time, received_time, mdp_message)
-        elif mdp_message.template_id.value == 42:
+        elif template_id == 42:
             self.handle_incremental_refresh_trade_summary(stream_sequence_number, sending_time, received_time, mdp_message)
+        elif template_id in self.definition_template_ids:
+            self.handle_instrument_definition(mdp_message)
+
+    def handle_instrument_definition(self, definition_message):
+        self.secdef.handle_definition(definition_message)
+        security_id = definition_message.security_id.value
+        if security_id in self.base_orderbooks and self.base_orderbooks[security_id] is None:
+            # updates seen before the definition were dropped, build the book from now on
+            del self.base_orderbooks[security_id]
 
     def handle_incremental_refresh_book(self, stream_sequence_number, sending_time, received_time, incremental_message):
         updated_books = set()  # Note: we batch all the updates from a single packet into one update
+        message_type = type(incremental_message)
         for md_entry in incremental_message.no_md_entries:
 
             security_id = md_entry.security_id.value
@@ -49,9 +198,9 @@ class PacketProcessor(object):
 
             if security_id not in self.base_orderbooks:
                 security_info = self.secdef.lookup_security_id(security_id)
-                if security_info:
+                if security_info and security_info[1] is not None:
                     symbol, depth = security_info
-                    ob = OrderBook(security_id, depth, symbol)
+                    ob = self.orderbook_class(security_id, depth, symbol)
                     self.base_orderbooks[security_id] = ob
                 else:
                     # Can't properly handle an orderbook without knowing the depth
@@ -61,13 +210,20 @@ class PacketProcessor(object):
             if not orderbook:
                 return
 
+            md_entry_type_field = md_entry.md_entry_type
+            md_entry_type = self.enum_values(message_type, md_entry_type_field, self.entry_types).get(
+                md_entry_type_field.code)
+            md_update_action_field = md_entry.md_update_action
+            md_update_action = self.enum_values(message_type, md_update_action_field, self.update_actions).get(
+                md_update_action_field.code)
+            if md_entry_type is None or md_update_action is None:
+                continue  # We only care about outright changes for now
+
             md_entry_price = md_entry.md_entry_px.value
             md_entry_size = md_entry.md_entry_size.value
             rpt_sequence = md_entry.rpt_seq.value
             number_of_orders = md_entry.number_of_orders.value
             md_price_level = md_entry.md_price_level.value
-            md_update_action = md_entry.md_update_action.value
-            md_entry_type = md_entry.md_entry_type.value
 
             visible_updated = orderbook.handle_update(sending_time, received_time, stream_sequence_number, rpt_sequence,
                 md_price_level, md_entry_type, md_update_action, md_entry_price, md_entry_size, number_of_orders)
@@ -88,9 +244,9 @@ class PacketProcessor(object):
 
             if security_id not in self.base_orderbooks:
                 security_info = self.secdef.lookup_security_id(security_id)
-                if security_info:
+                if security_info and security_info[1] is not None:
                     symbol, depth = security_info
-                    self.base_orderbooks[security_id] = OrderBook(security_id, depth, symbol)
+                    self.base_orderbooks[security_id] = self.orderbook_class(security_id, depth, symbol)
                 else:
                     # Can't properly handle an orderbook without knowing the depth
                     self.base_orderbooks[security_id] = None
@@ -0,0 +1,87 @@
+"""
+Decode a pcap or pcapng capture with a pool of worker processes.
+
+The parent process only walks the capture's record headers and hands batches of frame offsets to the workers,
+which map the file themselves, decode the UDP payloads of their batch and send back the handler's results.
+Results are yielded in capture order, with at most max_pending batches in flight.
+
+Parsers (and the schema behind them) can't be pickled, so each worker builds its own by calling parser_factory.
+Both parser_factory and handler must be picklable, e.g. module level functions or functools.partial of them:
+
+    def make_parser(schema_filename):
+        schema = MDPSchema()
+        schema.parse(schema_filename, cache_dir='/var/tmp/sbedecoder')
+        return SBEParser(MDPMessageFactory(schema))
+
+    def trades(parser, timestamp, packet):
+        return [record for record in parser.parse_records(packet, offset=12, template_ids={42})]
+
+    for trades in parallel_decode('capture.pcap', partial(make_parser, 'templates_FixBinary.xml'), trades):
+        ...
+"""
+
+import multiprocessing
+from collections import deque
+from itertools import islice
+
+from .pcap import PcapReader, capture_frames, frame_payloads
+
+_worker = None
+
+
+class _Worker(object):
+    def __init__(self, pcap_filename, parser_factory, handler):
+        self.reader = PcapReader(pcap_filename)
+        self.parser = parser_factory()
+        self.handler = handler
+
+    def decode(self, frames):
+        parser = self.parser
+        handler = self.handler
+        return [handler(parser, timestamp, payload)
+                for timestamp, payload in frame_payloads(self.reader.buffer, frames)]
+
+
+def _init_worker(pcap_filename, parser_factory, handler):
+    global _worker
+    _worker = _Worker(pcap_filename, parser_factory, handler)
+
+
+def _decode_batch(frames):
+    return _worker.decode(frames)
+
+
+def _batches(frames, batch_size):
+    while True:
+        batch = list(islice(frames, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def parallel_decode(pcap_filename, parser_factory, handler, processes=None, batch_size=1000, max_pending=None):
+    """ Yield handler(parser, timestamp, packet) for each UDP datagram of a capture, in capture order
+
+    The datagrams are decoded by processes workers (defaults to the number of cpus), batch_size datagrams at
+    a time.  At most max_pending batches (defaults to twice the number of workers) are queued or waiting to
+    be yielded, which bounds the memory used when the results are consumed slower than they are produced.
+    Gzipped captures are decompressed into memory by every worker.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    max_pending = max_pending or 2 * processes
+    pool = multiprocessing.Pool(processes, _init_worker, (pcap_filename, parser_factory, handler))
+    try:
+        with PcapReader(pcap_filename) as reader:
+            pending = deque()
+            for batch in _batches(capture_frames(reader.buffer), batch_size):
+                if len(pending) >= max_pending:
+                    for result in pending.popleft().get():
+                        yield result
+                pending.append(pool.apply_async(_decode_batch, (batch,)))
+            while pending:
+                for result in pending.popleft().get():
+                    yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,249 @@
+"""
+Read the UDP payloads of a pcap or pcapng capture without copying them.
+
+The capture file is memory mapped and each UDP payload is yielded as a memoryview slice of the map, which
+can be handed straight to SBEParser.parse().  Only the fixed Ethernet (optionally VLAN tagged), Linux cooked
+or raw IPv4 headers and the UDP header are parsed; other packets and fragmented datagrams are skipped.
+"""
+
+import gzip
+import mmap
+import socket
+from struct import Struct
+
+PCAP_MAGIC_MICROSECONDS = 0xa1b2c3d4
+PCAP_MAGIC_NANOSECONDS = 0xa1b23c4d
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+IP_PROTO_UDP = 17
+
+_ether_type = Struct('!H')
+_ipv4_header = Struct('!BxH2xHxB')  # version/ihl, total length, flags/fragment offset, protocol
+_udp_length = Struct('!4xH')
+_ip_destination = Struct('!16x4s')
+_udp_destination_port = Struct('!2xH')
+
+
+def udp_destination(frame, ip_offset, start):
+    """ Return the (address, port) destination of the datagram found by udp_datagram() """
+    address = _ip_destination.unpack_from(frame, ip_offset)[0]
+    port = _udp_destination_port.unpack_from(frame, start - 8)[0]
+    return socket.inet_ntoa(address), port
+
+
+def udp_datagram(linktype, frame, offset, end):
+    """ Return the (ip_offset, start, end) offsets of the IP header and UDP payload of the frame at
+    frame[offset:end], or None if the frame isn't an unfragmented IPv4 UDP datagram
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        ether_type = _ether_type.unpack_from(frame, offset + 12)[0]
+        offset += 14
+        while ether_type in ETH_TYPE_VLAN:
+            ether_type = _ether_type.unpack_from(frame, offset + 2)[0]
+            offset += 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        ether_type = _ether_type.unpack_from(frame, offset + 14)[0]
+        offset += 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        ether_type = _ether_type.unpack_from(frame, offset)[0]
+        offset += 20
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        ether_type = ETH_TYPE_IP
+    else:
+        return None
+
+    if ether_type != ETH_TYPE_IP or offset + 20 > end:
+        return None
+    ip_offset = offset
+    version_ihl, total_length, fragment, protocol = _ipv4_header.unpack_from(frame, offset)
+    if version_ihl >> 4 != 4 or protocol != IP_PROTO_UDP or fragment & 0x3fff:
+        return None  # not IPv4/UDP, or a fragment (more fragments flag or a fragment offset)
+
+    if total_length:
+        end = min(end, offset + total_length)  # drop any Ethernet padding
+    offset += (version_ihl & 0x0f) * 4
+    if offset + 8 > end:
+        return None
+    udp_length = _udp_length.unpack_from(frame, offset)[0]
+    return ip_offset, offset + 8, min(end, offset + udp_length)
+
+
+def pcap_frames(buffer):
+    """ Yield (timestamp, linktype, offset, end) for each frame of a pcap capture """
+    magic = Struct('<I').unpack_from(buffer, 0)[0]
+    endian = '<' if magic in (PCAP_MAGIC_MICROSECONDS, PCAP_MAGIC_NANOSECONDS) else '>'
+    magic, linktype = Struct(endian + 'I16xI').unpack_from(buffer, 0)
+    if magic == PCAP_MAGIC_MICROSECONDS:
+        resolution = 1e-6
+    elif magic == PCAP_MAGIC_NANOSECONDS:
+        resolution = 1e-9
+    else:
+        raise ValueError('not a pcap file')
+    linktype &= 0xffff
+
+    record_header = Struct(endian + 'IIII')
+    offset = 24
+    size = len(buffer)
+    while offset + 16 <= size:
+        seconds, fraction, captured_length, _ = record_header.unpack_from(buffer, offset)
+        offset += 16
+        yield seconds + fraction * resolution, linktype, offset, min(offset + captured_length, size)
+        offset += captured_length
+
+
+def _pcapng_resolution(block, offset, end, endian):
+    """ Read the timestamp resolution (if_tsresol option) of an interface description block """
+    option_header = Struct(endian + 'HH')
+    while offset + 4 <= end:
+        code, length = option_header.unpack_from(block, offset)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            tsresol = bytearray(block[offset + 4:offset + 5])[0]
+            if tsresol & 0x80:
+                return 2.0 ** -(tsresol & 0x7f)
+            return 10.0 ** -tsresol
+        offset += 4 + ((length + 3) & ~3)
+    return 1e-6
+
+
+def pcapng_frames(buffer):
+    """ Yield (timestamp, linktype, offset, end) for each packet of a pcapng capture """
+    size = len(buffer)
+    offset = 0
+    endian = '<'
+    interfaces = []
+    while offset + 12 <= size:
+        block_type = Struct(endian + 'I').unpack_from(buffer, offset)[0]
+        if block_type == PCAPNG_SECTION_HEADER:
+            # each section sets its own byte order and interfaces
+            byte_order_magic = Struct('<I').unpack_from(buffer, offset + 8)[0]
+            endian = '<' if byte_order_magic == PCAPNG_BYTE_ORDER_MAGIC else '>'
+            interfaces = []
+        block_length = Struct(endian + 'I').unpack_from(buffer, offset + 4)[0]
+        if block_length < 12:
+            raise ValueError('invalid pcapng block length %d at offset %d' % (block_length, offset))
+        block_end = min(offset + block_length, size)
+
+        if block_type == 1:  # interface description block
+            linktype = Struct(endian + 'H').unpack_from(buffer, offset + 8)[0]
+            interfaces.append((linktype, _pcapng_resolution(buffer, offset + 16, block_end - 4, endian)))
+        elif block_type == 6:  # enhanced packet block
+            interface_id, high, low, captured_length = Struct(endian + 'IIII').unpack_from(buffer, offset + 8)
+            linktype, resolution = interfaces[interface_id]
+            start = offset + 28
+            yield ((high << 32) | low) * resolution, linktype, start, min(start + captured_length, block_end)
+        elif block_type == 3:  # simple packet block (no timestamp)
+            linktype, resolution = interfaces[0]
+            start = offset + 12
+            original_length = Struct(endian + 'I').unpack_from(buffer, offset + 8)[0]
+            yield None, linktype, start, min(start + original_length, block_end - 4)
+        elif block_type == 2:  # (obsolete) packet block
+            interface_id, high, low, captured_length = Struct(endian + 'H2xIII').unpack_from(buffer, offset + 8)
+            linktype, resolution = interfaces[interface_id]
+            start = offset + 28
+            yield ((high << 32) | low) * resolution, linktype, start, min(start + captured_length, block_end)
+        offset += block_length
+
+
+def udp_payloads(buffer):
+    """ Yield (timestamp, payload) for each UDP datagram of a pcap or pcapng capture held in buffer
+
+    Timestamps are in seconds since the epoch and payloads are memoryview slices of buffer.
+    """
+    return frame_payloads(buffer, capture_frames(buffer))
+
+
+def capture_frames(buffer):
+    """ Yield (timestamp, linktype, offset, end) for each frame of a pcap or pcapng capture held in buffer """
+    if len(buffer) < 24:
+        return iter(())
+    magic = Struct('<I').unpack_from(buffer, 0)[0]
+    return pcapng_frames(buffer) if magic == PCAPNG_SECTION_HEADER else pcap_frames(buffer)
+
+
+def frame_payloads(buffer, frames):
+    """ Yield (timestamp, payload) for the UDP datagrams of frames, as yielded by capture_frames(buffer) """
+    try:
+        view = memoryview(buffer)
+    except TypeError:
+        view = buffer  # python 2 mmaps don't export the new buffer interface, slicing them copies
+    for timestamp, linktype, offset, end in frames:
+        datagram = udp_datagram(linktype, buffer, offset, end)
+        if datagram is not None:
+            yield timestamp, view[datagram[1]:datagram[2]]
+
+
+def udp_datagrams(buffer):
+    """ Yield (timestamp, (address, port), payload) for each UDP datagram of a capture held in buffer
+
+    Same as udp_payloads() but with the destination address and port of each datagram, e.g. to tell the
+    channels and A/B feeds of a capture apart.
+    """
+    try:
+        view = memoryview(buffer)
+    except TypeError:
+        view = buffer
+    for timestamp, linktype, offset, end in capture_frames(buffer):
+        datagram = udp_datagram(linktype, buffer, offset, end)
+        if datagram is not None:
+            ip_offset, start, end = datagram
+            yield timestamp, udp_destination(buffer, ip_offset, start), view[start:end]
+
+
+class PcapReader(object):
+    """ Iterate over the UDP payloads of a pcap or pcapng file (optionally gzipped)
+
+        with PcapReader('capture.pcap') as pcap:
+            for timestamp, payload in pcap:
+                ...
+
+    Plain files are memory mapped, gzipped files are decompressed into memory. Payloads are memoryviews
+    into the file's contents and are only valid until the reader is closed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+        self.buffer = None
+        if filename.endswith('.gz'):
+            with gzip.open(filename, 'rb') as gzip_file:
+                self.buffer = gzip_file.read()
+        else:
+            self._file = open(filename, 'rb')
+            try:
+                self.buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                self.buffer = b''  # empty file, which can't be mapped
+
+    def __iter__(self):
+        return udp_payloads(self.buffer)
+
+    def datagrams(self):
+        """ Iterate over (timestamp, (address, port), payload) for each UDP datagram, see udp_datagrams() """
+        return udp_datagrams(self.buffer)
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            try:
+                self.buffer.close()
+            except BufferError:
+                pass  # payloads are still referenced, the map is released with them
+        self.buffer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,3 +1,5 @@
+from __future__ import print_function
+
 
 from datetime import datetime
 
@@ -28,33 +30,47 @@ def adjustField(field, secdef):
     # Make prices match MC (no decimal)
     if field.semantic_type == 'Price':
         if value is not None:
-            value = '{} ({})'.format(int(float(value) * 10000000), value)
+            mantissa = getattr(field, 'mantissa', None)
+            if mantissa is not None:
+                value = '{} ({})'.format(mantissa.value, value)
+            else:
+                value = '{} ({})'.format(int(round(float(value) * 10000000)), value)
 
     value = '<Empty>' if value == '' else value
     value = 'Null' if value is None else value
     return value
 
 
-def pretty_print(msg, i, n, secdef):
-    print('    Message %d of %d: TID %d (%s) v%d' % (i + 1, n, msg.template_id.value, msg.name, msg.version.value))
+def format_message(msg, secdef):
+    lines = ['TID %d (%s) v%d' % (msg.template_id.value, msg.name, msg.version.value)]
     for field in [x for x in msg.fields if x.original_name[0].isupper()]:
         if field.since_version > msg.version.value: # field is later version than msg
             continue
         value = adjustField(field, secdef)
         if field.id:
-            print('        %s (%s): %s' % (field.original_name, field.id, value))
+            lines.append('        %s (%s): %s' % (field.original_name, field.id, value))
         else:
-            print('        %s: %s' % (field.original_name, value))
+            lines.append('        %s: %s' % (field.original_name, value))
     for group_container in msg.groups:
         if group_container.since_version > msg.version.value:
             continue
-        print('        %s (%d): %d' % (
+        lines.append('        %s (%d): %d' % (
         group_container.original_name, group_container.id, group_container.num_groups))
         for i_instance, group_instance in enumerate(group_container):
-            print('        Entry %d' % (i_instance + 1))
+            lines.append('        Entry %d' % (i_instance + 1))
             for field in group_instance.fields:
                 if field.since_version > msg.version.value:
                     continue
                 value = adjustField(field, secdef)
-                print('            %s (%s): %s' % (field.original_name, field.id, value))
+                lines.append('            %s (%s): %s' % (field.original_name, field.id, value))
+    return lines
+
+
+def print_message(lines, i, n, out=None):
+    print('    Message %d of %d: %s' % (i + 1, n, lines[0]), file=out)
+    for line in lines[1:]:
+        print(line, file=out)
+
 
+def pretty_print(msg, i, n, secdef, out=None):
+    print_message(format_message(msg, secdef), i, n, out)
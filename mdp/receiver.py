@@ -0,0 +1,356 @@
+"""
+Receive MDP packets from (multicast) UDP feeds with asyncio, e.g. to build books from the live channels.
+
+MDPReceiver joins the multicast groups of the feeds and hands each datagram to a handler called as
+handler(received_time, packet, destination), the signature of PacketProcessor.handle_packet():
+
+    processor = PacketProcessor(SBEParser(MDPMessageFactory(schema)), secdef, channels=channels)
+    receiver = MDPReceiver(processor.handle_packet, [('224.0.31.1', 14310), ('224.0.32.1', 15310)],
+                           interface='10.1.2.3')
+    loop.run_until_complete(receiver.start())
+    loop.run_forever()
+
+received_time is in microseconds since the epoch (as read from captures by scripts/mdp_book_builder.py) and
+destination is the (address, port) feed the packet was received on, so the A and B feeds of a channel can be
+arbitrated.  Any callable can be used as handler, e.g. one handing the packet to SBEParser.parse().
+
+By default packets are handled as soon as they are received, straight from the event loop's read callback and
+without being copied.  Handling a burst then delays reading the sockets, so the burst has to fit in the
+socket receive buffers (see rcvbuf).  With max_queue, packets are queued when received and handled by a
+task that yields to the event loop every batch_size packets: reading the sockets (which is cheap) goes first
+and the queue absorbs bursts, packets received while it is full are dropped and counted.  queue_depth,
+max_queue_depth and packets_dropped measure how far behind the handler is.
+
+Reading a datagram per callback (and allocating it as bytes) is too slow for the bursts of market open.  With
+ring_slots, each socket is read by a DatagramReader instead: the datagrams waiting are read in batches, with a
+single recvmmsg() call on Linux (recv_into() calls elsewhere), into a preallocated ring of ring_slots buffers,
+and handed to the handler as memoryviews of the ring, which SBEParser.parse() decodes in place.  A buffer is
+reused once the reader has gone around the ring, so handlers must copy the packets they keep, and max_queue
+can't be larger than ring_slots.
+
+Requires python 3 (asyncio).
+"""
+
+import asyncio
+import ctypes
+import errno
+import os
+import socket
+import sys
+import time
+from collections import deque
+from struct import pack
+
+
+def received_time_us():
+    return int(time.time() * 1000000)
+
+
+def is_multicast(address):
+    return 224 <= int(address.split('.')[0]) <= 239
+
+
+def feed_socket(address, port, interface='0.0.0.0', rcvbuf=None):
+    """ Return a non blocking UDP socket receiving the datagrams sent to address:port, joining its multicast
+    group on interface """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    try:
+        # several feeds (and processes) may listen on the same port
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        if is_multicast(address):
+            # binding to the group only receives its datagrams on Linux, other systems need the wildcard address
+            try:
+                sock.bind((address, port))
+            except OSError:
+                sock.bind(('', port))
+            membership = pack('4s4s', socket.inet_aton(address), socket.inet_aton(interface))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        else:
+            sock.bind((address, port))
+        sock.setblocking(False)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IOVec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+_recvmmsg = None
+if sys.platform.startswith('linux'):
+    try:
+        _recvmmsg = ctypes.CDLL(None, use_errno=True).recvmmsg
+        _recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        _recvmmsg.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        _recvmmsg = None
+
+_retry_errors = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class DatagramReader(object):
+    """ Reads the datagrams waiting on a non blocking socket in batches, into a preallocated ring of buffers
+
+    read() returns memoryviews of the datagrams in the ring, no bytes are allocated per datagram.  A slot is
+    reused once the reader has gone around the ring, so a datagram has to be handled (or copied) before slots
+    more are read.  slot_size should be larger than the largest datagram (MDP packets are at most 1420 bytes),
+    datagrams filling a slot are counted as truncated.
+    """
+    def __init__(self, sock, slots=256, slot_size=2048, use_recvmmsg=None):
+        if use_recvmmsg is None:
+            use_recvmmsg = _recvmmsg is not None
+        elif use_recvmmsg and _recvmmsg is None:
+            raise ValueError('recvmmsg is not available on this system')
+        self.sock = sock
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buffer = bytearray(slots * slot_size)
+        view = memoryview(self.buffer)
+        self.slot_views = [view[i * slot_size:(i + 1) * slot_size] for i in range(slots)]
+        self._scratch = bytearray(slot_size)
+        self.position = 0  # the slot the next datagram is read into
+        self.reads = 0  # calls reading datagrams, packets received / reads is the batching achieved
+        self.truncated = 0
+        self._messages = self._recvmmsg_messages() if use_recvmmsg else None
+
+    def _recvmmsg_messages(self):
+        # one message header per slot, pointing at the slot in the ring
+        self._c_buffer = (ctypes.c_char * len(self.buffer)).from_buffer(self.buffer)
+        base = ctypes.addressof(self._c_buffer)
+        self._iovecs = (_IOVec * self.slots)()
+        messages = (_MMsgHdr * self.slots)()
+        for i in range(self.slots):
+            self._iovecs[i].iov_base = base + i * self.slot_size
+            self._iovecs[i].iov_len = self.slot_size
+            messages[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            messages[i].msg_hdr.msg_iovlen = 1
+        self._messages_address = ctypes.addressof(messages)
+        return messages
+
+    def read(self, max_packets=None):
+        """ Read the datagrams waiting, up to max_packets and the end of the ring, returning their memoryviews """
+        start = self.position
+        count = self.slots - start
+        if max_packets is not None and max_packets < count:
+            count = max_packets
+        if self._messages is not None:
+            sizes = self._read_recvmmsg(start, count)
+        else:
+            sizes = self._read_recv_into(start, count)
+        if not sizes:
+            return []
+        self.reads += 1
+        self.position = (start + len(sizes)) % self.slots
+        slot_views = self.slot_views
+        slot_size = self.slot_size
+        packets = []
+        for i, size in enumerate(sizes, start):
+            if size >= slot_size:
+                self.truncated += 1
+            packets.append(slot_views[i][:size])
+        return packets
+
+    def _read_recvmmsg(self, start, count):
+        received = _recvmmsg(self.sock.fileno(), self._messages_address + start * ctypes.sizeof(_MMsgHdr),
+                             count, socket.MSG_DONTWAIT, None)
+        if received < 0:
+            error = ctypes.get_errno()
+            if error in _retry_errors:
+                return []
+            raise OSError(error, os.strerror(error))
+        messages = self._messages
+        return [messages[i].msg_len for i in range(start, start + received)]
+
+    def _read_recv_into(self, start, count):
+        recv_into = self.sock.recv_into
+        slot_views = self.slot_views
+        sizes = []
+        for i in range(start, start + count):
+            try:
+                sizes.append(recv_into(slot_views[i]))
+            except (BlockingIOError, InterruptedError):
+                break
+        return sizes
+
+    def discard(self, max_packets):
+        """ Read and drop up to max_packets of the datagrams waiting, without touching the ring, returning their
+        sizes """
+        recv_into = self.sock.recv_into
+        scratch = self._scratch
+        sizes = []
+        for _ in range(max_packets):
+            try:
+                sizes.append(recv_into(scratch))
+            except (BlockingIOError, InterruptedError):
+                break
+        return sizes
+
+
+class _FeedProtocol(asyncio.DatagramProtocol):
+    def __init__(self, receiver, destination):
+        self.receiver = receiver
+        self.destination = destination
+
+    def datagram_received(self, data, addr):
+        self.receiver.packet_received(data, self.destination)
+
+    def error_received(self, exc):
+        self.receiver.errors += 1
+
+
+class MDPReceiver(object):
+    def __init__(self, handler, feeds, interface='0.0.0.0', rcvbuf=None, max_queue=0, batch_size=64,
+                 clock=received_time_us, loop=None, ring_slots=0, slot_size=2048):
+        """ feeds lists the (address, port) of the feeds, multicast groups are joined on interface.  A port
+        of 0 picks a free port (see destinations).  With ring_slots, the sockets are read in batches by
+        DatagramReaders (see readers). """
+        if ring_slots and max_queue > ring_slots:
+            raise ValueError('max_queue (%d) is larger than ring_slots (%d)' % (max_queue, ring_slots))
+        self.handler = handler
+        self.feeds = list(feeds)
+        self.interface = interface
+        self.rcvbuf = rcvbuf
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.clock = clock
+        self.loop = loop
+        self.ring_slots = ring_slots
+        self.slot_size = slot_size
+        self.destinations = []  # the (address, port) of the feeds, once started
+        self.transports = []
+        self.readers = []
+
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.packets_dropped = 0
+        self.errors = 0
+        self.max_queue_depth = 0
+        self._queue = deque()
+        self._queue_ready = None
+        self._consumer = None
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    async def start(self):
+        """ Open the sockets of the feeds and start receiving """
+        loop = self.loop or asyncio.get_event_loop()
+        self.loop = loop
+        try:
+            for address, port in self.feeds:
+                sock = feed_socket(address, port, self.interface, self.rcvbuf)
+                destination = (address, sock.getsockname()[1])
+                if self.ring_slots:
+                    reader = DatagramReader(sock, self.ring_slots, self.slot_size)
+                    self.readers.append(reader)
+                    loop.add_reader(sock.fileno(), self._read_ready, reader, destination)
+                else:
+                    transport, _ = await loop.create_datagram_endpoint(
+                        lambda: _FeedProtocol(self, destination), sock=sock)
+                    self.transports.append(transport)
+                self.destinations.append(destination)
+        except Exception:
+            self.close()
+            raise
+        if self.max_queue:
+            self._queue_ready = asyncio.Event()
+            self._consumer = loop.create_task(self._consume())
+
+    def packet_received(self, packet, destination):
+        self.packets_received += 1
+        self.bytes_received += len(packet)
+        if not self.max_queue:
+            self.handler(self.clock(), packet, destination)
+            return
+
+        queue = self._queue
+        if len(queue) >= self.max_queue:
+            self.packets_dropped += 1
+            return
+        queue.append((self.clock(), packet, destination))
+        if len(queue) > self.max_queue_depth:
+            self.max_queue_depth = len(queue)
+        self._queue_ready.set()
+
+    def _read_ready(self, reader, destination):
+        # read at most a ring of datagrams, so that a busy feed doesn't hold up the others
+        remaining = reader.slots
+        while remaining:
+            count = min(remaining, reader.slots - reader.position)
+            if self.max_queue:
+                # the queued packets of the feed are in the slots before position, don't read over them
+                count = min(count, self.max_queue - len(self._queue))
+                if not count:
+                    self._discard(reader, remaining)
+                    return
+            try:
+                packets = reader.read(count)
+            except OSError:
+                self.errors += 1
+                return
+            for packet in packets:
+                self.packet_received(packet, destination)
+            if len(packets) < count:
+                return
+            remaining -= count
+
+    def _discard(self, reader, max_packets):
+        try:
+            sizes = reader.discard(max_packets)
+        except OSError:
+            self.errors += 1
+            return
+        self.packets_received += len(sizes)
+        self.bytes_received += sum(sizes)
+        self.packets_dropped += len(sizes)
+
+    async def _consume(self):
+        queue = self._queue
+        handler = self.handler
+        batch_size = self.batch_size
+        while True:
+            await self._queue_ready.wait()
+            self._queue_ready.clear()
+            while queue:
+                for _ in range(min(batch_size, len(queue))):
+                    handler(*queue.popleft())
+                # let the event loop read the sockets before handling the next batch
+                await asyncio.sleep(0)
+
+    async def drain(self):
+        """ Wait until the queued packets have been handled """
+        while self._queue:
+            await asyncio.sleep(0)
+
+    def close(self):
+        """ Stop receiving, the packets still queued aren't handled """
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+        for reader in self.readers:
+            if self.loop is not None:
+                self.loop.remove_reader(reader.sock.fileno())
+            reader.sock.close()
+        self.readers = []
+        if self._consumer is not None:
+            self._consumer.cancel()
+            self._consumer = None
+        self._queue.clear()
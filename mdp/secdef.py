@@ -1,29 +1,250 @@
-import re
+"""
+Security definitions read from a CME secdef file: one FIX security definition per line, gzipped or not.
+
+SecDef.load() streams the file, optionally keeping only the definitions of some security ids.  Large files can
+be indexed instead: the index maps each security id to its symbol, market depth, tick size and the offset of
+its definition in the file.  It is built once, rebuilt when the secdef file changes, and memory mapped so that
+only the securities looked up are read:
+
+    secdef = SecDef()
+    secdef.load('secdef.dat.gz', index_filename='secdef.dat.gz.index')
+    symbol, depth = secdef.lookup_security_id(security_id)
+
+The same definitions are sent as MDInstrumentDefinition* messages on the instrument channels, SecDef can be built
+(and kept up to date) from those too, see SecDef.load_packets() and SecDef.handle_definition().
+"""
+
 import gzip
+import mmap
+import os
+import re
+import tempfile
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from struct import Struct
+
+SecurityDefinition = namedtuple('SecurityDefinition', 'symbol depth tick_size offset')
+
+security_id_regexp = re.compile(br'(?:^|\x01)48=(-?\d+)\x01')
+symbol_regexp = re.compile(br'(?:^|\x01)55=([^\x01\n]*)')
+depth_regexp = re.compile(br'1022=GBX\x01264=(\d+)')
+tick_size_regexp = re.compile(br'(?:^|\x01)969=([^\x01\n]*)')
+
+
+def open_secdef(secdef_filename):
+    with open(secdef_filename, 'rb') as secdef_file:
+        gzipped = secdef_file.read(2) == b'\x1f\x8b'
+    return gzip.open(secdef_filename, 'rb') if gzipped else open(secdef_filename, 'rb')
+
+
+def read_definitions(secdef_filename, security_ids=None):
+    """ Yield (security_id, SecurityDefinition) for the definitions of a secdef file, or only for security_ids
+
+    The depth (of the GBX market segment) and tick size are None if the definition doesn't have them, and the
+    offset is the position of the definition's line in the (uncompressed) file.
+    """
+    offset = 0
+    with open_secdef(secdef_filename) as secdef_file:
+        for line in secdef_file:
+            line_offset = offset
+            offset += len(line)
+            match = security_id_regexp.search(line)
+            if match is None:
+                continue
+            security_id = int(match.group(1))
+            if security_ids is not None and security_id not in security_ids:
+                continue  # skipped without looking at the rest of the definition
+            symbol = symbol_regexp.search(line)
+            if symbol is None:
+                continue
+            depth = depth_regexp.search(line)
+            tick_size = tick_size_regexp.search(line)
+            yield security_id, SecurityDefinition(symbol.group(1).decode('UTF-8'),
+                                                  int(depth.group(1)) if depth else None,
+                                                  float(tick_size.group(1)) if tick_size else None,
+                                                  line_offset)
+
+
+class SecDefIndex(object):
+    """ A memory mapped index of the definitions of a secdef file
+
+    The index holds a header (identifying the secdef file it was built from), the sorted security ids, a
+    record per security id and the symbols.  It is stored in the native byte order, so it is only meant to be
+    reused on the machine that built it.
+    """
+    magic = b'SECDEF01'
+    header = Struct('=8sQdI')  # magic, secdef file size, secdef file modification time, number of securities
+    record = Struct('=QIHid')  # definition offset, symbol offset, symbol length, depth (-1 if none), tick size
+    no_depth = -1
+
+    def __init__(self, index_filename):
+        self.index_filename = index_filename
+        with open(index_filename, 'rb') as index_file:
+            self._mmap = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.secdef_size, self.secdef_mtime, self.count = self.header.unpack_from(self._mmap, 0)
+        if magic != self.magic:
+            self._mmap.close()
+            raise ValueError('%s is not a secdef index' % index_filename)
+        ids_start = self.header.size
+        self.records_offset = ids_start + 4 * self.count
+        self.symbols_offset = self.records_offset + self.record.size * self.count
+        try:
+            self.security_ids = memoryview(self._mmap)[ids_start:self.records_offset].cast('i')
+        except AttributeError:  # python 2, read them into an array
+            self.security_ids = array('i', self._mmap[ids_start:self.records_offset])
+
+    @classmethod
+    def build(cls, secdef_filename, index_filename):
+        """ Index the definitions of a secdef file """
+        stat = os.stat(secdef_filename)
+        definitions = sorted(read_definitions(secdef_filename), key=lambda item: item[0])
+        security_ids = array('i', [security_id for security_id, _ in definitions])
+        symbols = bytearray()
+        records = bytearray()
+        for security_id, definition in definitions:
+            symbol = definition.symbol.encode('UTF-8')
+            records += cls.record.pack(definition.offset, len(symbols), len(symbol),
+                                       cls.no_depth if definition.depth is None else definition.depth,
+                                       float('nan') if definition.tick_size is None else definition.tick_size)
+            symbols += symbol
+
+        index_dir = os.path.dirname(os.path.abspath(index_filename))
+        # write to a temporary file first so concurrent readers never see a partial index
+        with tempfile.NamedTemporaryFile(dir=index_dir, delete=False) as index_file:
+            index_file.write(cls.header.pack(cls.magic, stat.st_size, stat.st_mtime, len(definitions)))
+            index_file.write(security_ids.tobytes() if hasattr(security_ids, 'tobytes') else security_ids.tostring())
+            index_file.write(records)
+            index_file.write(symbols)
+        os.rename(index_file.name, index_filename)
+
+    @classmethod
+    def open(cls, secdef_filename, index_filename):
+        """ Open the index of a secdef file, (re)building it first if it's missing or out of date """
+        if os.path.exists(index_filename):
+            try:
+                index = cls(index_filename)
+                if index.is_current(secdef_filename):
+                    return index
+                index.close()
+            except (ValueError, EnvironmentError):
+                pass  # unreadable index, rebuild it
+        cls.build(secdef_filename, index_filename)
+        return cls(index_filename)
+
+    def is_current(self, secdef_filename):
+        stat = os.stat(secdef_filename)
+        return stat.st_size == self.secdef_size and stat.st_mtime == self.secdef_mtime
+
+    def lookup(self, security_id):
+        """ Return the SecurityDefinition of a security id, or None """
+        i = bisect_left(self.security_ids, security_id)
+        if i == self.count or self.security_ids[i] != security_id:
+            return None
+        offset, symbol_offset, symbol_length, depth, tick_size = self.record.unpack_from(
+            self._mmap, self.records_offset + i * self.record.size)
+        symbol_offset += self.symbols_offset
+        return SecurityDefinition(self._mmap[symbol_offset:symbol_offset + symbol_length].decode('UTF-8'),
+                                  None if depth == self.no_depth else depth,
+                                  None if tick_size != tick_size else tick_size,
+                                  offset)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.security_ids)
+
+    def close(self):
+        if isinstance(self.security_ids, memoryview):
+            self.security_ids.release()  # the mmap can't be closed while it is exported
+        self._mmap.close()
 
 
 class SecDef(object):
+    # MDInstrumentDefinitionFuture, Spread and Option of MDP 3.0 schema version 8 and Future, Option, Spread,
+    # FixedIncome, Repo and FX of later versions
+    template_ids = frozenset([27, 29, 41, 54, 55, 56, 57, 58, 63])
+
     def __init__(self):
+        # security id -> SecurityDefinition, or (symbol, depth), of the definitions loaded (None once deleted)
         self.info = {}
+        self.index = None
+        self.secdef_filename = None
 
-    def load(self, secdef_filename):
-        tag_regexp = re.compile(r'(?:^|\x01)(48|55)=(.*?)(?=\x01)')
-        depth_regexp = re.compile(r'1022=GBX\x01264=(\d+)')
-        with gzip.open(secdef_filename, 'rb') as f:
-            for line in f:
-                line = line.decode('UTF-8')
-                matches = tag_regexp.findall(line)
-                if matches:
-                    tag = dict(matches)
-                    security_id = int(tag['48'])
-                    symbol = tag['55']
-                    # now we need the depth
-                    m = depth_regexp.search(line)
-                    depth = int(m.group(1))
-                    self.info[security_id] = (symbol, depth)
+    def load(self, secdef_filename, security_ids=None, index_filename=None):
+        """ Load the definitions of a secdef file, only those of security_ids if given
 
-    def lookup_security_id(self, security_id):
+        With an index_filename, the definitions are looked up in the (memory mapped) index of the secdef file
+        instead, which is built or rebuilt first if needed (see SecDefIndex).
+        """
+        self.secdef_filename = secdef_filename
+        if index_filename is not None:
+            self.index = SecDefIndex.open(secdef_filename, index_filename)
+            return
+        security_ids = frozenset(security_ids) if security_ids is not None else None
+        for security_id, definition in read_definitions(secdef_filename, security_ids):
+            self.info[security_id] = definition
+
+    def lookup(self, security_id):
+        """ Return the SecurityDefinition of a security id, or None """
         if security_id in self.info:
             return self.info[security_id]
-        return None
+        definition = None
+        if self.index is not None:
+            definition = self.index.lookup(security_id)
+            if definition is not None:
+                self.info[security_id] = definition
+        return definition
+
+    def lookup_security_id(self, security_id):
+        """ Return the (symbol, depth) of a security id, or None """
+        definition = self.lookup(security_id)
+        if definition is None:
+            return None
+        return definition[:2]
+
+    def definition_fields(self, security_id):
+        """ Return the (tag, value) fields of the definition of a security id read from the secdef file, or None
+
+        Definitions are found by their offset, so reading them from a gzipped file decompresses the file up to
+        the definition.
+        """
+        definition = self.lookup(security_id)
+        if definition is None or len(definition) < 4 or definition.offset is None:
+            return None  # not read from the secdef file
+        with open_secdef(self.secdef_filename) as secdef_file:
+            secdef_file.seek(definition.offset)
+            line = secdef_file.readline().decode('UTF-8')
+        return [tuple(field.split('=', 1)) for field in line.rstrip('\r\n').split('\x01') if '=' in field]
+
+    def handle_definition(self, message):
+        """ Add, update or delete a definition from a (decoded) MDInstrumentDefinition* message
+
+        The depth is the market depth of the GBX (book) feed of the instrument's no_md_feed_types.
+        """
+        security_id = message.security_id.value
+        update_action = getattr(message, 'security_update_action', None)
+        if update_action is not None and update_action.enumerant == 'Delete':
+            self.info[security_id] = None
+            return
+
+        depth = None
+        for feed_type in message.no_md_feed_types:
+            if feed_type.md_feed_type.value == 'GBX':
+                depth = feed_type.market_depth.value
+        min_price_increment = getattr(message, 'min_price_increment', None)
+        tick_size = min_price_increment.value if min_price_increment is not None else None
+        self.info[security_id] = SecurityDefinition(message.symbol.value, depth, tick_size, None)
+
+    def load_packets(self, mdp_parser, packets, offset=12):
+        """ Load the definitions of the instrument definition messages of MDP packets (e.g. the UDP payloads of a
+        capture of an instrument channel), the other messages are skipped """
+        for packet in packets:
+            for message in mdp_parser.parse(packet, offset=offset, template_ids=self.template_ids):
+                self.handle_definition(message)
 
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
@@ -1,3 +1,5 @@
-from .schema import SBESchema, MDPSchema
+__version__ = '0.1.8'
+
+from .schema import SBESchema, SBESchemaRegistry, MDPSchema
 from .message import SBEMessage, SBEMessageFactory, MDPMessageFactory
 from .parser import SBEParser
@@ -0,0 +1,559 @@
+"""
+Generate specialised python decoders for the message types of a schema.
+
+Each template becomes a class with __slots__ whose wrap() unpacks the root block with a literal Struct and
+converts the values in straight-line code (null values, strings, enums, sets and composites are inlined),
+and each repeating group gets its own decode function.  The generated source can be written to a module
+(see generator/sbe_class_generator.py --compiled) and loaded with SBESchema.load(), or compiled in
+process with SBESchema.parse(..., compiled=True).
+"""
+
+import keyword
+import math
+import re
+from datetime import datetime
+
+import six
+
+from sbedecoder.message import block_layout, field_end, make_record_type
+
+
+def _identifier(name):
+    name = re.sub(r'\W', '_', name)
+    if not name or name[0].isdigit() or keyword.iskeyword(name):
+        name = '_' + name
+    return name
+
+
+def _struct_size(block_struct):
+    return len(block_struct.unpack(b'\0' * block_struct.size))
+
+
+def _endian(block_struct):
+    if block_struct is None or block_struct.format[0] not in '@=<>!':
+        return '<'
+    return block_struct.format[0]
+
+
+def _enum_mapping(field):
+    is_char = field.unpack_fmt[-1] in 'cs'
+    mapping = {}
+    for enum_value in field.enum_values:
+        text = enum_value['text']
+        if is_char:
+            key = text.encode('UTF-8')
+        else:
+            try:
+                key = int(text)
+            except ValueError:
+                continue  # never matches an integer on the wire
+            if str(key) != text:
+                continue
+        mapping[key] = enum_value.get('description', '')
+    return mapping
+
+
+class _SourceWriter(object):
+    def __init__(self):
+        self.lines = []
+        self.constants = []
+        self._constant_names = {}
+
+    def constant(self, prefix, value_repr):
+        """ Return the name of a module level constant, shared by everything with the same value """
+        name = self._constant_names.get(value_repr)
+        if name is None:
+            name = '_%s_%d' % (prefix, len(self.constants))
+            self._constant_names[value_repr] = name
+            self.constants.append('%s = %s' % (name, value_repr))
+        return name
+
+    def struct(self, fmt):
+        return self.constant('S', "Struct(%r)" % (str(fmt),))
+
+    def emit(self, indent=0, line=''):
+        self.lines.append(('    ' * indent + line) if line else '')
+
+
+class _BlockWriter(object):
+    """ Writes the statements decoding the fields of one block (message root or group entry)
+
+    Each field's value is assigned to target_format % field name (e.g. 'self.%s').  Fields that aren't on the
+    wire (newer than the version, or past block_end, the expression of the end of the block on the wire) are
+    set to None behind a single check of the version and block length.
+    """
+    def __init__(self, writer, indent, target_format, fields, endian, buffer_name, offset_name, block_end=None,
+                 header_size=0):
+        self.writer = writer
+        self.indent = indent
+        self.target_format = target_format
+        self.fields = fields
+        block_struct, self.value_indices = block_layout(fields, endian)
+        self.block_struct = block_struct
+        self.buffer_name = buffer_name
+        self.offset_name = offset_name
+        self.unpack_targets = ['_'] * (_struct_size(block_struct) if block_struct is not None else 0)
+        self.statements = []
+        self.block_end = block_end if block_end is None or not block_end.isdigit() else None  # constant, always fits
+        self.header_size = header_size
+        self.optional_fields = []  # (target, since_version, end) of the fields that may not be on the wire
+
+    def raw_value(self, field, direct=False):
+        """ Return an expression holding the raw value of a (non constant) field """
+        value_index = self.value_indices.get(id(field))
+        if value_index is None:
+            local_name = '_f%d' % field.field_offset
+            self.statements.append('%s = %s.unpack_from(%s, %s + %d)[0]' % (
+                local_name, self.writer.struct(field.unpack_fmt), self.buffer_name, self.offset_name,
+                field.field_offset))
+            return local_name
+        if direct:
+            self.unpack_targets[value_index] = self.target_format % _identifier(field.name)
+            return None
+        local_name = '_v%d' % value_index
+        self.unpack_targets[value_index] = local_name
+        return local_name
+
+    def type_value(self, field, direct=True):
+        """ Return an expression for TypeMessageField.value, or None if it is unpacked straight into place """
+        if field.constant is not None:
+            constant = field.constant
+            if field.null_value and constant == field.null_value:
+                constant = None
+            return repr(constant)
+        if not field.null_value and not field.is_string_type:
+            return self.raw_value(field, direct=direct)
+        value = self.raw_value(field)
+        expression = value
+        if field.is_string_type:
+            expression = "%s.split(b'\\x00', 1)[0].decode('UTF-8')" % (value,)
+        if field.null_value:
+            expression = 'None if %s == %r else %s' % (value, field.null_value, expression)
+        return expression
+
+    def composite_value(self, field):
+        values = {}
+        nullable = set()
+        for part in field.parts:
+            expression = self.type_value(part, direct=False)
+            if part.null_value or part.is_string_type:
+                # keep converted part values in a local of their own
+                local_name = '_p%d' % part.field_offset
+                self.statements.append('%s = %s' % (local_name, expression))
+                expression = local_name
+            if part.null_value or expression == 'None':
+                nullable.add(part.name)
+            values[part.name] = expression
+
+        if not field.float_value:
+            return '{%s}' % ', '.join('%r: %s' % (part.name, values[part.name]) for part in field.parts)
+
+        mantissa = values.get('mantissa', 'None')
+        exponent = values.get('exponent', 'None')
+        if mantissa == 'None' or exponent == 'None':
+            return 'None'
+        null_checks = ['%s is None' % values[name] for name in ('mantissa', 'exponent') if name in nullable]
+        exponent_part = [p for p in field.parts if p.name == 'exponent'][0]
+        price_mode = getattr(field, 'price_mode', 'float')
+        if price_mode == 'decimal':
+            expression = 'Decimal(%s).scaleb(%s)' % (mantissa, exponent)
+        elif exponent_part.constant is not None:
+            if price_mode == 'fixed':
+                expression = mantissa
+            else:
+                expression = 'float(%s) * %r' % (mantissa, math.pow(10, int(exponent)))
+        else:
+            expression = 'float(%s) * math.pow(10, %s)' % (mantissa, exponent)
+        if null_checks:
+            expression = 'None if %s else %s' % (' or '.join(null_checks), expression)
+        return expression
+
+    def add_field(self, field):
+        target = self.target_format % _identifier(field.name)
+        field_type = type(field).__name__
+        if field_type == 'CompositeMessageField':
+            expression = self.composite_value(field)
+        elif field_type == 'EnumMessageField':
+            mapping = self.writer.constant('ENUM', repr(_enum_mapping(field)))
+            expression = '%s.get(%s)' % (mapping, self.raw_value(field))
+        elif field_type == 'SetMessageField':
+            values = self.writer.constant('SET', 'SetValues(%r)' % (field.values.choices,))
+            expression = '%s[%s]' % (values, self.raw_value(field))
+        else:
+            expression = self.type_value(field)
+        if expression is not None:
+            self.statements.append('%s = %s' % (target, expression))
+        end = field_end(field) if self.block_end is not None else 0
+        if field.since_version > 0 or end > self.header_size:
+            self.optional_fields.append((target, field.since_version, end))
+
+    def absent_statements(self):
+        """ Statements setting the fields that aren't on the wire to None, only run for older versions or
+        shorter blocks """
+        if not self.optional_fields:
+            return []
+        since_version = max(field[1] for field in self.optional_fields)
+        end = max(field[2] for field in self.optional_fields)
+        checks = []
+        if since_version > 0:
+            checks.append('0 < version < %d' % since_version)
+        if end > self.header_size:
+            checks.append('%s < %d' % (self.block_end, end))
+        statements = ['if %s:' % ' or '.join(checks)]
+        for target, field_since_version, field_end in self.optional_fields:
+            field_checks = []
+            if field_since_version > 0:
+                field_checks.append('0 < version < %d' % field_since_version)
+            if field_end > self.header_size:
+                field_checks.append('%s < %d' % (self.block_end, field_end))
+            statements.append('    if %s:' % ' or '.join(field_checks))
+            statements.append('        %s = None' % target)
+        return statements
+
+    def write(self, header_statements=()):
+        for field in self.fields:
+            self.add_field(field)
+
+        writer, indent = self.writer, self.indent
+        if self.block_struct is not None:
+            block_struct = writer.struct(self.block_struct.format)
+            targets = ', '.join(self.unpack_targets)
+            if len(self.unpack_targets) == 1:
+                targets += ','
+            writer.emit(indent, 'try:')
+            writer.emit(indent + 1, '(%s) = %s.unpack_from(%s, %s)' % (
+                targets, block_struct, self.buffer_name, self.offset_name))
+            writer.emit(indent, 'except StructError:')
+            writer.emit(indent + 1, '(%s) = %s.unpack_from(*block_buffer(%s, %s, %s.size))' % (
+                targets, block_struct, self.buffer_name, self.offset_name, block_struct))
+        for statement in header_statements:
+            writer.emit(indent, statement)
+        for statement in self.statements + self.absent_statements():
+            writer.emit(indent, statement)
+
+
+def _write_dimension(writer, group):
+    """ Write the statements reading the group's dimension (block_length and num_in_group) at offset """
+    block_length_field = group.block_length_field
+    num_in_group_field = group.num_in_group_field
+    dimension_fmt = block_length_field.unpack_fmt[0]
+    if num_in_group_field.field_offset < block_length_field.field_offset:
+        raise ValueError('unsupported dimension type for repeating group %s' % group.name)
+    dimension_fmt += block_length_field.unpack_fmt.lstrip('@=<>!')
+    padding = num_in_group_field.field_offset - block_length_field.field_offset - block_length_field.field_length
+    if padding:
+        dimension_fmt += '%dx' % padding
+    dimension_fmt += num_in_group_field.unpack_fmt.lstrip('@=<>!')
+    dimension_struct = writer.struct(dimension_fmt)
+
+    dimension_offset = ' + %d' % block_length_field.field_offset if block_length_field.field_offset else ''
+    writer.emit(1, 'block_length, num_in_group = %s.unpack_from(msg_buffer, offset%s)' % (
+        dimension_struct, dimension_offset))
+    writer.emit(1, 'offset += %d' % group.dimension_size)
+
+
+def _write_group(writer, class_name, group, decoders):
+    entry_class = '%s_%s' % (class_name, _identifier(group.original_name or group.name))
+    function_name = '_decode_%s' % entry_class
+    for nested_group in group.groups:
+        _write_group(writer, entry_class, nested_group, decoders)
+
+    slots = [_identifier(f.name) for f in group.fields] + [_identifier(g.name) for g in group.groups] + \
+        [_identifier(d.name) for d in group.data_fields]
+    writer.emit(0, 'class %s(CompiledGroupEntry):' % entry_class)
+    writer.emit(1, '__slots__ = %r' % (tuple(slots),))
+    writer.emit()
+    writer.emit()
+
+    writer.emit(0, 'def %s(msg_buffer, offset, version):' % function_name)
+    _write_dimension(writer, group)
+    writer.emit(1, 'entries = []')
+    writer.emit(1, 'for _ in range(num_in_group):')
+    writer.emit(2, 'entry = %s()' % entry_class)
+    _BlockWriter(writer, 2, 'entry.%s', group.fields, _endian(group.block_struct), 'msg_buffer', 'offset',
+                 block_end='block_length').write()
+    writer.emit(2, 'offset += block_length')
+    _write_groups(writer, 2, 'entry', group.groups, decoders)
+    _write_data(writer, 2, 'entry', group.data_fields)
+    writer.emit(2, 'entries.append(entry)')
+    writer.emit(1, 'return tuple(entries), offset')
+    writer.emit()
+    writer.emit()
+    decoders[id(group)] = function_name
+
+
+def _write_groups(writer, indent, target, groups, decoders):
+    for group in groups:
+        call = '%s.%s, offset = %s(msg_buffer, offset, version)' % (target, _identifier(group.name),
+                                                                   decoders[id(group)])
+        if group.since_version > 0:
+            writer.emit(indent, 'if version >= %d:' % group.since_version)
+            writer.emit(indent + 1, call)
+            writer.emit(indent, 'else:')
+            writer.emit(indent + 1, '%s.%s = ()' % (target, _identifier(group.name)))
+        else:
+            writer.emit(indent, call)
+
+
+def _write_data(writer, indent, target, data_fields):
+    """ Write the statements copying the var data payloads at offset, moving offset past them """
+    for data_field in data_fields:
+        statements = [
+            'length = %s.unpack_from(msg_buffer, offset)[0]' % writer.struct(data_field.unpack_fmt),
+            '%s.%s = bytes(msg_buffer[offset + %d:offset + %d + length])' % (
+                target, _identifier(data_field.name), data_field.data_offset, data_field.data_offset),
+            'offset += %d + length' % data_field.data_offset]
+        if data_field.since_version > 0:
+            writer.emit(indent, 'if version >= %d:' % data_field.since_version)
+            for statement in statements:
+                writer.emit(indent + 1, statement)
+            writer.emit(indent, 'else:')
+            writer.emit(indent + 1, '%s.%s = None' % (target, _identifier(data_field.name)))
+        else:
+            for statement in statements:
+                writer.emit(indent, statement)
+
+
+def _write_skip_data(writer, indent, data_fields):
+    """ Write the statements moving offset past var data, reading only their lengths """
+    for data_field in data_fields:
+        statement = 'offset += %d + %s.unpack_from(msg_buffer, offset)[0]' % (
+            data_field.data_offset, writer.struct(data_field.unpack_fmt))
+        if data_field.since_version > 0:
+            writer.emit(indent, 'if version >= %d:' % data_field.since_version)
+            writer.emit(indent + 1, statement)
+        else:
+            writer.emit(indent, statement)
+
+
+def _header_statements(message_type, target_format):
+    """ Return the statements setting version (and block_end, the end of the block on the wire) from the
+    decoded header fields, and the expression of the end of the block """
+    names = set(f.name for f in message_type.fields)
+    statements = ['version = %s' % (target_format % 'version') if 'version' in names else 'version = 0']
+    if 'block_length' not in names:
+        return statements, '%d' % (message_type.header_size + message_type.schema_block_length)
+    statements.append('block_end = %d + %s' % (message_type.header_size, target_format % 'block_length'))
+    return statements, 'block_end'
+
+
+def _write_message(writer, message_type):
+    class_name = _identifier(message_type.__name__)
+    decoders = {}
+    for group in message_type.groups:
+        _write_group(writer, class_name, group, decoders)
+
+    slots = [_identifier(f.name) for f in message_type.fields] + [_identifier(g.name) for g in message_type.groups] + \
+        [_identifier(d.name) for d in message_type.data_fields]
+    writer.emit(0, 'class %s(CompiledMessage):' % class_name)
+    writer.emit(1, '__slots__ = %r' % (tuple(slots),))
+    writer.emit(1, 'message_id = %d' % message_type.message_id)
+    writer.emit(1, 'schema_block_length = %d' % message_type.schema_block_length)
+    writer.emit(1, 'header_size = %d' % message_type.header_size)
+    writer.emit()
+    writer.emit(1, 'def wrap(self, msg_buffer, msg_offset):')
+    header_statements, block_end = _header_statements(message_type, 'self.%s')
+    block = _BlockWriter(writer, 2, 'self.%s', message_type.fields, _endian(message_type.block_struct),
+                         'msg_buffer', 'msg_offset', block_end=block_end, header_size=message_type.header_size)
+    block.write(header_statements)
+    if message_type.groups or message_type.data_fields:
+        # groups follow the block of the length on the wire
+        writer.emit(2, 'offset = msg_offset + %s' % block_end)
+        _write_groups(writer, 2, 'self', message_type.groups, decoders)
+        _write_data(writer, 2, 'self', message_type.data_fields)
+        writer.emit(2, 'self.encoded_length = offset - msg_offset')
+    else:
+        writer.emit(2, 'self.encoded_length = %s' % block_end)
+    writer.emit()
+    writer.emit()
+    return class_name
+
+
+_module_imports = ['import math',
+                   'from decimal import Decimal',
+                   'from struct import Struct, error as StructError',
+                   'from sbedecoder.compiled import CompiledMessage, CompiledGroupEntry, block_buffer',
+                   'from sbedecoder.message import SetValues']
+
+
+def generate_source(schema, generation_date=None):
+    """ Return the python source of a module defining a compiled message class per template of schema """
+    writer = _SourceWriter()
+    class_names = []
+    for message_id in sorted(schema.message_map.keys()):
+        class_names.append(_write_message(writer, schema.message_map[message_id]))
+
+    header = []
+    if generation_date is not None:
+        header.append('# Generated @ %s' % (generation_date,))
+    header += ["'''", '', ' Generated SBE Message Decoders ', '', "'''", ''] + _module_imports + ['']
+    footer = ['__messages__ = [', ] + ['    %s,' % name for name in class_names] + [']']
+    return '\n'.join(header + writer.constants + ['', ''] + writer.lines + footer) + '\n'
+
+
+def compile_messages(schema):
+    """ Generate and compile the decoders of schema in process, returning the compiled message classes """
+    source = generate_source(schema, generation_date=datetime.now())
+    namespace = {'__name__': 'sbedecoder.compiled_schema'}
+    six.exec_(compile(source, '<compiled sbe schema>', 'exec'), namespace)
+    return namespace['__messages__']
+
+
+def _select_fields(entity, names):
+    fields = dict((f.name, f) for f in entity.fields)
+    unknown = [name for name in names if name not in fields]
+    if unknown:
+        entity_name = getattr(entity, 'name', None) or entity.__name__
+        raise ValueError('unknown field(s) in %s: %s' % (entity_name, ', '.join(unknown)))
+    return [fields[name] for name in names]
+
+
+class _ProjectionWriter(object):
+    """ Writes the functions decoding a projection of a message type """
+    def __init__(self, writer, groups, named):
+        self.writer = writer
+        self.groups = groups
+        self.named = named
+        self.functions = 0
+        self.record_types = {}
+
+    def function_name(self, prefix):
+        self.functions += 1
+        return '_%s_%d' % (prefix, self.functions)
+
+    def body_writer(self):
+        """ A writer for the body of a function, sharing the module constants """
+        body = _SourceWriter()
+        body.constants, body._constant_names = self.writer.constants, self.writer._constant_names
+        return body
+
+    def result(self, name, names):
+        values = ', '.join('f_%s' % _identifier(n) for n in names)
+        values = '(%s,)' % values if len(names) == 1 else '(%s)' % values
+        if not self.named:
+            return values
+        record_type = '_T_%d' % len(self.record_types)
+        self.record_types[record_type] = make_record_type(name, names)
+        return 'tuple_new(%s, %s)' % (record_type, values)
+
+    def write_groups(self, body, indent, groups, path, last_needed=None):
+        """ Decode (or skip over) groups up to the last one needed, returning the names of the projected ones """
+        projected = []
+        for group in groups[:last_needed]:
+            group_path = path + group.name
+            if group_path in self.groups:
+                call = 'f_%s, offset = %s(msg_buffer, offset, version)' % (
+                    _identifier(group.name), self.write_group(group, group_path))
+                projected.append(group.name)
+            else:
+                call = 'offset = %s(msg_buffer, offset, version)' % self.write_skip(group)
+            if group.since_version > 0:
+                body.emit(indent, 'if version >= %d:' % group.since_version)
+                body.emit(indent + 1, call)
+                if group_path in self.groups:
+                    body.emit(indent, 'else:')
+                    body.emit(indent + 1, 'f_%s = ()' % _identifier(group.name))
+            else:
+                body.emit(indent, call)
+        return projected
+
+    def write_skip(self, group):
+        body = self.body_writer()
+        if not group.groups and not group.data_fields:
+            body.emit(1, 'return offset + block_length * num_in_group')
+        else:
+            body.emit(1, 'for _ in range(num_in_group):')
+            body.emit(2, 'offset += block_length')
+            for nested_group in group.groups:
+                call = 'offset = %s(msg_buffer, offset, version)' % self.write_skip(nested_group)
+                if nested_group.since_version > 0:
+                    body.emit(2, 'if version >= %d:' % nested_group.since_version)
+                    body.emit(3, call)
+                else:
+                    body.emit(2, call)
+            _write_skip_data(body, 2, group.data_fields)
+            body.emit(1, 'return offset')
+        return self.write_function('skip', group, body)
+
+    def write_group(self, group, path):
+        fields = _select_fields(group, self.groups[path])
+        body = self.body_writer()
+        body.emit(1, 'entries = []')
+        body.emit(1, 'for _ in range(num_in_group):')
+        _BlockWriter(body, 2, 'f_%s', fields, _endian(group.block_struct), 'msg_buffer', 'offset',
+                     block_end='block_length').write()
+        body.emit(2, 'offset += block_length')
+        projected = self.write_groups(body, 2, group.groups, path + '.')
+        _write_skip_data(body, 2, group.data_fields)
+        names = [f.name for f in fields] + projected
+        body.emit(2, 'entries.append(%s)' % self.result(group.original_name or group.name, names))
+        body.emit(1, 'return tuple(entries), offset')
+        return self.write_function('project', group, body)
+
+    def write_function(self, prefix, group, body):
+        # nested functions have already been written, so they are defined before this one
+        writer = self.writer
+        function_name = self.function_name(prefix)
+        writer.emit(0, 'def %s(msg_buffer, offset, version):' % function_name)
+        _write_dimension(writer, group)
+        writer.lines.extend(body.lines)
+        writer.emit()
+        writer.emit()
+        return function_name
+
+    def write_message(self, message_type, root):
+        fields = _select_fields(message_type, root)
+        header_fields = [f for f in message_type.fields if f.name in ('version', 'block_length')]
+        block_fields = fields + [f for f in header_fields if f not in fields]
+
+        body = self.body_writer()
+        header_statements, block_end = _header_statements(message_type, 'f_%s')
+        _BlockWriter(body, 1, 'f_%s', block_fields, _endian(message_type.block_struct), 'msg_buffer', 'msg_offset',
+                     block_end=block_end, header_size=message_type.header_size).write(header_statements)
+        needed = [i + 1 for i, g in enumerate(message_type.groups)
+                  if any(path == g.name or path.startswith(g.name + '.') for path in self.groups)]
+        projected = []
+        if needed:
+            body.emit(1, 'offset = msg_offset + %s' % block_end)
+            projected = self.write_groups(body, 1, message_type.groups, '', max(needed))
+        body.emit(1, 'return %s' % self.result(message_type.__name__, root + projected))
+
+        self.writer.emit(0, 'def decode(msg_buffer, msg_offset):')
+        self.writer.lines.extend(body.lines)
+
+
+def compile_projection(message_type, root=(), groups=None, named=True):
+    """ Generate and compile a function decoding only the given fields of a (dynamic) message type
+
+    root lists the names of the message fields to decode and groups maps repeating group names (nested
+    groups are named 'outer.inner') to the names of their fields to decode.  The returned function
+    decode(msg_buffer, msg_offset) returns a namedtuple (or a plain tuple if named is False) of the root
+    field values in the given order, followed by a tuple of entries for each projected group.
+    """
+    groups = dict(groups or {})
+    for path in list(groups):
+        # decoding a nested group requires decoding the entries of the groups enclosing it
+        parts = path.split('.')
+        for i in range(1, len(parts)):
+            groups.setdefault('.'.join(parts[:i]), [])
+
+    known_groups = set()
+
+    def collect_groups(entity, path):
+        for group in entity.groups:
+            known_groups.add(path + group.name)
+            collect_groups(group, path + group.name + '.')
+    collect_groups(message_type, '')
+    unknown = sorted(set(groups) - known_groups)
+    if unknown:
+        raise ValueError('unknown repeating group(s) in %s: %s' % (message_type.__name__, ', '.join(unknown)))
+
+    writer = _SourceWriter()
+    projection = _ProjectionWriter(writer, groups, named)
+    projection.write_message(message_type, list(root))
+
+    source = '\n'.join(_module_imports + writer.constants + ['', ''] + writer.lines) + '\n'
+    namespace = {'__name__': 'sbedecoder.projection', 'tuple_new': tuple.__new__}
+    namespace.update(projection.record_types)
+    six.exec_(compile(source, '<%s projection>' % message_type.__name__, 'exec'), namespace)
+    return namespace['decode']
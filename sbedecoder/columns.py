@@ -0,0 +1,186 @@
+"""
+Columnar decoding of many messages into NumPy structured arrays.
+
+numpy is an optional dependency, it is only needed by SBEParser.parse_to_columns().
+"""
+
+from struct import Struct
+
+import numpy
+import six
+
+
+def numpy_format(unpack_fmt, endian='<'):
+    """ Convert a (single field) struct format into a numpy dtype format """
+    code = unpack_fmt.lstrip('@=<>!')
+    count, type_code = code[:-1], code[-1]
+    if type_code == 's':
+        return 'S' + (count or '1')
+    base_format = 'S1' if type_code == 'c' else endian + type_code
+    if count and int(count) > 1:
+        return base_format, (int(count),)
+    return base_format
+
+
+def block_dtype(fields, block_struct):
+    """ Build a dtype matching a block decoded by block_struct (i.e. covering all the fields with a value_index) """
+    endian = block_struct.format[0] if block_struct.format[0] in '@=<>!' else '<'
+    names = []
+    formats = []
+    offsets = []
+    for field, part in value_parts(fields):
+        names.append(field.name if part is field else '%s_%s' % (field.name, part.name))
+        formats.append(numpy_format(part.unpack_fmt, endian))
+        offsets.append(part.field_offset)
+    return numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                        'itemsize': block_struct.size})
+
+
+def value_parts(fields):
+    """ Yield the (field, part) of the values stored on the wire, part is the field itself unless composite """
+    for field in fields:
+        parts = getattr(field, 'parts', None)
+        for part in parts if parts is not None else [field]:
+            if getattr(part, 'value_index', None) is not None:
+                yield field, part
+
+
+def null_block(fields, block_struct):
+    """ Return a block holding the null value of the fields which have one, zeros elsewhere """
+    endian = block_struct.format[0] if block_struct.format[0] in '@=<>!' else '<'
+    block = bytearray(block_struct.size)
+    for field, part in value_parts(fields):
+        null_value = getattr(part, 'null_value', None)
+        if isinstance(null_value, six.integer_types):
+            Struct(endian + part.unpack_fmt.lstrip('@=<>!')).pack_into(block, part.field_offset, null_value)
+    return bytes(block)
+
+
+class BlockTable(object):
+    """ Accumulates fixed blocks (of one message type or repeating group) and builds a structured array
+
+    Blocks are laid out by the schema, the fields that aren't on the wire (see VersionLayout), e.g. past the end
+    of the shorter block of an older version, get their null value (or zeros if they have none).
+    """
+    def __init__(self, fields, block_struct, index_columns=()):
+        if block_struct is None:
+            block_struct = Struct('<')  # nothing stored on the wire (e.g. only constant fields)
+        self.fields = fields
+        self.dtype = block_dtype(fields, block_struct)
+        self.block_size = block_struct.size
+        self.null_block = null_block(fields, block_struct)
+        self.index_columns = index_columns
+        self.blocks = []
+        self.indices = [[] for _ in index_columns]
+        self._absent = {}  # VersionLayout -> [(start, end)] of the values missing from its blocks
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def _absent_ranges(self, layout):
+        absent_fields = set(field.name for field, present in zip(self.fields, layout.present) if not present)
+        ranges = []
+        for field, part in value_parts(self.fields):
+            if field.name in absent_fields:
+                start = part.field_offset
+                ranges.append((start, start + Struct('<' + part.unpack_fmt.lstrip('@=<>!')).size))
+        if layout.block_end < self.block_size:
+            ranges.append((layout.block_end, self.block_size))
+        return ranges
+
+    def add(self, msg_buffer, offset, layout, *indices):
+        absent = self._absent.get(layout)
+        if absent is None:
+            absent = self._absent[layout] = self._absent_ranges(layout)
+        # a copy, the buffer may be a view of a capture or of a receive buffer which is reused
+        block = bytearray(msg_buffer[offset:offset + self.block_size])
+        if absent or len(block) < self.block_size:
+            # null the values that aren't on the wire, e.g. the bytes past a shorter block are the next entry's
+            null = self.null_block
+            block += null[len(block):]
+            for start, end in absent:
+                block[start:end] = null[start:end]
+        self.blocks.append(block)
+        for index_values, index in zip(self.indices, indices):
+            index_values.append(index)
+
+    def build(self):
+        blocks = numpy.frombuffer(bytearray().join(self.blocks), dtype=self.dtype)
+        if not self.index_columns:
+            return blocks
+        table_dtype = numpy.dtype([(name, '<i8') for name in self.index_columns] +
+                                  [(name, self.dtype.fields[name][0]) for name in self.dtype.names])
+        table = numpy.empty(len(blocks), dtype=table_dtype)
+        for name, index_values in zip(self.index_columns, self.indices):
+            table[name] = index_values
+        for name in self.dtype.names:
+            table[name] = blocks[name]
+        return table
+
+
+class MessageColumns(object):
+    """ Columns decoded for a single template
+
+    messages holds one row per message. groups maps each repeating group name (nested groups are named
+    'outer.inner') to a table with one row per group entry, keyed by the 'message_index' of the row in
+    messages (and for nested groups the 'parent_index' of the row in the enclosing group's table).
+
+    Values are the raw wire values: null values, enums, sets and composite exponents are not applied.
+    """
+    def __init__(self, message_type, messages, groups):
+        self.message_type = message_type
+        self.messages = messages
+        self.groups = groups
+
+
+class ColumnBuilder(object):
+    def __init__(self, message):
+        self.message_type = type(message)
+        self.messages = BlockTable(message.fields, message.block_struct)
+        self.group_tables = {}
+
+    def _group_table(self, path, container, nested):
+        table = self.group_tables.get(path)
+        if table is None:
+            index_columns = ('message_index', 'parent_index') if nested else ('message_index',)
+            table = BlockTable(container.fields, container.block_struct, index_columns)
+            self.group_tables[path] = table
+        return table
+
+    def _add_group(self, message, container, path, message_index, parent_index=None):
+        table = self._group_table(path, container, parent_index is not None)
+        layout = container.layout
+        for index in range(container.num_groups):
+            entry_index = len(table)
+            table.add(message.msg_buffer, message.msg_offset + container.entry_offset(index), layout,
+                      message_index, parent_index)
+            if layout.groups:
+                container[index]  # position the nested groups on this entry
+                for nested_group in layout.groups:
+                    self._add_group(message, nested_group, path + '.' + nested_group.name,
+                                    message_index, entry_index)
+
+    def add(self, message):
+        message_index = len(self.messages)
+        self.messages.add(message.msg_buffer, message.msg_offset, message.layout)
+        for group in message.layout.groups:
+            self._add_group(message, group, group.name, message_index)
+
+    def build(self):
+        groups = dict((path, table.build()) for path, table in self.group_tables.items())
+        return MessageColumns(self.message_type, self.messages.build(), groups)
+
+
+def parse_to_columns(parser, buffers, offset=0, template_ids=None):
+    if parser.compiled:
+        raise ValueError('columns require the message types of a parsed (not compiled) schema')
+    builders = {}
+    for msg_buffer in buffers:
+        for message in parser.parse(msg_buffer, offset, template_ids):
+            template_id = message.message_id
+            builder = builders.get(template_id)
+            if builder is None:
+                builder = ColumnBuilder(message)
+                builders[template_id] = builder
+            builder.add(message)
+    return dict((template_id, builder.build()) for template_id, builder in builders.items())
@@ -0,0 +1,41 @@
+"""
+Runtime support for compiled (generated) message decoders, see sbedecoder.codegen.
+
+Compiled messages decode all of their values (and repeating groups) when wrapped, so, like records
+returned by SBEMessage.to_record(), they own their values and can be stored.
+"""
+
+
+class CompiledGroupEntry(object):
+    __slots__ = ()
+    name = None
+    original_name = None
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.__slots__))
+
+
+class CompiledMessage(CompiledGroupEntry):
+    # the generated classes define wrap(msg_buffer, msg_offset), which decodes a message in place
+    __slots__ = ('encoded_length',)
+    message_id = None
+    schema_block_length = None
+    header_size = None
+    compiled = True  # fields are plain values, not field objects
+
+    def to_record(self):
+        # compiled messages already own their values
+        return self
+
+    def __str__(self):
+        return '%s' % (self.__class__.__name__,)
+
+
+def block_buffer(msg_buffer, offset, size):
+    """ Return a (buffer, offset) pair with at least size bytes available at offset """
+    if offset + size <= len(msg_buffer):
+        return msg_buffer, offset
+    # truncated block (e.g. an older version at the end of the buffer), missing bytes decode as zeros
+    block = bytes(msg_buffer[offset:offset + size])
+    return block + b'\0' * (size - len(block)), 0
@@ -0,0 +1,442 @@
+"""
+Encode messages with the block layouts of a parsed schema, e.g. to generate synthetic feeds.
+
+Values are given in the form decoding returns them: numbers, strings, prices as floats (or Decimals, or
+mantissas with price_mode='fixed'), enums by description, enumerant name or integer code, and sets as a list
+of choice names (or the raw integer).  Fields that aren't given are encoded as their null value, or zero.
+Var data is given as bytes (or text, encoded with the field's character encoding) and is empty by default.
+SBESchema.encode() and encode_into() use a MessageEncoder per template, and MDPPacketBuilder frames the
+messages into MDP packets.
+"""
+
+from decimal import Decimal
+from struct import Struct
+
+import six
+
+from sbedecoder.message import block_layout
+
+
+def _endian(block_struct):
+    if block_struct is None or block_struct.format[0] not in '@=<>!':
+        return '<'
+    return block_struct.format[0]
+
+
+def _value_count(field, endian):
+    field_struct = Struct(endian + field.unpack_fmt.lstrip('@=<>!'))
+    return len(field_struct.unpack(b'\0' * field_struct.size))
+
+
+def _text(value):
+    return value.encode('UTF-8') if isinstance(value, six.text_type) else value
+
+
+def _decimal(value):
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, six.integer_types):
+        return Decimal(value)
+    return Decimal(repr(value))  # the shortest decimal that rounds to the float
+
+
+def _type_converter(field):
+    """ Return a function converting a value of a TypeMessageField to its wire value """
+    type_code = field.unpack_fmt[-1]
+    if type_code == 's':
+        return lambda value: b'' if value is None else _text(value)  # struct pads strings with nulls
+    if type_code == 'c':
+        def convert(value):
+            if value is None:
+                return b'\0'
+            if isinstance(value, six.integer_types):
+                return six.int2byte(value)
+            return _text(value)
+        return convert
+    null_value = field.null_value if field.null_value is not None else 0
+    return lambda value: null_value if value is None else value
+
+
+def _enum_converter(field):
+    # accept the wire text, the description or the name of an enumerant (names win over clashing descriptions)
+    codes = {}
+    for enum_value in field.enum_values:
+        if enum_value['name'] in field.codes:
+            codes[enum_value['text']] = field.codes[enum_value['name']]
+    codes.update((description, code) for code, description in field.code_to_enum_description.items())
+    codes.update(field.codes)
+    is_char = field.is_char
+
+    def convert(value):
+        if value is None:
+            code = 0
+        elif isinstance(value, six.integer_types):
+            code = value  # a code, or a member of field.enum_type()
+        elif is_char and isinstance(value, bytes) and len(value) == 1 and value not in codes:
+            return value
+        else:
+            try:
+                code = codes[value]
+            except KeyError:
+                raise ValueError('unknown value %r of enum %s' % (value, field.name))
+        return six.int2byte(code) if is_char else code
+    return convert
+
+
+def _set_converter(field):
+    masks = field.masks
+
+    def convert(value):
+        if value is None:
+            return 0
+        if isinstance(value, six.integer_types):
+            return value
+        if isinstance(value, six.string_types):
+            value = [choice.strip() for choice in value.split(',') if choice.strip()]  # as rendered by value
+        raw_value = 0
+        for choice in value:
+            try:
+                raw_value |= masks[choice]
+            except KeyError:
+                raise ValueError('unknown choice %r of set %s' % (choice, field.name))
+        return raw_value
+    return convert
+
+
+def _slot_setter(field, endian, convert):
+    """ Return a function storing the converted value of a field in its slot(s) of the block's values """
+    index = field.value_index
+    count = _value_count(field, endian)
+    if count == 1:
+        def set_value(values, value):
+            values[index] = convert(value)
+    else:
+        def set_value(values, value):
+            values[index:index + count] = [convert(None)] * count if value is None else [convert(v) for v in value]
+    return set_value
+
+
+def _composite_setter(field, endian):
+    part_setters = {}
+    for part in field.parts:
+        # constant parts (e.g. the exponent of most prices) aren't stored
+        stored = part.constant is None and part.value_index is not None
+        part_setters[part.name] = _slot_setter(part, endian, _type_converter(part)) if stored else None
+
+    def set_parts(values, parts):
+        for name, part_value in parts.items():
+            try:
+                part_setter = part_setters[name]
+            except KeyError:
+                raise ValueError('composite %s has no part %r' % (field.name, name))
+            if part_setter is not None:
+                part_setter(values, part_value)
+
+    if not field.float_value:
+        def set_value(values, value):
+            set_parts(values, value if value is not None else dict.fromkeys(part_setters))
+        return set_value
+
+    set_mantissa = part_setters['mantissa']
+    if field.price_exponent is not None:
+        exponent = field.price_exponent
+        scale = 10 ** -exponent if exponent <= 0 else None
+        fixed = field.price_mode == 'fixed'
+
+        def set_value(values, value):
+            if isinstance(value, dict):
+                set_parts(values, value)
+            elif value is None or fixed and isinstance(value, six.integer_types):
+                set_mantissa(values, value)  # already scaled by 10 ** price_exponent
+            elif scale is None or isinstance(value, Decimal):
+                set_mantissa(values, int(_decimal(value).scaleb(-exponent)))
+            else:
+                set_mantissa(values, int(round(value * scale)))
+        return set_value
+
+    set_exponent = part_setters.get('exponent')
+
+    def set_value(values, value):
+        if value is None:
+            set_mantissa(values, None)
+        elif isinstance(value, dict):
+            set_parts(values, value)
+        else:
+            # the exponent is stored with the mantissa, use the shortest exact one
+            value = _decimal(value)
+            exponent = value.as_tuple().exponent
+            set_mantissa(values, int(value.scaleb(-exponent)))
+            if set_exponent is not None:
+                set_exponent(values, exponent)
+    return set_value
+
+
+def _field_setter(field, endian):
+    """ Return (index, convert) where values[index] = convert(value) stores the value of a field, convert is
+    None if the value is stored as is.  Fields that don't fit a single slot have no index and are stored by
+    convert(values, value). """
+    if getattr(field, 'parts', None) is not None:
+        return None, _composite_setter(field, endian)
+    if getattr(field, 'constant', None) is not None or field.value_index is None:
+        return None, None  # constants aren't stored, fields overlapping another one are encoded through it
+    if hasattr(field, 'enum_values'):
+        convert = _enum_converter(field)
+    elif hasattr(field, 'masks'):
+        convert = _set_converter(field)
+    elif field.unpack_fmt[-1] not in 'sc' and _value_count(field, endian) == 1:
+        return field.value_index, None  # a number, None leaves the default (null) value
+    else:
+        convert = _type_converter(field)
+    if _value_count(field, endian) > 1:
+        return None, _slot_setter(field, endian, convert)
+    return field.value_index, convert
+
+
+class BlockEncoder(object):
+    """ Packs the fields of a fixed-length block (a message's header and root block, or a group entry) """
+    def __init__(self, name, fields, block_struct, block_length, other_names=()):
+        self.name = name
+        self.block_struct = block_struct
+        self.block_length = block_length
+        endian = _endian(block_struct)
+        self.setters = dict((field.name, _field_setter(field, endian)) for field in fields)
+        # the nested groups and var data given with the fields, see GroupEncoder and DataEncoder
+        self.setters.update((other_name, (None, None)) for other_name in other_names)
+
+        struct_size = 0
+        self.defaults = []
+        if block_struct is not None:
+            struct_size = block_struct.size
+            self.defaults = list(block_struct.unpack(b'\0' * struct_size))
+            for field in fields:
+                # numbers are stored as is and default to their null value
+                if getattr(field, 'null_value', None) is not None and \
+                        self.setters[field.name] == (field.value_index, None):
+                    self.defaults[field.value_index] = field.null_value
+            for index, convert in self.setters.values():
+                if index is not None:
+                    if convert is not None:
+                        self.defaults[index] = convert(None)
+                elif convert is not None:
+                    convert(self.defaults, None)
+        self.padding_offset = struct_size
+        self.padding = b'\0' * max(block_length - struct_size, 0)
+
+    def values(self, fields):
+        """ Return the values packed by block_struct for a dict of field values """
+        values = self.defaults[:]
+        if fields:
+            setters = self.setters
+            for name, value in fields.items():
+                try:
+                    index, convert = setters[name]
+                except KeyError:
+                    raise ValueError('%s has no field %r' % (self.name, name))
+                if index is None:
+                    if convert is not None:
+                        convert(values, value)
+                elif convert is not None:
+                    values[index] = convert(value)
+                elif value is not None:
+                    values[index] = value
+        return values
+
+    def pack_into(self, msg_buffer, offset, values):
+        if self.block_struct is not None:
+            self.block_struct.pack_into(msg_buffer, offset, *values)
+        if self.padding:
+            start = offset + self.padding_offset
+            msg_buffer[start:start + len(self.padding)] = self.padding
+
+
+class DataEncoder(object):
+    """ Encodes a var data field: its length followed by the payload """
+    def __init__(self, data_field):
+        self.name = data_field.name
+        self.length_struct = Struct(data_field.unpack_fmt)
+        self.data_offset = data_field.data_offset
+        self.character_encoding = data_field.character_encoding or 'UTF-8'
+
+    def payload(self, value):
+        if value is None:
+            return b''
+        if isinstance(value, six.text_type):
+            return value.encode(self.character_encoding)
+        return value
+
+    def size(self, value):
+        return self.data_offset + len(self.payload(value))
+
+    def encode_into(self, msg_buffer, offset, value):
+        """ Encode the field at offset, returning the offset following it """
+        payload = self.payload(value)
+        msg_buffer[offset:offset + self.data_offset] = b'\0' * self.data_offset
+        self.length_struct.pack_into(msg_buffer, offset, len(payload))
+        offset += self.data_offset
+        msg_buffer[offset:offset + len(payload)] = payload
+        return offset + len(payload)
+
+
+class GroupEncoder(object):
+    """ Encodes the dimension and entries of a repeating group """
+    def __init__(self, group):
+        self.name = group.name
+        block_length = getattr(group, 'schema_block_length', None)
+        if block_length is None:
+            block_length = max([field.field_offset + field.field_length for field in group.fields] or [0])
+        self.block_length = block_length
+        self.groups = [GroupEncoder(nested_group) for nested_group in group.groups]
+        self.data = [DataEncoder(data_field) for data_field in getattr(group, 'data_fields', ())]
+        self.block = BlockEncoder(group.name, group.fields, group.block_struct, block_length,
+                                  [nested.name for nested in self.groups + self.data])
+        endian = _endian(group.block_struct)
+        self.dimension_struct = block_layout([group.block_length_field, group.num_in_group_field], endian)[0]
+        self.dimension_size = group.dimension_size
+        self.dimension_padding = b'\0' * (self.dimension_size - self.dimension_struct.size)
+
+    def size(self, entries):
+        size = self.dimension_size + len(entries) * self.block_length
+        if self.groups or self.data:
+            for entry in entries:
+                for group in self.groups:
+                    size += group.size(entry.get(group.name, ()))
+                for data in self.data:
+                    size += data.size(entry.get(data.name))
+        return size
+
+    def encode_into(self, msg_buffer, offset, entries):
+        """ Encode the group at offset, returning the offset following it """
+        self.dimension_struct.pack_into(msg_buffer, offset, self.block_length, len(entries))
+        if self.dimension_padding:
+            start = offset + self.dimension_struct.size
+            msg_buffer[start:start + len(self.dimension_padding)] = self.dimension_padding
+        offset += self.dimension_size
+
+        block = self.block
+        block_length = self.block_length
+        for entry in entries:
+            block.pack_into(msg_buffer, offset, block.values(entry))
+            offset += block_length
+            for group in self.groups:
+                offset = group.encode_into(msg_buffer, offset, entry.get(group.name, ()))
+            for data in self.data:
+                offset = data.encode_into(msg_buffer, offset, entry.get(data.name))
+        return offset
+
+
+class MessageEncoder(object):
+    """ Encodes the messages of a template, the header fields are filled in
+
+    groups maps the names of the message's repeating groups to lists of entries, each entry a dict of field
+    values, with the entries of its nested groups under their name.  Groups that aren't given are empty.  Var
+    data is given with the fields (of the message or of group entries).
+    """
+    def __init__(self, message_type, schema_id=None, schema_version=None):
+        self.message_type = message_type
+        self.template_id = message_type.message_id
+        self.block_length = message_type.header_size + message_type.schema_block_length
+        self.groups = [GroupEncoder(group) for group in message_type.groups]
+        self.group_map = dict((group.name, group) for group in self.groups)
+        self.data = [DataEncoder(data_field) for data_field in getattr(message_type, 'data_fields', ())]
+        # the size of the (empty) groups and var data following the block
+        self.empty_size = sum(group.dimension_size for group in self.groups) + \
+            sum(data.data_offset for data in self.data)
+        name = message_type.__name__ if isinstance(message_type, type) else type(message_type).__name__
+        self.block = BlockEncoder(name, message_type.fields, message_type.block_struct, self.block_length,
+                                  [data.name for data in self.data])
+
+        header = {'block_length': message_type.schema_block_length, 'template_id': self.template_id,
+                  'schema_id': schema_id, 'version': schema_version}
+        self.block.defaults = self.block.values(dict((name, value) for name, value in header.items()
+                                                     if value is not None and name in self.block.setters))
+        self._message_size_index = self.block.setters['message_size'][0] if 'message_size' in self.block.setters \
+            else None
+
+    def size(self, groups=None, fields=None):
+        """ Return the size of the message encoded with these groups (and the var data of these fields) """
+        size = self.block_length + self.empty_size
+        if self.data and fields:
+            for data in self.data:
+                size += len(data.payload(fields.get(data.name)))
+        if not groups:
+            return size
+        for name in groups:
+            if name not in self.group_map:
+                raise ValueError('%s has no group %r' % (self.block.name, name))
+        for group in self.groups:
+            size += group.size(groups.get(group.name, ())) - group.dimension_size
+        return size
+
+    def encode(self, fields=None, groups=None):
+        """ Return the message as a bytearray """
+        size = self.size(groups, fields)
+        msg_buffer = bytearray(size)
+        self._encode_into(msg_buffer, 0, size, fields, groups)
+        return msg_buffer
+
+    def encode_into(self, msg_buffer, offset, fields=None, groups=None):
+        """ Write the message into msg_buffer (e.g. a bytearray or a writable memoryview) at offset, returning
+        its size.  Raises ValueError if it doesn't fit. """
+        size = self.size(groups, fields)
+        if offset + size > len(msg_buffer):
+            raise ValueError('a %d byte %s message does not fit at offset %d of a %d byte buffer' %
+                             (size, self.block.name, offset, len(msg_buffer)))
+        self._encode_into(msg_buffer, offset, size, fields, groups)
+        return size
+
+    def _encode_into(self, msg_buffer, offset, size, fields, groups):
+        block = self.block
+        values = block.values(fields)
+        if self._message_size_index is not None:
+            values[self._message_size_index] = size
+        block.pack_into(msg_buffer, offset, values)
+        group_offset = offset + self.block_length
+        for group in self.groups:
+            group_offset = group.encode_into(msg_buffer, group_offset, groups.get(group.name, ()) if groups else ())
+        for data in self.data:
+            group_offset = data.encode_into(msg_buffer, group_offset, fields.get(data.name) if fields else None)
+
+
+class MDPPacketBuilder(object):
+    """ Builds CME MDP 3.0 packets in a preallocated buffer
+
+    A packet starts with a 12 byte header (the packet sequence number and sending time) followed by messages,
+    each framed by its message size header (so the schema must be built with include_message_size_header,
+    e.g. an MDPSchema):
+
+        builder = MDPPacketBuilder(schema)
+        builder.start(sequence_number, sending_time)
+        while builder.add(32, fields, groups):
+            ...
+        sock.sendto(builder.packet(), destination)
+
+    The buffer is reused by the next packet started.
+    """
+    packet_header = Struct('<IQ')
+
+    def __init__(self, schema, max_packet_size=1420, msg_buffer=None):
+        if not schema.include_message_size_header:
+            raise ValueError('MDP messages are framed by a message size header, '
+                             'the schema needs include_message_size_header')
+        self.schema = schema
+        self.msg_buffer = msg_buffer if msg_buffer is not None else bytearray(max_packet_size)
+        self.size = 0
+
+    def start(self, sequence_number, sending_time):
+        """ Start a new packet, discarding the current one """
+        self.packet_header.pack_into(self.msg_buffer, 0, sequence_number, sending_time)
+        self.size = self.packet_header.size
+
+    def add(self, template_id, fields=None, groups=None):
+        """ Append a message to the packet, or return False (leaving the packet unchanged) if it doesn't fit """
+        encoder = self.schema.get_encoder(template_id)
+        size = encoder.size(groups, fields)
+        if self.size + size > len(self.msg_buffer):
+            return False
+        encoder._encode_into(self.msg_buffer, self.size, size, fields, groups)
+        self.size += size
+        return True
+
+    def packet(self):
+        """ Return a memoryview of the packet in the buffer """
+        return memoryview(self.msg_buffer)[:self.size]
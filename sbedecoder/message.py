@@ -1,8 +1,139 @@
-from struct import unpack_from
+from struct import Struct, calcsize, unpack_from
+from collections import namedtuple
+from copy import copy
+from decimal import Decimal
 import math
 
 
+def unpack_block(block_struct, msg_buffer, offset):
+    """ Decode a whole fixed-length block in one call, or None if the block can't be (fully) decoded """
+    if block_struct is not None and offset + block_struct.size <= len(msg_buffer):
+        return block_struct.unpack_from(msg_buffer, offset)
+    return None
+
+
+def block_layout(fields, endian):
+    """ Lay out the (non constant) fields of a block in a single struct
+
+    Returns the struct (or None if no field is stored on the wire) and a dict mapping id(field) to the
+    index of the field's value in the unpacked tuple.  Composites are flattened into their parts and
+    fields overlapping a previous one are left out, to be unpacked on their own.
+    """
+    stored_fields = []
+    for field in fields:
+        for part in getattr(field, 'parts', [field]):
+            if getattr(part, 'constant', None) is None:
+                stored_fields.append(part)
+    stored_fields.sort(key=lambda f: f.field_offset)
+
+    block_fmt = endian
+    block_offset = 0
+    value_index = 0
+    value_indices = {}
+    for field in stored_fields:
+        if field.field_offset < block_offset:
+            continue  # overlapping field
+        field_fmt = field.unpack_fmt.lstrip('@=<>!')
+        field_struct = Struct(endian + field_fmt)
+        if field.field_offset > block_offset:
+            block_fmt += '%dx' % (field.field_offset - block_offset)
+        block_fmt += field_fmt
+        value_indices[id(field)] = value_index
+        block_offset = field.field_offset + field_struct.size
+        value_index += len(field_struct.unpack(b'\0' * field_struct.size))
+
+    if value_index == 0:
+        return None, value_indices
+    return Struct(block_fmt), value_indices
+
+
+def field_end(field):
+    """ Offset of the end of the (non constant) values of a field, 0 if none is stored on the wire """
+    end = 0
+    for part in getattr(field, 'parts', [field]):
+        if getattr(part, 'constant', None) is None:
+            end = max(end, part.field_offset + calcsize(part.unpack_fmt))
+    return end
+
+
+def header_layout(fields, endian='<'):
+    """ Return a struct unpacking the block length and version of a message header (in the order of their
+    offsets), or None if the header lacks them """
+    header_fields = [field for field in fields if field.name in ('block_length', 'version')]
+    if len(header_fields) != 2:
+        return None
+    return block_layout(header_fields, endian)[0]
+
+
+class VersionLayout(object):
+    """ The fields, groups and var data of a message root block (or group entry) found on the wire
+
+    Fields newer than the version (unless it is 0) and fields past the end of the block (older producers send
+    shorter blocks) aren't on the wire, neither are groups and var data newer than the version.  A layout is
+    built once for each version and block length seen, so wrapping needs no per field version check.
+    """
+    def __init__(self, entity, version, block_end):
+        self.version = version
+        self.block_end = block_end
+        fields = entity.fields
+        self.present = [(field.since_version <= version or version == 0) and field_end(field) <= block_end
+                        for field in fields]
+        self.fields = [field for field, present in zip(fields, self.present) if present]
+        self.groups = [group for group in entity.groups if group.since_version <= version]
+        data_fields = getattr(entity, 'data_fields', [])
+        self.data_present = [data_field.since_version <= version for data_field in data_fields]
+        self.data_fields = [data_field for data_field, present in zip(data_fields, self.data_present) if present]
+
+        self.block_struct = entity.block_struct
+        if self.block_struct is not None and block_end < max([field_end(field) for field in fields] or [0]):
+            # a prefix of the block struct, so the fields keep their value_index
+            endian = self.block_struct.format[:1]
+            self.block_struct = block_layout([field for field in fields if field_end(field) <= block_end],
+                                             endian if endian in '@=<>!' else '<')[0]
+
+    def bind(self, entity):
+        """ Return this layout for another instance of the entity's class, whose fields are its own (generated
+        message classes build their fields per instance) """
+        layout = copy(self)
+        layout.fields = [field for field, present in zip(entity.fields, self.present) if present]
+        layout.groups = [group for group in entity.groups if group.since_version <= self.version]
+        layout.data_fields = [data_field for data_field, present in zip(entity.data_fields, self.data_present)
+                              if present]
+        return layout
+
+
+def make_record_type(name, field_names, **attributes):
+    """ Build an immutable, tuple backed record class holding decoded values """
+    record_base = namedtuple(name, field_names, rename=True)
+    attributes['__slots__'] = ()
+    return type(name, (record_base,), attributes)
+
+
+def enum_code(text, is_char):
+    """ Return the integer code of an enumerant's text, or None if it can never match a value on the wire """
+    if is_char:
+        return ord(text) if len(text) == 1 else None
+    try:
+        code = int(text)
+    except ValueError:
+        return None
+    return code if str(code) == text else None
+
+
+def record_values(fields, present):
+    # fields that aren't on the wire (see VersionLayout) are None
+    return [field.value if field_present else None for field, field_present in zip(fields, present)]
+
+
+def data_values(data_fields, present):
+    # records own copies of the var data payloads
+    return [data_field.tobytes() if data_present else None
+            for data_field, data_present in zip(data_fields, present)]
+
+
 class SBEMessageField(object):
+    block_values = None
+
     def __init__(self):
         self.name = None
         self.original_name = None
@@ -13,11 +144,27 @@ class SBEMessageField(object):
         self.unpack_fmt = None
         self.field_offset = 0
         self.relative_offset = 0
+        self.value_index = None
 
-    def wrap(self, msg_buffer, base_offset, relative_offset=0):
+    def wrap(self, msg_buffer, base_offset, relative_offset=0, block_values=None):
         self.msg_buffer = msg_buffer
         self.msg_offset = base_offset
         self.relative_offset = relative_offset
+        # values pre-decoded by the owning message/group's block_struct (if it covers this field)
+        self.block_values = block_values if self.value_index is not None else None
+
+    def __getstate__(self):
+        # never persist the buffer last wrapped (e.g. when caching a compiled schema)
+        state = self.__dict__.copy()
+        state.pop('msg_buffer', None)
+        state.pop('block_values', None)
+        return state
+
+    def _unpack_raw_value(self):
+        if self.block_values is not None:
+            return self.block_values[self.value_index]
+        return unpack_from(self.unpack_fmt, self.msg_buffer,
+                           self.msg_offset + self.relative_offset + self.field_offset)[0]
 
     @property
     def value(self):
@@ -39,7 +186,7 @@ class TypeMessageField(SBEMessageField):
                  unpack_fmt=None, field_offset=None,
                  field_length=None, optional=False,
                  null_value=None, constant=None, is_string_type=False,
-                 semantic_type=None, since_version=0):
+                 semantic_type=None, since_version=0, value_index=None):
         super(SBEMessageField, self).__init__()
         self.name = name
         self.original_name = original_name
@@ -54,6 +201,7 @@ class TypeMessageField(SBEMessageField):
         self.is_string_type = is_string_type
         self.semantic_type = semantic_type
         self.since_version = since_version
+        self.value_index = value_index
 
     @property
     def value(self):
@@ -76,15 +224,33 @@ class TypeMessageField(SBEMessageField):
         if self.constant is not None:
             return self.constant
 
-        _raw_value = unpack_from(self.unpack_fmt, self.msg_buffer,
-                                 self.msg_offset + self.relative_offset + self.field_offset)[0]
+        return self._unpack_raw_value()
 
-        return _raw_value
+
+class SetValues(dict):
+    """ Renderings of the raw values of a set, computed from its (mask, name) choices on first use
+
+    At most max_size renderings are kept, further raw values are rendered on each lookup.
+    """
+    max_size = 256
+
+    def __init__(self, choices):
+        super(SetValues, self).__init__()
+        self.choices = choices
+
+    def __missing__(self, raw_value):
+        value = ', '.join([name for mask, name in self.choices if raw_value & mask])
+        if len(self) < self.max_size:
+            self[raw_value] = value
+        return value
+
+    def __reduce__(self):
+        return SetValues, (self.choices,)  # don't persist the renderings
 
 
 class SetMessageField(SBEMessageField):
     def __init__(self, name=None, original_name=None, id=None, description=None, unpack_fmt=None, field_offset=None,
-                 choices=None, field_length=None, semantic_type=None, since_version=0):
+                 choices=None, field_length=None, semantic_type=None, since_version=0, value_index=None):
         super(SBEMessageField, self).__init__()
         self.name = name
         self.original_name = original_name
@@ -97,31 +263,33 @@ class SetMessageField(SBEMessageField):
         self.text_to_name = dict((int(x['text']), x['name']) for x in choices)
         self.semantic_type = semantic_type
         self.since_version = since_version
+        self.value_index = value_index
+
+        # bit mask of each choice, so that testing a choice is a single AND
+        self.masks = dict((name, 1 << bit) for bit, name in self.text_to_name.items() if bit < field_length * 8)
+        self.values = SetValues(tuple(sorted((mask, name) for name, mask in self.masks.items())))
+
+    def is_set(self, choice):
+        """ Return True if the choice (e.g. 'EndOfEvent') is set """
+        return self._unpack_raw_value() & self.masks[choice] != 0
+
+    @property
+    def flags(self):
+        """ The raw bits of the set, to be tested against masks """
+        return self._unpack_raw_value()
 
     @property
     def value(self):
-        _raw_value = self.raw_value
-        _value = ''
-        _num_values = 0
-        for i in range(self.field_length*8):
-            bit_set = 1 & (_raw_value >> i)
-            if bit_set:
-                if _num_values > 0:
-                    _value += ', '
-                _value += self.text_to_name[i]
-                _num_values += 1
-        return _value
+        return self.values[self._unpack_raw_value()]
 
     @property
     def raw_value(self):
-        _raw_value = unpack_from(self.unpack_fmt, self.msg_buffer,
-                                 self.msg_offset + self.relative_offset + self.field_offset)[0]
-        return _raw_value
+        return self._unpack_raw_value()
 
 
 class EnumMessageField(SBEMessageField):
     def __init__(self, name=None, original_name=None, id=None, description=None, unpack_fmt=None, field_offset=None,
-                 enum_values=None, field_length=None, semantic_type=None, since_version=0):
+                 enum_values=None, field_length=None, semantic_type=None, since_version=0, value_index=None):
         super(SBEMessageField, self).__init__()
         self.name = name
         self.original_name = original_name
@@ -135,23 +303,52 @@ class EnumMessageField(SBEMessageField):
         self.text_to_enumerant = dict((x['text'], x['name']) for x in enum_values) # shorter repr of value
         self.semantic_type = semantic_type
         self.since_version = since_version
+        self.value_index = value_index
+
+        # Integer codes of the enumerants: the value on the wire, or its ordinal for char encoded enums
+        self.is_char = unpack_fmt is not None and unpack_fmt[-1] == 'c'
+        self.codes = {}
+        for x in enum_values:
+            code = enum_code(x['text'], self.is_char)
+            if code is not None:
+                self.codes[x['name']] = code
+        self.code_to_enum_description = dict((self.codes[x['name']], x.get('description', ''))
+                                             for x in enum_values if x['name'] in self.codes)
+        self.code_to_enumerant = dict((code, name) for name, code in self.codes.items())
+        self._enum_type = None
+
+    def __getstate__(self):
+        state = super(EnumMessageField, self).__getstate__()
+        state['_enum_type'] = None  # generated classes can't be pickled
+        return state
+
+    @property
+    def code(self):
+        """ Integer code of the value, comparable to the values of codes (and enum_type()) """
+        _raw_value = self._unpack_raw_value()
+        if self.is_char:
+            return ord(_raw_value)
+        return _raw_value
+
+    def enum_type(self):
+        """ Return an IntEnum class of the enumerants, whose members compare equal to the codes """
+        if self._enum_type is None:
+            from enum import IntEnum  # enum34 is needed under python 2
+            self._enum_type = IntEnum(str(self.original_name or self.name),
+                                      sorted(self.codes.items(), key=lambda item: item[1]))
+        return self._enum_type
 
     @property
     def value(self):
-        _raw_value = self.raw_value
-        _value = self.text_to_enum_description.get(str(_raw_value), None)
-        return _value
+        return self.code_to_enum_description.get(self.code, None)
 
     @property
     def enumerant(self):
-        _raw_value = self.raw_value
-        _enumerant = self.text_to_enumerant.get(str(_raw_value), None)
-        return _enumerant
+        return self.code_to_enumerant.get(self.code, None)
 
     @property
     def raw_value(self):
-        _raw_value = unpack_from(self.unpack_fmt, self.msg_buffer,
-                                 self.msg_offset + self.relative_offset + self.field_offset)[0]
+        _raw_value = self._unpack_raw_value()
         if type(_raw_value) is bytes:
             _raw_value = _raw_value.decode('UTF-8')
         return _raw_value
@@ -159,7 +356,7 @@ class EnumMessageField(SBEMessageField):
 
 class CompositeMessageField(SBEMessageField):
     def __init__(self, name=None, original_name=None, id=None, description=None, field_offset=None, field_length=None,
-                 parts=None, float_value=False, semantic_type=None, since_version=0):
+                 parts=None, float_value=False, semantic_type=None, since_version=0, price_mode='float'):
         super(SBEMessageField, self).__init__()
         self.name = name
         self.original_name = original_name
@@ -171,29 +368,48 @@ class CompositeMessageField(SBEMessageField):
         self.float_value = float_value
         self.semantic_type = semantic_type
         self.since_version = since_version
+        self.price_mode = price_mode
 
         # Map the parts
         for part in self.parts:
             setattr(self, part.name, part)
 
-    def wrap(self, msg_buffer, msg_offset, relative_offset=0):
+        # Most prices have a constant exponent, so scale them without computing a power each time
+        self.price_exponent = None
+        self.price_factor = None
+        if float_value:
+            exponent = getattr(self, 'exponent', None)
+            if exponent is not None and exponent.constant is not None:
+                self.price_exponent = int(exponent.constant)
+                self.price_factor = math.pow(10, self.price_exponent)
+
+    def wrap(self, msg_buffer, msg_offset, relative_offset=0, block_values=None):
         self.msg_buffer = msg_buffer
         self.msg_offset = msg_offset
         self.relative_offset = relative_offset
 
         for part in self.parts:
-            part.wrap(msg_buffer, msg_offset, relative_offset=relative_offset)
+            part.wrap(msg_buffer, msg_offset, relative_offset=relative_offset, block_values=block_values)
 
     @property
     def value(self):
-        _raw_value = self.raw_value
-
         if self.float_value:
             # We expect two fields, mantissa and exponent as part of this field
-            mantissa = _raw_value.get('mantissa', None)
-            exponent = _raw_value.get('exponent', None)
-            if mantissa is None or exponent is None:
+            mantissa = self.mantissa.value
+            if mantissa is None:
+                return None
+            if self.price_exponent is not None:
+                if self.price_mode == 'fixed':
+                    return mantissa  # scaled by 10 ** price_exponent
+                if self.price_mode == 'decimal':
+                    return Decimal(mantissa).scaleb(self.price_exponent)
+                return float(mantissa) * self.price_factor
+
+            exponent = self.exponent.value if hasattr(self, 'exponent') else None
+            if exponent is None:
                 return None
+            if self.price_mode == 'decimal':
+                return Decimal(mantissa).scaleb(exponent)
             return float(mantissa) * math.pow(10, exponent)
 
         return self.raw_value
@@ -204,44 +420,107 @@ class CompositeMessageField(SBEMessageField):
         return part_dict
 
 
+class VarDataMessageField(SBEMessageField):
+    """ A variable length data field: a length followed by that many bytes
+
+    Data fields follow the groups of a message (or group entry), so they are wrapped at the offset the
+    previous data field (or group) ends, only reading their length.  The payload is a zero-copy memoryview
+    of the message buffer, only valid until the buffer is reused.
+    """
+    def __init__(self, name=None, original_name=None, id=None, description=None, unpack_fmt=None,
+                 data_offset=None, character_encoding=None, semantic_type=None, since_version=0):
+        super(VarDataMessageField, self).__init__()
+        self.name = name
+        self.original_name = original_name
+        self.id = id
+        self.description = description
+        self.unpack_fmt = unpack_fmt  # of the length
+        self.data_offset = data_offset  # of the payload, from the start of the field
+        self.character_encoding = character_encoding
+        self.semantic_type = semantic_type
+        self.since_version = since_version
+        self.length = 0
+
+    def wrap(self, msg_buffer, base_offset, relative_offset=0, block_values=None):
+        """ Wrap the field at relative_offset, returning its size """
+        self.msg_buffer = msg_buffer
+        self.msg_offset = base_offset
+        self.relative_offset = relative_offset
+        self.length = unpack_from(self.unpack_fmt, msg_buffer, base_offset + relative_offset)[0]
+        return self.data_offset + self.length
+
+    @property
+    def value(self):
+        start = self.msg_offset + self.relative_offset + self.data_offset
+        return memoryview(self.msg_buffer)[start:start + self.length]
+
+    @property
+    def raw_value(self):
+        return self.value
+
+    @property
+    def text(self):
+        """ The payload decoded with the field's character encoding (UTF-8 if it has none) """
+        return self.tobytes().decode(self.character_encoding or 'UTF-8')
+
+    def tobytes(self):
+        """ A copy of the payload """
+        return self.value.tobytes()
+
+    def __str__(self, raw=False):
+        if self.character_encoding is not None:
+            return "%s: %s" % (self.name, self.text)
+        return "%s: %r" % (self.name, self.tobytes())
+
+
 class SBERepeatingGroup:
-    def __init__(self, msg_buffer, msg_offset, relative_offset, name, original_name, fields):
+    """ Cursor over the entries of a repeating group
+
+    A single instance is re-positioned on each entry by its SBERepeatingGroupContainer, so (like
+    message fields) it must be used before moving on to the next entry.
+    """
+    def __init__(self, msg_buffer, msg_offset, relative_offset, name, original_name, fields, block_struct=None,
+                 groups=None, data_fields=None):
         self.msg_buffer = msg_buffer
         self.msg_offset = msg_offset
         self.relative_offset = relative_offset
         self.fields = fields
-        self._groups = []
+        self.block_struct = block_struct
         self.name = name
         self.original_name = original_name
 
-        for field in fields:
-            setattr(self, field.name, field)
-
-    def wrap(self):
-        for field in self.fields:
-            field.wrap(self.msg_buffer, self.msg_offset, relative_offset=self.relative_offset)
-
-    def add_subgroup(self, subgroup):
-        if not hasattr(self, subgroup.name):
-            setattr(self, subgroup.name, [subgroup])
+        if groups is None:
+            self.groups = []
         else:
-            getattr(self, subgroup.name).append(subgroup)
-        self._groups.append(subgroup)
+            self.groups = groups
+        self.data_fields = data_fields if data_fields is not None else []
 
-    @property
-    def groups(self):
-        for group in self._groups:
-            group.wrap()
-            yield group
+        for field in fields:
+            setattr(self, field.name, field)
+        for group in self.groups:
+            setattr(self, group.name, group)
+        for data_field in self.data_fields:
+            setattr(self, data_field.name, data_field)
+
+    def wrap(self, layout=None):
+        block_struct, fields = (layout.block_struct, layout.fields) if layout is not None else \
+            (self.block_struct, self.fields)
+        block_values = unpack_block(block_struct, self.msg_buffer, self.msg_offset + self.relative_offset)
+        for field in fields:
+            field.wrap(self.msg_buffer, self.msg_offset, relative_offset=self.relative_offset,
+                       block_values=block_values)
 
 
 class SBERepeatingGroupContainer(object):
     def __init__(self, name=None, original_name=None, id=None, block_length_field=None,
                  num_in_group_field=None, dimension_size=None, fields=None, groups=None,
-                 since_version=0):
+                 since_version=0, block_struct=None, schema_block_length=None, data_fields=None):
         self.msg_buffer = None
         self.msg_offset = 0
         self.group_start_offset = 0
+        self.group_offset = 0
+        self.block_length = 0
+        self.num_instances = 0
 
         self.name = name
         self.original_name = original_name
@@ -258,12 +537,19 @@ class SBERepeatingGroupContainer(object):
             self.groups = []
         else:
             self.groups = groups
+        self.data_fields = data_fields if data_fields is not None else []
         self.since_version = since_version
+        self.block_struct = block_struct
+        self.schema_block_length = schema_block_length  # of the entries encoded with this version of the schema
 
         self.dimension_size = dimension_size
-        self._repeating_groups = []
+        self._entry_offsets = []  # only used when entries contain nested groups or var data
+        self._cursor = None
+        self._record_type = None
+        self._layouts = {}  # (version, block length) -> VersionLayout of the entries
+        self.layout = None
 
-    def wrap(self, msg_buffer, msg_offset, group_start_offset):
+    def wrap(self, msg_buffer, msg_offset, group_start_offset, version=0):
         self.msg_buffer = msg_buffer
         self.msg_offset = msg_offset
         self.group_start_offset = group_start_offset
@@ -272,52 +558,139 @@ class SBERepeatingGroupContainer(object):
         block_length = self.block_length_field.value
         num_instances = self.num_in_group_field.value
 
-        self._repeating_groups = []
+        self.block_length = block_length
+        self.num_instances = num_instances
         self.group_offset = group_start_offset + self.dimension_size
 
-        # for each group, add the group length which can vary due to nested groups
-        repeated_group_offset = group_start_offset + self.dimension_size
-        nested_groups_length = 0
-        for i in range(num_instances):
-            repeated_group = SBERepeatingGroup(msg_buffer,
-                                               msg_offset,
-                                               repeated_group_offset + nested_groups_length,
-                                               self.name,
-                                               self.original_name,
-                                               self.fields)
-            self._repeating_groups.append(repeated_group)
-            repeated_group_offset += block_length
-            # now account for any nested groups
-            for nested_group in self.groups:
-                nested_groups_length += nested_group.wrap(
-                    msg_buffer, msg_offset, repeated_group_offset + nested_groups_length)
-                for nested_repeating_group in nested_group._repeating_groups:
-                    repeated_group.add_subgroup(nested_repeating_group)
+        # entries are laid out by the version of the message and the block length on the wire
+        layout = self._layouts.get((version, block_length))
+        if layout is None:
+            layout = self._layouts[(version, block_length)] = VersionLayout(self, version, block_length)
+        self.layout = layout
 
-        size = self.dimension_size + (num_instances * block_length) + nested_groups_length
-        return size
+        if not layout.groups and not layout.data_fields:
+            # fixed size entries, offsets are computed on demand
+            return self.dimension_size + (num_instances * block_length)
+
+        # entries vary in size due to nested groups or var data, so walk them once to find each entry's offset
+        entry_offsets = self._entry_offsets
+        del entry_offsets[:]
+        entry_offset = self.group_offset
+        for i in range(num_instances):
+            entry_offsets.append(entry_offset)
+            entry_offset += block_length
+            for nested_group in layout.groups:
+                entry_offset += nested_group.wrap(msg_buffer, msg_offset, entry_offset, version)
+            for data_field in layout.data_fields:
+                entry_offset += data_field.wrap(msg_buffer, msg_offset, entry_offset)
+
+        return entry_offset - group_start_offset
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['msg_buffer'] = None
+        state['_cursor'] = None
+        state['_record_type'] = None
+        state['_layouts'] = {}
+        state['layout'] = None
+        if self.block_struct is not None:
+            state['block_struct'] = self.block_struct.format
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.block_struct is not None:
+            self.block_struct = Struct(self.block_struct)
+
+    def entry_offset(self, index):
+        """ Offset of an entry's block, relative to the start of the message """
+        if self.layout.groups or self.layout.data_fields:
+            return self._entry_offsets[index]
+        return self.group_offset + index * self.block_length
+
+    def _wrap_entry(self, index):
+        cursor = self._cursor
+        if cursor is None:
+            cursor = SBERepeatingGroup(None, 0, 0, self.name, self.original_name, self.fields,
+                                       block_struct=self.block_struct, groups=self.groups,
+                                       data_fields=self.data_fields)
+            self._cursor = cursor
+
+        layout = self.layout
+        entry_offset = self.entry_offset(index)
+        cursor.msg_buffer = self.msg_buffer
+        cursor.msg_offset = self.msg_offset
+        cursor.relative_offset = entry_offset
+        cursor.wrap(layout)
+
+        # position the nested groups on this entry
+        nested_offset = entry_offset + self.block_length
+        for nested_group in layout.groups:
+            nested_offset += nested_group.wrap(self.msg_buffer, self.msg_offset, nested_offset, layout.version)
+        for data_field in layout.data_fields:
+            nested_offset += data_field.wrap(self.msg_buffer, self.msg_offset, nested_offset)
+        return cursor
 
     @property
     def num_groups(self):
-        return len(self._repeating_groups)
+        return self.num_instances
 
     @property
     def repeating_groups(self):
-        for group in self._repeating_groups:
-            group.wrap()
-            yield group
+        for index in range(self.num_instances):
+            yield self._wrap_entry(index)
+
+    def __len__(self):
+        return self.num_instances
+
+    def __iter__(self):
+        return self.repeating_groups
 
     def __getitem__(self, index):
-        group = self._repeating_groups[index]
-        group.wrap()
-        return group
+        if index < 0:
+            index += self.num_instances
+        if not 0 <= index < self.num_instances:
+            raise IndexError('repeating group index out of range')
+        return self._wrap_entry(index)
+
+    def record_type(self):
+        if self._record_type is None:
+            self._record_type = make_record_type(
+                self.original_name or self.name,
+                [f.name for f in self.fields] + [g.name for g in self.groups] + [d.name for d in self.data_fields],
+                group_type=self)
+        return self._record_type
+
+    def to_records(self, version):
+        """ Return a tuple of immutable records, one per repeating group entry """
+        if self.since_version > version:
+            return ()
+        record_type = self.record_type()
+        layout = self.layout
+        records = []
+        for entry in self.repeating_groups:
+            values = record_values(self.fields, layout.present)
+            for nested_group in self.groups:
+                values.append(nested_group.to_records(version))
+            values.extend(data_values(self.data_fields, layout.data_present))
+            records.append(record_type._make(values))
+        return tuple(records)
 
 
 class SBEMessage(object):
+    block_struct = None
+    header_struct = None  # unpacks the block length and version of the header, see header_layout()
+    data_fields = []
+    _layouts = None  # (block length, version) -> VersionLayout, per class once the schema has built it
+    _instance_fields = False  # whether the fields are built per instance (generated classes), see wrap()
+
     def __init__(self):
         self.name = self.__class__.__name__
         self.msg_buffer = None
         self.msg_offset = None
+        self.message_version = 0
+        self.encoded_length = None  # the size of the message last wrapped, up to the end of its var data
+        self.layout = None
 
     @staticmethod
     def parse_message(schema, msg_buffer, offset=0):
@@ -325,55 +698,168 @@ class SBEMessage(object):
         template_id_offset = 2  # the 2 byte BlockHeader that starts all SBE Messages
         if schema.include_message_size_header:
             template_id_offset = 4  # Include a two byte message header (i.e for CME MDP)
-        template_id = unpack_from('<H', msg_buffer, offset + template_id_offset)[0]
-        message_type = schema.get_message_type(template_id)
+        template_id, schema_id, version = unpack_from('<HHH', msg_buffer, offset + template_id_offset)
+        message_type = schema.get_message_type(template_id, schema_id, version)
         message = message_type()
         message.wrap(msg_buffer, offset)
         return message
 
+    @classmethod
+    def _build_layout(cls, header, entity=None):
+        # entity holds the fields, the message itself when they are built per instance
+        if entity is None:
+            entity = cls
+        layouts = cls._layouts
+        if layouts is None:
+            layouts = cls._layouts = {}
+        version, block_length = 0, cls.schema_block_length
+        if header is not None:
+            block_length, version = header
+            if entity.version.field_offset < entity.block_length.field_offset:
+                version, block_length = header
+        layout = layouts[header] = VersionLayout(entity, version, cls.header_size + block_length)
+        return layout
+
+    @classmethod
+    def encoded_size(cls, msg_buffer, msg_offset):
+        """ The size of the message at msg_offset, read from its header, group headers and var data lengths
+        without building the message or decoding its fields (the fields must be those of the class) """
+        header_struct = cls.header_struct
+        header = header_struct.unpack_from(msg_buffer, msg_offset) if header_struct is not None else None
+        layout = cls._layouts.get(header) if cls._layouts is not None else None
+        if layout is None:
+            layout = cls._build_layout(header)
+        size = layout.block_end
+        for group in layout.groups:
+            size += group.wrap(msg_buffer, msg_offset, size, layout.version)
+        for data_field in layout.data_fields:
+            size += data_field.wrap(msg_buffer, msg_offset, size)
+        return size
+
     def wrap(self, msg_buffer, msg_offset):
-        # Wrap the fields for decoding
         self.msg_buffer = msg_buffer
         self.msg_offset = msg_offset
 
-        message_version = 0
-        for field in self.fields:
-            if field.since_version > message_version > 0:
-                continue
-            field.wrap(msg_buffer, msg_offset)
-            if field.name == 'version': # as we're iterating fields, save the version, which comes early as part of header
-                message_version = field.value
+        # The version and block length in the header select the layout of the message
+        header_struct = self.header_struct
+        header = header_struct.unpack_from(msg_buffer, msg_offset) if header_struct is not None else None
+        layout = self._layouts.get(header) if self._layouts is not None else None
+        if layout is None:
+            layout = self._build_layout(header, self)
+        elif self._instance_fields:
+            layout = layout.bind(self)  # the cached layout refers to the fields of another instance
+        self.layout = layout
+        self.message_version = version = layout.version
 
-        # Wrap the groups for decoding
-        group_offset = self.schema_block_length + self.header_size
+        # Wrap the fields for decoding
+        block_values = unpack_block(layout.block_struct, msg_buffer, msg_offset)
+        for field in layout.fields:
+            field.wrap(msg_buffer, msg_offset, block_values=block_values)
+
+        # Wrap the groups for decoding, they follow the block (of the length on the wire)
+        group_offset = layout.block_end
+        for group in layout.groups:
+            group_offset += group.wrap(msg_buffer, msg_offset, group_offset, version)
+
+        # Var data follows the groups, only the lengths are read to find where the message ends
+        data_offset = group_offset
+        for data_field in layout.data_fields:
+            data_offset += data_field.wrap(msg_buffer, msg_offset, data_offset)
+        self.encoded_length = data_offset
+
+    def record_type(self):
+        message_class = self.__class__
+        record_type = message_class.__dict__.get('_record_type')
+        if record_type is None:
+            record_type = make_record_type(
+                self.name,
+                [f.name for f in self.fields] + [g.name for g in self.groups] + [d.name for d in self.data_fields],
+                message_type=message_class)
+            message_class._record_type = record_type
+        return record_type
+
+    def to_record(self):
+        """ Return an immutable record owning the decoded field values (and group entries) of this message
+
+        Unlike the message itself, the record is not affected by parsing further messages, so it can be
+        stored, batched or handed over to another thread.
+        """
+        layout = self.layout
+        values = record_values(self.fields, layout.present)
         for group in self.groups:
-            if group.since_version <= message_version:
-                group_offset += group.wrap(msg_buffer, msg_offset, group_offset)
+            values.append(group.to_records(self.message_version))
+        values.extend(data_values(self.data_fields, layout.data_present))
+        return self.record_type()._make(values)
 
     def __str__(self):
         return '%s' % (self.__class__.__name__,)
 
 
 class SBEMessageFactory(object):
+    # The template id, schema id and version of the header, after its block length (and the message size
+    # header if the schema has one).  The schema can be an SBESchemaRegistry, which dispatches on all three.
+    header = Struct('<2xHHH')
+    sized_header = Struct('<H2xHHH')
+
     def __init__(self, schema):
         self.schema = schema
 
-    # This should return a tuple of (message, message_size)
-    def build(self, msg_buffer, offset):
-        raise NotImplementedError()
+    def _peek(self, msg_buffer, offset):
+        header_offset = offset + 2 if self.schema.include_message_size_header else offset
+        template_id, schema_id, version = self.header.unpack_from(msg_buffer, header_offset)
+        return template_id, schema_id, self.schema.get_message_type(template_id, schema_id, version)
+
+    @staticmethod
+    def _size(message_type, msg_buffer, offset):
+        # Messages are only framed by their SBE header here, so skipped messages are sized by walking their
+        # groups and var data lengths.  Generated and compiled messages only have fields once built.
+        if issubclass(message_type, SBEMessage) and not message_type._instance_fields:
+            return message_type.encoded_size(msg_buffer, offset)
+        message = message_type()
+        message.wrap(msg_buffer, offset)
+        return message.encoded_length
+
+    # This should return a tuple of (message, message_size), where message is None if its template id
+    # isn't in template_ids (when given).
+    def build(self, msg_buffer, offset, template_ids=None):
+        template_id, _, message_type = self._peek(msg_buffer, offset)
+        if template_ids is not None and template_id not in template_ids:
+            return None, self._size(message_type, msg_buffer, offset)
+        message = message_type()
+        message.wrap(msg_buffer, offset)
+        return message, message.encoded_length
+
+    # This should return a tuple of ((template_id, values), message_size), where values are returned by the
+    # projection registered for the template id in the schema, or (None, message_size) if there is none
+    def build_projection(self, msg_buffer, offset):
+        template_id, schema_id, message_type = self._peek(msg_buffer, offset)
+        projection = self.schema.get_projection(template_id, schema_id)
+        if projection is None:
+            return None, self._size(message_type, msg_buffer, offset)
+        return (template_id, projection(msg_buffer, offset)), self._size(message_type, msg_buffer, offset)
 
 
 class MDPMessageFactory(SBEMessageFactory):
     def __init__(self, schema):
         super(MDPMessageFactory, self).__init__(schema)
 
-    def build(self, msg_buffer, offset):
+    def build(self, msg_buffer, offset, template_ids=None):
         # Peek at the template id to figure out what class to build.
         # This looks past the starting 2 byte MsgSize header that is CME specific
         # and the 2 byte BlockLength that starts all SBE Messages:
         #   https://www.cmegroup.com/confluence/display/EPICSANDBOX/MDP+3.0+-+Message+Header
-        template_id = unpack_from('<H', msg_buffer, offset+4)[0]
-        message_type = self.schema.get_message_type(template_id)
+        message_size, template_id, schema_id, version = self.sized_header.unpack_from(msg_buffer, offset)
+        if template_ids is not None and template_id not in template_ids:
+            # skipped using the MsgSize header alone, without building the message
+            return None, message_size
+        message_type = self.schema.get_message_type(template_id, schema_id, version)
         message = message_type()
         message.wrap(msg_buffer, offset)
-        return message, message.message_size.value
+        return message, message_size
+
+    def build_projection(self, msg_buffer, offset):
+        message_size, template_id, schema_id, _ = self.sized_header.unpack_from(msg_buffer, offset)
+        projection = self.schema.get_projection(template_id, schema_id)
+        if projection is None:
+            return None, message_size
+        return (template_id, projection(msg_buffer, offset)), message_size
@@ -2,9 +2,46 @@ class SBEParser(object):
     def __init__(self, msg_factory):
         self.factory = msg_factory
 
-    def parse(self, message_buffer, offset=0):
+    @property
+    def compiled(self):
+        """ Whether the messages are compiled decoders (plain values) rather than messages of field objects """
+        return getattr(self.factory.schema, 'compiled', False)
+
+    def parse(self, message_buffer, offset=0, template_ids=None):
+        """ Yield the messages in message_buffer
+
+        If template_ids is given, only messages with those template ids are decoded, the others are skipped
+        without being built.
+        """
+        msg_offset = offset
+        while msg_offset < len(message_buffer):
+            message, message_size = self.factory.build(message_buffer, msg_offset, template_ids)
+            msg_offset += message_size
+            if message is not None:
+                yield message
+
+    def parse_records(self, message_buffer, offset=0, template_ids=None):
+        """ Same as parse() but yields immutable records that can be stored for later processing """
+        for message in self.parse(message_buffer, offset, template_ids):
+            yield message.to_record()
+
+    def parse_projections(self, message_buffer, offset=0):
+        """ Yield (template_id, values) for the messages with a projection registered with schema.project()
+
+        Other messages are skipped without being decoded.
+        """
         msg_offset = offset
         while msg_offset < len(message_buffer):
-            message, message_size = self.factory.build(message_buffer, msg_offset)
+            projection, message_size = self.factory.build_projection(message_buffer, msg_offset)
             msg_offset += message_size
-            yield message
+            if projection is not None:
+                yield projection
+
+    def parse_to_columns(self, buffers, offset=0, template_ids=None):
+        """ Decode all the messages in buffers (e.g. the packets of a capture) into NumPy structured arrays
+
+        Returns a dict of template id to sbedecoder.columns.MessageColumns. If template_ids is given, only
+        messages with those template ids are decoded into columns.  Requires numpy.
+        """
+        from sbedecoder import columns  # numpy is only imported when needed
+        return columns.parse_to_columns(self, buffers, offset=offset, template_ids=template_ids)
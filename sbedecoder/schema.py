@@ -1,8 +1,17 @@
+import io
+import os
 import re
+import hashlib
+import tempfile
 import six
+from six.moves import cPickle as pickle
+from struct import Struct
 from lxml import etree
+from sbedecoder import __version__
+from sbedecoder.codegen import compile_messages, compile_projection
+from sbedecoder.encoder import MessageEncoder
 from sbedecoder.message import SBEMessage, TypeMessageField, EnumMessageField, SetMessageField, CompositeMessageField, \
-    SBERepeatingGroupContainer
+    SBERepeatingGroupContainer, VarDataMessageField, block_layout, header_layout
 
 
 def convert_to_underscore(name):
@@ -12,10 +21,22 @@ def convert_to_underscore(name):
 
 
 class SBESchema(object):
-    def __init__(self, include_message_size_header=False, use_description_as_message_name=False):
+    price_modes = ('float', 'fixed', 'decimal')
+
+    def __init__(self, include_message_size_header=False, use_description_as_message_name=False, price_mode='float'):
+        """ price_mode sets the value of price composites (a mantissa and an exponent):
+            'float': a float (the default)
+            'fixed': the mantissa, an integer scaled by the constant exponent of the field (price_exponent).
+                     Prices with a variable exponent are still floats.
+            'decimal': an exact decimal.Decimal, e.g. for reporting
+        """
+        if price_mode not in self.price_modes:
+            raise ValueError('unknown price mode %r, expected one of %s' % (price_mode, ', '.join(self.price_modes)))
         self.messages = []
+        self.compiled = False  # whether the message types are generated decoders, see compile()
         self.include_message_size_header = include_message_size_header
         self.use_description_as_message_name = use_description_as_message_name
+        self.price_mode = price_mode
         self.initial_types = {
            "char": {"children": [], "description": "char", "name": "char", "primitive_type": "char", "type": "type"},
            "int": {"children": [], "description": "int", "name": "int", "primitive_type": "int32", "type": "type"},
@@ -32,6 +53,11 @@ class SBESchema(object):
         }
         self.type_map = {}
         self.message_map = {}
+        self.projections = {}
+        self.schema_id = None  # id and version attributes of the messageSchema
+        self.schema_version = None
+        self.encoders = {}
+        self._parsed_message_map = {}  # kept by compile(), the encoders need the parsed message types
 
         self.primitive_type_map = {
             'char': ('c', 1),
@@ -56,7 +82,7 @@ class SBESchema(object):
             type_configuration['text'] = type_definition.text.strip()
 
         children_types = []
-        for child in type_definition.getchildren():
+        for child in type_definition:
             child_configuration = dict((convert_to_underscore(x[0]), x[1]) for x in child.items())
             child_configuration['type'] = child.tag
             if child.text:
@@ -65,35 +91,64 @@ class SBESchema(object):
         type_configuration['children'] = children_types
         return type_configuration
 
-    def _parse_types(self, xml_file, types_tag='types'):
-        type_map = self.initial_types
-        with open(xml_file, 'rb') as input_schema_file:
-            xml_context = etree.iterparse(input_schema_file, tag=types_tag, remove_comments=True)
-            for action, elem in xml_context:
-                # Now parse all the children under the types tag
-                for type_def in elem.getchildren():
-                    new_type = self._build_type_definition(type_def)
-                    type_map[new_type['name']] = new_type
-        return type_map
+    @staticmethod
+    def _open_schema(xml_file):
+        """ Return a binary file object for a schema given as a file name, bytes or a file object """
+        if hasattr(xml_file, 'read'):
+            return xml_file
+        if isinstance(xml_file, (bytearray, memoryview)) or \
+                (isinstance(xml_file, six.binary_type) and xml_file.lstrip().startswith(b'<')):
+            return io.BytesIO(xml_file)
+        return open(xml_file, 'rb')
 
     @staticmethod
-    def _parse_messages(xml_file, message_tag='message'):
+    def _read_schema(xml_file):
+        schema_file = SBESchema._open_schema(xml_file)
+        try:
+            return schema_file.read()
+        finally:
+            if schema_file is not xml_file:
+                schema_file.close()
+
+    def _parse_definitions(self, xml_file, message_tag='message', types_tag='types'):
+        """ Collect the type and message definitions in a single streaming pass over the schema """
+        type_map = dict(self.initial_types)
         messages = []
-        with open(xml_file, 'rb') as input_schema_file:
-            xml_context = etree.iterparse(input_schema_file)
+        schema_file = self._open_schema(xml_file)
+        try:
+            xml_context = etree.iterparse(schema_file, remove_comments=True)
             for action, elem in xml_context:
                 local_name = etree.QName(elem.tag).localname
-                if local_name == message_tag:
+                if local_name == types_tag:
+                    # Now parse all the children under the types tag
+                    for type_def in elem:
+                        new_type = self._build_type_definition(type_def)
+                        type_map[new_type['name']] = new_type
+                elif local_name == message_tag:
                     message_definition = dict((convert_to_underscore(x[0]), x[1]) for x in elem.items())
                     SBESchema._parse_message_elements(elem, message_definition)
                     messages.append(message_definition)
-        return messages
+                elif local_name == 'messageSchema':
+                    self.schema_id = int(elem.get('id')) if elem.get('id') is not None else None
+                    self.schema_version = int(elem.get('version', '0'))
+                else:
+                    continue
+
+                # release the parsed elements as we go
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        finally:
+            if schema_file is not xml_file:
+                schema_file.close()
+        return type_map, messages
 
     @staticmethod
     def _parse_message_elements(elements, definition):
         fields = []
         groups = []
-        for child in elements.getchildren():
+        data = []
+        for child in elements:
             if child.tag == 'field':
                 field = dict((convert_to_underscore(x[0]), x[1]) for x in child.items())
                 field['converted_name'] = convert_to_underscore(field['name'])
@@ -103,8 +158,13 @@ class SBESchema(object):
                 SBESchema._parse_message_elements(child, group)
                 group['converted_name'] = convert_to_underscore(group['name'])
                 groups.append(group)
+            elif child.tag == 'data':
+                data_field = dict((convert_to_underscore(x[0]), x[1]) for x in child.items())
+                data_field['converted_name'] = convert_to_underscore(data_field['name'])
+                data.append(data_field)
         definition['fields'] = fields
         definition['groups'] = groups
+        definition['data'] = data
 
     def _build_message_field(self, message_type, field_definition, offset, endian='<', add_header_size=True):
         field_original_name = field_definition['name']
@@ -276,12 +336,16 @@ class SBESchema(object):
                                                   field_offset=field_offset, field_length=field_length,
                                                   parts=composite_parts,
                                                   float_value=float_composite, semantic_type=field_semantic_type,
-                                                  since_version=field_since_version)
+                                                  since_version=field_since_version, price_mode=self.price_mode)
         return message_field
 
-    def get_message_type(self, template_id):
+    def get_message_type(self, template_id, schema_id=None, version=None):
+        # the schema id and version of the message are only used by SBESchemaRegistry
         return self.message_map.get(template_id, None)
 
+    def get_projection(self, template_id, schema_id=None):
+        return self.projections.get(template_id)
+
     def _determine_field_length(self, field):
         field_type = field.get('primitive_type', field['type'])
         if field_type in self.primitive_type_map:
@@ -354,6 +418,42 @@ class SBESchema(object):
             # make it an attribute too
             setattr(entity_type, field.name, field)
 
+    def _build_data_field(self, data_definition, endian):
+        # var data types are composites of a length and a varData part, typically varDataEncoding
+        data_type = self.type_map[data_definition['type']]
+        length_type = None
+        data_offset = 0
+        character_encoding = None
+        for child in data_type['children']:
+            if child['name'] == 'length':
+                length_type = child
+                data_offset += self.primitive_type_map[child['primitive_type']][1]
+            elif child['name'] == 'varData':
+                if 'offset' in child:
+                    data_offset = int(child['offset'])
+                character_encoding = child.get('character_encoding')
+        if length_type is None:
+            raise ValueError('var data type %s has no length' % data_definition['type'])
+        length_offset = int(length_type.get('offset', '0'))
+        unpack_fmt = endian + ('%dx' % length_offset if length_offset else '') + \
+            self.primitive_type_map[length_type['primitive_type']][0]
+
+        return VarDataMessageField(name=convert_to_underscore(data_definition['name']),
+                                   original_name=data_definition['name'], id=data_definition['id'],
+                                   description=data_definition.get('description', ''), unpack_fmt=unpack_fmt,
+                                   data_offset=data_offset, character_encoding=character_encoding,
+                                   semantic_type=data_definition.get('semantic_type'),
+                                   since_version=int(data_definition.get('since_version', '0')))
+
+    def _add_data_fields(self, entity, entity_type, endian):
+        # var data fields follow the fields and groups
+        data_fields = []
+        for data_definition in entity.get('data', []):
+            data_field = self._build_data_field(data_definition, endian)
+            data_fields.append(data_field)
+            setattr(entity_type, data_field.name, data_field)
+        setattr(entity_type, 'data_fields', data_fields)
+
     def _add_groups(self, entity, entity_type, endian):
         # Now figure out the message groups
         repeating_groups = []
@@ -398,7 +498,8 @@ class SBESchema(object):
                                                          block_length_field=block_length_field,
                                                          num_in_group_field=num_in_group_field,
                                                          dimension_size=block_field_offset,
-                                                         since_version=group_since_version)
+                                                         since_version=group_since_version,
+                                                         schema_block_length=self._determine_block_length(group_type))
 
             self._add_fields(entity, group_field_offset, group_type, repeating_group, endian, add_header_size=False)
 
@@ -407,29 +508,295 @@ class SBESchema(object):
 
             # handle nested groups
             self._add_groups(group_type, repeating_group, endian)
+            self._add_data_fields(group_type, repeating_group, endian)
 
         setattr(entity_type, 'groups', repeating_groups)
 
+    @staticmethod
+    def _build_block_struct(fields, endian):
+        block_struct, value_indices = block_layout(fields, endian)
+        for field in fields:
+            for part in getattr(field, 'parts', [field]):
+                if getattr(part, 'constant', None) is None:
+                    # overlapping fields have no index, they are unpacked on their own
+                    part.value_index = value_indices.get(id(part))
+        return block_struct
+
+    def _compile_block_layouts(self, entity_type, endian):
+        entity_type.block_struct = self._build_block_struct(entity_type.fields, endian)
+        for group in entity_type.groups:
+            self._compile_block_layouts(group, endian)
+
     def _construct_body(self, message, field_offset, endian):
         message_id = int(message['id'])
         message_type = self.get_message_type(message_id)
         self._add_fields(message_type, field_offset, message, message_type, endian, add_header_size=True)
         self._add_groups(message, message_type, endian)
-
-    def parse(self, xml_file, message_tag="message", types_tag="types", endian='<'):
-        self.type_map = self._parse_types(xml_file, types_tag=types_tag)
-        self.messages = self._parse_messages(xml_file, message_tag=message_tag)
+        self._add_data_fields(message, message_type, endian)
+        # one precompiled struct per message root block and per repeating group block
+        self._compile_block_layouts(message_type, endian)
+        # and one layout per version and block length seen on the wire, built when first seen
+        message_type.header_struct = header_layout(message_type.fields, endian)
+        message_type._layouts = {}
+
+    def _cache_filename(self, cache_dir, xml_data, message_tag, types_tag, endian):
+        # Key on the schema content, the library version and everything that affects the compiled messages
+        cache_key = hashlib.sha1()
+        cache_key.update(xml_data)
+        cache_key.update(repr((__version__, type(self).__name__, self.include_message_size_header,
+                               self.use_description_as_message_name, self.price_mode, message_tag, types_tag,
+                               endian)).encode('UTF-8'))
+        return os.path.join(cache_dir, 'sbe_schema_%s.pickle' % cache_key.hexdigest())
+
+    def _compiled_state(self):
+        message_types = []
+        for message_type in self.message_map.values():
+            message_types.append({
+                'name': message_type.__name__,
+                'message_id': message_type.message_id,
+                'schema_block_length': message_type.schema_block_length,
+                'header_size': message_type.header_size,
+                'block_struct': message_type.block_struct.format if message_type.block_struct else None,
+                'fields': message_type.fields,
+                'groups': message_type.groups,
+                'data_fields': message_type.data_fields,
+            })
+        return {'type_map': self.type_map, 'messages': self.messages, 'message_types': message_types,
+                'schema_id': self.schema_id, 'schema_version': self.schema_version}
+
+    def _restore_compiled_state(self, state):
+        self.type_map = state['type_map']
+        self.messages = state['messages']
+        self.schema_id = state['schema_id']
+        self.schema_version = state['schema_version']
+        self.encoders = {}
+        self.message_map = {}
+        for definition in state['message_types']:
+            block_struct = definition['block_struct']
+            message_type = type(definition['name'], (SBEMessage,), {
+                'message_id': definition['message_id'],
+                'schema_block_length': definition['schema_block_length'],
+                'header_size': definition['header_size'],
+                'block_struct': Struct(block_struct) if block_struct is not None else None,
+                'header_struct': header_layout(definition['fields'], block_struct[0] if block_struct else '<'),
+                '_layouts': {},
+                'fields': definition['fields'],
+                'groups': definition['groups'],
+                'data_fields': definition['data_fields'],
+            })
+            for entity in definition['fields'] + definition['groups'] + definition['data_fields']:
+                setattr(message_type, entity.name, entity)
+            self.message_map[message_type.message_id] = message_type
+        self._parsed_message_map = self.message_map
+
+    def _load_cache(self, cache_filename):
+        try:
+            with open(cache_filename, 'rb') as cache_file:
+                self._restore_compiled_state(pickle.load(cache_file))
+            return True
+        except Exception:
+            # missing, stale or unreadable cache: fall back to parsing the schema
+            return False
+
+    def _save_cache(self, cache_filename):
+        cache_file = None
+        try:
+            cache_dir = os.path.dirname(cache_filename)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # write to a temporary file first so concurrent readers never see a partial cache
+            with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as cache_file:
+                pickle.dump(self._compiled_state(), cache_file, pickle.HIGHEST_PROTOCOL)
+            os.rename(cache_file.name, cache_filename)
+        except Exception:
+            # caching is best effort (e.g. an unwritable directory or a type that can't be pickled)
+            if cache_file is not None and os.path.exists(cache_file.name):
+                os.remove(cache_file.name)
+
+    def parse(self, xml_file, message_tag="message", types_tag="types", endian='<', cache_dir=None,
+              compiled=False):
+        """ Build the message types from an xml schema, given as a file name, bytes or a binary file object
+
+        If cache_dir is given, the compiled schema is cached there (keyed by the schema content, the
+        sbedecoder version and the parse options) and reused by later calls instead of parsing the xml.
+        Only use a cache directory you trust, cached schemas are stored as pickles.
+
+        If compiled is True, the message types are replaced by generated decoders, see compile().  Their
+        messages hold plain values instead of field objects (no .value, .raw_value, .enumerant, ...), so they
+        can't be used with the tools built on field objects: PacketProcessor, mdp.decode and mdp.prettyprinter,
+        SBEParser.parse_to_columns(), projections and encoding, which reject them.
+        """
+        cache_filename = None
+        if cache_dir is not None:
+            xml_file = self._read_schema(xml_file)
+            cache_filename = self._cache_filename(cache_dir, xml_file, message_tag, types_tag, endian)
+            if self._load_cache(cache_filename):
+                if compiled:
+                    self.compile()
+                return
+
+        self.type_map, self.messages = self._parse_definitions(xml_file, message_tag=message_tag,
+                                                               types_tag=types_tag)
 
         # Now construct each message with its expected field types
         for message in self.messages:
             field_offset = self._construct_header(message)
             self._construct_body(message, field_offset, endian)
+        self._parsed_message_map = self.message_map
+        self.encoders = {}
+
+        if cache_filename is not None:
+            self._save_cache(cache_filename)
+
+        if compiled:
+            self.compile()
+
+    def compile(self):
+        """ Replace the message types with generated decoders (see sbedecoder.codegen)
+
+        Compiled messages decode all their values when parsed: fields are plain attributes holding what
+        field.value would return, repeating groups are tuples of entries, and messages can be stored.
+        """
+        self.message_map = dict((m.message_id, m) for m in compile_messages(self))
+        self.compiled = True
+
+    def project(self, template_id, root=(), groups=None, named=True):
+        """ Register a decoder of only the given fields of a template, see SBEParser.parse_projections()
+
+        root lists the message fields to decode and groups maps repeating group names (nested groups are
+        named 'outer.inner') to the fields to decode in each of their entries, e.g.:
+
+            schema.project(32, root=['transact_time'], groups={'no_md_entries': ['security_id', 'md_entry_px']})
+
+        The decoder returns a namedtuple (or a tuple if named is False) of the field values followed by a
+        tuple of entries for each projected group.  It is also returned, and is called as
+        decoder(msg_buffer, msg_offset).
+        """
+        message_type = self.get_message_type(template_id)
+        if message_type is None:
+            raise ValueError('unknown template id %s' % template_id)
+        if not hasattr(message_type, 'fields'):
+            raise ValueError('projections require the message types of a parsed (not compiled) schema')
+        projection = compile_projection(message_type, root, groups, named)
+        self.projections[template_id] = projection
+        return projection
+
+    def get_encoder(self, template_id):
+        """ Return the MessageEncoder of a template (see encode()), built on first use """
+        encoder = self.encoders.get(template_id)
+        if encoder is None:
+            message_type = self._parsed_message_map.get(template_id)
+            if message_type is None:
+                raise ValueError('unknown template id %s' % template_id)
+            if not hasattr(message_type, 'fields'):
+                message_type = message_type()  # generated message classes set up their fields when built
+            if not hasattr(message_type, 'fields'):
+                raise ValueError('encoding requires the message types of a parsed (not compiled) schema')
+            encoder = MessageEncoder(message_type, self.schema_id, self.schema_version)
+            self.encoders[template_id] = encoder
+        return encoder
+
+    def encode(self, template_id, fields=None, groups=None):
+        """ Return the encoding of a message as a bytearray
+
+        fields maps field names to their values, in the form decoding returns them (e.g. a float or Decimal
+        price, an enum description or enumerant name, a string or a list of set choices), and groups maps
+        repeating group names to lists of entries, each entry a dict of field values (and of its nested
+        groups' entries), e.g.:
+
+            schema.encode(42, {'transact_time': 1500000000000000000, 'match_event_indicator': ['EndOfEvent']},
+                          {'no_md_entries': [{'md_entry_px': 2432.5, 'md_entry_size': 3, 'security_id': 1000}]})
+
+        Fields left out are encoded as their null value (or zero), the header fields are filled in.
+        """
+        return self.get_encoder(template_id).encode(fields, groups)
+
+    def encode_into(self, msg_buffer, offset, template_id, fields=None, groups=None):
+        """ Same as encode() but writes the message into msg_buffer at offset, returning its size """
+        return self.get_encoder(template_id).encode_into(msg_buffer, offset, fields, groups)
 
     def load(self, messages):
         self.messages = messages
+        self.compiled = any(getattr(m, 'compiled', False) for m in messages)
         self.message_map = dict((m.message_id, m) for m in messages)
+        self._parsed_message_map = self.message_map
+        self.encoders = {}
+
+
+class SBESchemaRegistry(object):
+    """ Several schemas (or versions of a schema) decoded by a single parser
+
+    Used in place of a schema by the message factories, the registry dispatches messages on the schema id,
+    version and template id of their header: messages are decoded with the message types of the oldest
+    registered version of their schema that is at least as recent as the message, or of the latest one for
+    newer messages.
+
+        registry = SBESchemaRegistry([mdp_schema_v9, mdp_schema_v13, other_schema])
+        parser = SBEParser(MDPMessageFactory(registry))
+
+    All the schemas must agree on include_message_size_header, the framing of the messages.
+    """
+    def __init__(self, schemas=()):
+        self.schemas = {}  # (schema id, version) -> schema
+        self.include_message_size_header = None
+        self.dispatch = {}  # (schema id, version, template id) -> message type
+        self._latest = {}  # schema id -> schema of its latest version
+        for schema in schemas:
+            self.add(schema)
+
+    def add(self, schema, schema_id=None, version=None):
+        """ Register a schema under its id and version (those of its messageSchema unless given) """
+        schema_id = schema.schema_id if schema_id is None else schema_id
+        version = (schema.schema_version or 0) if version is None else version
+        if schema_id is None:
+            raise ValueError('the schema has no id to register it under')
+        if self.include_message_size_header is None:
+            self.include_message_size_header = schema.include_message_size_header
+        elif schema.include_message_size_header != self.include_message_size_header:
+            raise ValueError('the schemas of a registry must all use (or not use) the message size header')
+        self.schemas[(schema_id, version)] = schema
+        self._build_dispatch()
+
+    def _build_dispatch(self):
+        dispatch = {}
+        latest = {}
+        for schema_id, version in sorted(self.schemas, reverse=True):
+            # walking down the versions, each one covers the message versions down to the previous one
+            schema = self.schemas[(schema_id, version)]
+            latest.setdefault(schema_id, schema)
+            previous = max([v for i, v in self.schemas if i == schema_id and v < version] or [-1])
+            for message_version in range(previous + 1, version + 1):
+                for template_id in schema.message_map:
+                    dispatch[(schema_id, message_version, template_id)] = schema.get_message_type(template_id)
+        self.dispatch = dispatch
+        self._latest = latest
+
+    @property
+    def compiled(self):
+        return any(schema.compiled for schema in self.schemas.values())
+
+    def get_schema(self, schema_id, version=None):
+        """ Return the schema decoding the messages of a schema id and version, or None """
+        for registered_version in sorted(v for i, v in self.schemas if i == schema_id):
+            if version is not None and registered_version >= version:
+                return self.schemas[(schema_id, registered_version)]
+        return self._latest.get(schema_id)
+
+    def get_message_type(self, template_id, schema_id=None, version=None):
+        message_type = self.dispatch.get((schema_id, version, template_id))
+        if message_type is None:
+            # a message newer than the registered versions
+            schema = self._latest.get(schema_id)
+            if schema is not None:
+                message_type = schema.get_message_type(template_id)
+        return message_type
+
+    def get_projection(self, template_id, schema_id=None):
+        schema = self._latest.get(schema_id)
+        return schema.get_projection(template_id) if schema is not None else None
 
 
 class MDPSchema(SBESchema):
-    def __init__(self):
-        super(MDPSchema, self).__init__(include_message_size_header=True, use_description_as_message_name=True)
+    def __init__(self, price_mode='float'):
+        super(MDPSchema, self).__init__(include_message_size_header=True, use_description_as_message_name=True,
+                                        price_mode=price_mode)
@@ -55,6 +55,9 @@ def process_command_line():
     parser.add_argument('-s', '--schema', default='templates_FixBinary.xml',
         help='Name of the SBE schema xml file')
 
+    parser.add_argument('--schema-cache-dir',
+        help='Directory used to cache the compiled schema between runs')
+
     default_skip_fields = 'message_size,block_length,template_id,schema_id,version'
 
     parser.add_argument('-f', '--skip-fields', default=default_skip_fields,
@@ -83,7 +86,7 @@ def main(argv=None):
 
     # Read in the schema xml as a dictionary and construct the various schema objects
     mdp_schema = MDPSchema()
-    mdp_schema.parse(args.schema)
+    mdp_schema.parse(args.schema, cache_dir=args.schema_cache_dir)
     msg_factory = MDPMessageFactory(mdp_schema)
     mdp_parser = SBEParser(msg_factory)
 
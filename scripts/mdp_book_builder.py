@@ -6,13 +6,14 @@ Build and display orderbooks from a given pcap file
 
 import sys
 import os.path
-import gzip
-
-import dpkt
 import binascii
+from functools import partial
 
+from mdp.pcap import PcapReader
 from mdp.secdef import SecDef
 from mdp.orderbook import PacketProcessor
+from mdp.orderbook import OrderBook
+from mdp.orderbook import ArrayOrderBook
 from mdp.orderbook import ConsolePrinter
 
 from sbedecoder import MDPSchema
@@ -20,43 +21,43 @@ from sbedecoder import MDPMessageFactory
 from sbedecoder import SBEParser
 
 
-def process_file(args, pcap_filename, security_id_filter=None, print_data=False):
-    mdp_schema = MDPSchema()
+def process_file(args, pcap_filename, security_id_filter=None, print_data=False, channels=None):
+    mdp_schema = MDPSchema(price_mode='fixed' if args.fixed_point_prices else 'float')
     # Read in the schema xml as a dictionary and construct the various schema objects
     try:
         from sbedecoder.generated import __messages__ as generated_messages
         mdp_schema.load(generated_messages)
     except:
-        mdp_schema.parse(args.schema)
+        mdp_schema.parse(args.schema, cache_dir=args.schema_cache_dir)
 
     msg_factory = MDPMessageFactory(mdp_schema)
     mdp_parser = SBEParser(msg_factory)
 
     secdef = SecDef()
-    secdef.load(args.secdef)
-
-    book_builder = PacketProcessor(mdp_parser, secdef, security_id_filter=security_id_filter)
+    if args.instruments:
+        with PcapReader(args.instruments) as instruments_reader:
+            secdef.load_packets(mdp_parser, (packet for _, packet in instruments_reader))
+    else:
+        secdef.load(args.secdef, security_ids=security_id_filter, index_filename=args.secdef_index)
+
+    orderbook_class = OrderBook
+    if args.array_books:
+        orderbook_class = partial(ArrayOrderBook, integer_prices=args.fixed_point_prices)
+    book_builder = PacketProcessor(mdp_parser, secdef, security_id_filter=security_id_filter, channels=channels,
+        orderbook_class=orderbook_class)
 
     console_printer = ConsolePrinter()
     book_builder.orderbook_handler = console_printer
 
-    with gzip.open(pcap_filename, 'rb') if pcap_filename.endswith('.gz') else open(pcap_filename, 'rb') as pcap:
-        pcap_reader = dpkt.pcap.Reader(pcap)
-        packet_number = 0
-        for ts, packet in pcap_reader:
-            packet_number += 1
-            ethernet = dpkt.ethernet.Ethernet(packet)
-            if ethernet.type == dpkt.ethernet.ETH_TYPE_IP:
-                ip = ethernet.data
-                if ip.p == dpkt.ip.IP_PROTO_UDP:
-                    udp = ip.data
-                    data = udp.data
-                    try:
-                        if print_data:
-                            print('data: {}'.format(binascii.b2a_hex(data)))
-                        book_builder.handle_packet(int(ts*1000000), data)
-                    except Exception as e:
-                        print('Error decoding e:{} message:{}'.format(e, binascii.b2a_hex(data)))
+    with PcapReader(pcap_filename) as pcap_reader:
+        for ts, destination, data in pcap_reader.datagrams():
+            try:
+                if print_data:
+                    print('data: {}'.format(binascii.b2a_hex(data)))
+                book_builder.handle_packet(int(ts*1000000) if ts is not None else None, data, destination)
+            except Exception as e:
+                print('Error decoding e:{} message:{}'.format(e, binascii.b2a_hex(data)))
+        book_builder.flush()
 
 
 def process_command_line():
@@ -71,24 +72,56 @@ def process_command_line():
     parser.add_argument('-s', '--schema', default='templates_FixBinary.xml',
         help='Name of the SBE schema xml file')
 
+    parser.add_argument('--schema-cache-dir',
+        help='Directory used to cache the compiled schema between runs')
+
     parser.add_argument('-d', '--secdef', default='secdef.dat.gz',
         help='Name of the security definition file')
 
+    parser.add_argument('--secdef-index',
+        help='Index of the security definition file, built (or rebuilt if the file changed) and reused so that '
+             'only the securities seen are loaded')
+
+    parser.add_argument('--instruments', metavar='PCAP',
+        help='Capture of the instrument channel to load the security definitions from, instead of the security '
+             'definition file.  Instrument definitions in the capture processed are always applied.')
+
     parser.add_argument('-i', '--ids', default='',
         help='Comma separated list of security ids to display books for')
 
     parser.add_argument("--print-data", action='store_true',
         help="Print the data as an ascii hex string (default: %(default)s)")
 
+    parser.add_argument('--array-books', action='store_true',
+        help='Store the book levels in arrays rather than in an object per level (default: %(default)s)')
+
+    parser.add_argument('--fixed-point-prices', action='store_true',
+        help='Keep prices as integers (the price mantissas) rather than floats (default: %(default)s)')
+
+    parser.add_argument('--feed', action='append', default=[], metavar='CHANNEL=ADDRESS:PORT',
+        help='Multicast feed of a channel, e.g. --feed 310=224.0.31.1:14310 --feed 310=224.0.32.1:15310 to '
+             'arbitrate the A and B feeds of channel 310 (by default each destination is its own channel)')
+
     args = parser.parse_args()
 
     # check number of arguments, verify values, etc.:
     if not os.path.isfile(args.schema):
         parser.error('sbe schema xml file "{}" not found'.format(args.schema))
 
-    if not os.path.isfile(args.secdef):
+    if args.instruments and not os.path.isfile(args.instruments):
+        parser.error('Instrument channel capture "{}" not found'.format(args.instruments))
+
+    if not args.instruments and not os.path.isfile(args.secdef):
         parser.error('Security definition file "{}" not found'.format(args.secdef))
 
+    args.channels = {}
+    for feed in args.feed:
+        try:
+            channel, destination = feed.split('=')
+            address, port = destination.split(':')
+            args.channels[(address, int(port))] = channel
+        except ValueError:
+            parser.error('invalid feed "{}", expected CHANNEL=ADDRESS:PORT'.format(feed))
 
     return args
 
@@ -98,7 +131,7 @@ def main(argv=None):
     security_id_filter = None
     if args.ids:
         security_id_filter = [int(x.strip().lstrip()) for x in args.ids.split(',')]
-    process_file(args, args.pcapfile, security_id_filter, args.print_data)
+    process_file(args, args.pcapfile, security_id_filter, args.print_data, args.channels)
     return 0  # success
 
 
@@ -12,28 +12,49 @@ from sbedecoder import SBEParser
 import mdp.prettyprinter
 import mdp.secdef
 import mdp.decode
-import gzip
-import dpkt
+from mdp.parallel import parallel_decode
+from mdp.pcap import PcapReader
 from datetime import datetime
+from functools import partial
+import six
 
 
 def process_file(pcap_filename, mdp_parser, secdef, pretty_print, print_data, skip_fields):
-    with gzip.open(pcap_filename, 'rb') if pcap_filename.endswith('.gz') else open(pcap_filename, 'rb') as pcap:
-        pcap_reader = dpkt.pcap.Reader(pcap)
+    with PcapReader(pcap_filename) as pcap_reader:
         packet_number = 0
-        for ts, packet in pcap_reader:
+        for ts, data in pcap_reader:
             packet_number += 1
-            ethernet = dpkt.ethernet.Ethernet(packet)
-            if ethernet.type == dpkt.ethernet.ETH_TYPE_IP:
-                ip = ethernet.data
-                if ip.p == dpkt.ip.IP_PROTO_UDP:
-                    udp = ip.data
-                    try:
-                        timestamp = datetime.fromtimestamp(ts)
-                        mdp.decode.decode_packet(mdp_parser, timestamp, udp.data, skip_fields,
-                            print_data, pretty_print, secdef, packet_number)
-                    except Exception as e:
-                        print('Error parsing packet #{} - {}'.format(packet_number, e))
+            try:
+                timestamp = datetime.fromtimestamp(ts) if ts is not None else None
+                mdp.decode.decode_packet(mdp_parser, timestamp, data, skip_fields,
+                    print_data, pretty_print, secdef, packet_number)
+            except Exception as e:
+                print('Error parsing packet #{} - {}'.format(packet_number, e))
+
+
+def build_parser(schema_filename, schema_cache_dir):
+    mdp_schema = MDPSchema()
+    mdp_schema.parse(schema_filename, cache_dir=schema_cache_dir)
+    msg_factory = MDPMessageFactory(mdp_schema)
+    return SBEParser(msg_factory)
+
+
+def format_packet(secdef, pretty_print, print_data, skip_fields, mdp_parser, ts, data):
+    # the packet is printed to a string so that the output can be printed in capture order
+    output = six.StringIO()
+    try:
+        timestamp = datetime.fromtimestamp(ts) if ts is not None else None
+        mdp.decode.decode_packet(mdp_parser, timestamp, data, skip_fields,
+            print_data, pretty_print, secdef, '', out=output)
+    except Exception as e:
+        output.write(u'Error parsing packet - {}\n'.format(e))
+    return output.getvalue()
+
+
+def process_file_parallel(pcap_filename, parser_factory, secdef, pretty_print, print_data, skip_fields, processes):
+    handler = partial(format_packet, secdef, pretty_print, print_data, skip_fields)
+    for output in parallel_decode(pcap_filename, parser_factory, handler, processes=processes):
+        sys.stdout.write(output)
 
 
 def process_command_line():
@@ -48,6 +69,9 @@ def process_command_line():
     parser.add_argument("-s", "--schema", default='templates_FixBinary.xml',
         help="Name of the SBE schema xml file")
 
+    parser.add_argument("--schema-cache-dir",
+        help="Directory used to cache the compiled schema between runs")
+
     default_skip_fields = 'message_size,block_length,template_id,schema_id,version'
 
     parser.add_argument("-f", "--skip-fields", default=default_skip_fields,
@@ -62,6 +86,9 @@ def process_command_line():
     parser.add_argument('--secdef',
         help='Name of the security definition file for augmenting logs with symbols')
 
+    parser.add_argument('-j', '--processes', type=int, default=1,
+        help='Number of processes decoding the pcap file, 0 for one per cpu (default: %(default)s)')
+
     args = parser.parse_args()
 
     # check number of arguments, verify values, etc.:
@@ -74,12 +101,6 @@ def process_command_line():
 def main(argv=None):
     args = process_command_line()
 
-    # Read in the schema xml as a dictionary and construct the various schema objects
-    mdp_schema = MDPSchema()
-    mdp_schema.parse(args.schema)
-    msg_factory = MDPMessageFactory(mdp_schema)
-    mdp_parser = SBEParser(msg_factory)
-
     secdef = None
     if args.secdef:
         secdef = mdp.secdef.SecDef()
@@ -87,7 +108,13 @@ def main(argv=None):
 
     skip_fields = set(args.skip_fields.split(','))
 
-    process_file(args.pcapfile, mdp_parser, secdef, args.pretty, args.print_data, skip_fields)
+    # Read in the schema xml as a dictionary and construct the various schema objects
+    parser_factory = partial(build_parser, args.schema, args.schema_cache_dir)
+    if args.processes == 1:
+        process_file(args.pcapfile, parser_factory(), secdef, args.pretty, args.print_data, skip_fields)
+    else:
+        process_file_parallel(args.pcapfile, parser_factory, secdef, args.pretty, args.print_data, skip_fields,
+            args.processes or None)
     return 0  # success
 
 
@@ -1,3 +1,4 @@
+import re
 from setuptools import setup
 from os import path
 
@@ -7,9 +8,13 @@ here = path.abspath(path.dirname(__file__))
 with open(path.join(here, 'README.md')) as f:
     long_description = f.read()
 
+# The version is defined once, in the package (read without importing it, its dependencies may be missing)
+with open(path.join(here, 'sbedecoder', '__init__.py')) as f:
+    version = re.search(r"^__version__ = '([^']+)'", f.read(), re.M).group(1)
+
 setup(
     name="sbedecoder",
-    version="0.1.8",
+    version=version,
     author="TradeForecaster Global Markets, LLC",
     author_email="github@tradeforecaster.com",
     description="Simple Binary Encoding (SBE) decoder (handles CME MDP3 messages)",
@@ -20,7 +25,7 @@ setup(
     url="https://github.com/tfgm/sbedecoder",
     packages=['sbedecoder', 'mdp', 'mdp.orderbook'],
     scripts=['scripts/mdp_decoder.py', 'scripts/mdp_base64_decoder.py', 'scripts/mdp_book_builder.py'],
-    install_requires=['dpkt', 'lxml', 'six'],
+    install_requires=['lxml', 'six', 'enum34; python_version < "3.4"'],
     classifiers=[
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 2',
@@ -0,0 +1,6 @@
+import sys
+
+collect_ignore = []
+if sys.version_info < (3, 5):
+    # mdp.receiver and its tests use asyncio (and async def)
+    collect_ignore.append('test_receiver.py')
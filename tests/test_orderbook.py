@@ -1,19 +1,23 @@
 #!/usr/bin/env python
 
 import pytest
+import six
 
+from mdp.orderbook import ArrayOrderBook
+from mdp.orderbook import BID, OFFER, NEW, CHANGE, DELETE
 from mdp.orderbook import OrderBook
+from mdp.orderbook.orderbook import INT64_TYPECODE
 
 
-@pytest.fixture()
-def book():
-    book = OrderBook(9999, 3, 'TEST')
-    book.change(3, 'Offer', 8, 8, 8)
-    book.change(2, 'Offer', 7, 7, 7)
-    book.change(1, 'Offer', 6, 6, 6)
-    book.change(1, 'Bid', 3, 3, 3)
-    book.change(2, 'Bid', 2, 2, 2)
-    book.change(3, 'Bid', 1, 1, 1)
+@pytest.fixture(params=[OrderBook, ArrayOrderBook])
+def book(request):
+    book = request.param(9999, 3, 'TEST')
+    book.change(3, OFFER, 8, 8, 8)
+    book.change(2, OFFER, 7, 7, 7)
+    book.change(1, OFFER, 6, 6, 6)
+    book.change(1, BID, 3, 3, 3)
+    book.change(2, BID, 2, 2, 2)
+    book.change(3, BID, 1, 1, 1)
 
     book.instrument_sequence = 0
 
@@ -22,8 +26,8 @@ def book():
 
 def test_adding_level_1_entries(book):
     # def add(self, level, side, price, size, num_orders):
-    book.add(1, 'Offer', 5, 5, 5)
-    book.add(1, 'Bid', 4, 4, 4)
+    book.add(1, OFFER, 5, 5, 5)
+    book.add(1, BID, 4, 4, 4)
 
     assert book.offers[0].price == 5
     assert book.offers[2].price == 7
@@ -34,8 +38,8 @@ def test_adding_level_1_entries(book):
 
 def test_adding_level_3_entries(book):
     # def add(self, level, side, price, size, num_orders):
-    book.add(3, 'Offer', 9, 9, 9)
-    book.add(3, 'Bid', 0, 0, 0)
+    book.add(3, OFFER, 9, 9, 9)
+    book.add(3, BID, 0, 0, 0)
 
     assert book.offers[0].price == 6
     assert book.offers[2].price == 9
@@ -46,8 +50,8 @@ def test_adding_level_3_entries(book):
 
 def test_deleting_level_1_entries(book):
     # def add(self, level, side, price, size, num_orders):
-    book.delete(1, 'Offer')
-    book.delete(1, 'Bid')
+    book.delete(1, OFFER)
+    book.delete(1, BID)
 
     assert book.offers[0].price == 7
     assert book.offers[2].price is None
@@ -58,8 +62,8 @@ def test_deleting_level_1_entries(book):
 
 def test_deleting_level_3_entries(book):
     # def add(self, level, side, price, size, num_orders):
-    book.delete(3, 'Offer')
-    book.delete(3, 'Bid')
+    book.delete(3, OFFER)
+    book.delete(3, BID)
 
     assert book.offers[0].price == 6
     assert book.offers[2].price is None
@@ -69,12 +73,12 @@ def test_deleting_level_3_entries(book):
 
 
 def test_change(book):
-    book.change(3, 'Offer', 8, 8, 8)
+    book.change(3, OFFER, 8, 8, 8)
     assert book.offers[2].price == 8
     assert book.offers[2].size == 8
     assert book.offers[2].num_orders == 8
 
-    book.change(1, 'Bid', 4, 4, 4)
+    book.change(1, BID, 4, 4, 4)
     assert book.bids[0].price == 4
     assert book.bids[0].size == 4
     assert book.bids[0].num_orders == 4
@@ -87,8 +91,8 @@ def test_update_book_change(book):
         stream_sequence=1,
         instrument_sequence=1,
         level=3,
-        md_entry_type='Offer',
-        md_update_action='Change',
+        md_entry_type=OFFER,
+        md_update_action=CHANGE,
         price=8,
         size=8,
         num_orders=8
@@ -102,7 +106,7 @@ def test_update_book_change(book):
     assert book.offers[2].size == 8
     assert book.offers[2].num_orders == 8
 
-    book.handle_update(101, 102, 2, 2, 1, 'Bid', 'Change', 4, 4, 4)
+    book.handle_update(101, 102, 2, 2, 1, BID, CHANGE, 4, 4, 4)
 
     assert book.bids[0].price == 4
     assert book.bids[0].size == 4
@@ -114,7 +118,7 @@ def test_update_book_change(book):
 
 
 def test_update_book_add(book):
-    book.handle_update(101, 102, 1, 1, 1, 'Offer', 'New', 5, 5, 5)
+    book.handle_update(101, 102, 1, 1, 1, OFFER, NEW, 5, 5, 5)
 
     assert book.offers[0].price == 5
     assert book.offers[0].size == 5
@@ -124,7 +128,7 @@ def test_update_book_add(book):
     assert book.offers[2].size == 7
     assert book.offers[2].num_orders == 7
 
-    book.handle_update(101, 102, 2, 2, 1, 'Bid', 'New', 4, 4, 4)
+    book.handle_update(101, 102, 2, 2, 1, BID, NEW, 4, 4, 4)
 
     assert book.bids[0].price == 4
     assert book.bids[0].size == 4
@@ -136,14 +140,14 @@ def test_update_book_add(book):
 
 
 def test_update_book_delete(book):
-    book.handle_update(101, 102, 1, 1, 1, 'Offer', 'Delete', None, None, None)
+    book.handle_update(101, 102, 1, 1, 1, OFFER, DELETE, None, None, None)
 
     assert book.offers[0].price == 7
     assert book.offers[0].size == 7
     assert book.offers[0].num_orders == 7
     assert book.offers[2].price is None
 
-    book.handle_update(101, 102, 2, 2, 1, 'Bid', 'Delete', None, None, None)
+    book.handle_update(101, 102, 2, 2, 1, BID, DELETE, None, None, None)
     assert book.bids[0].price == 2
     assert book.bids[0].size == 2
     assert book.bids[0].num_orders == 2
@@ -152,8 +156,8 @@ def test_update_book_delete(book):
 
 def test_update_book_old_sequence(book):
     book.instrument_sequence = 99
-    book.handle_update(101, 102, 100, 100, 1, 'Offer', 'New', 5, 5, 5)
-    book.handle_update(101, 102, 99, 99, 1, 'Offer', 'New', 999, 999, 999)
+    book.handle_update(101, 102, 100, 100, 1, OFFER, NEW, 5, 5, 5)
+    book.handle_update(101, 102, 99, 99, 1, OFFER, NEW, 999, 999, 999)
 
     assert book.offers[0].price == 5
     assert book.offers[0].size == 5
@@ -164,8 +168,8 @@ def test_update_book_old_sequence(book):
     assert book.offers[2].num_orders == 7
 
     book.instrument_sequence = 99
-    book.handle_update(101, 102, 100, 100, 1, 'Bid', 'New', 4, 4, 4)
-    book.handle_update(101, 102, 99, 99, 1, 'Bid', 'New', 999, 999, 999)
+    book.handle_update(101, 102, 100, 100, 1, BID, NEW, 4, 4, 4)
+    book.handle_update(101, 102, 99, 99, 1, BID, NEW, 999, 999, 999)
 
     assert book.bids[0].price == 4
     assert book.bids[0].size == 4
@@ -177,8 +181,8 @@ def test_update_book_old_sequence(book):
 
 
 def test_update_book_duplicate_sequence(book):
-    book.handle_update(101, 102, 1, 1, 1, 'Offer', 'New', 5, 5, 5)
-    book.handle_update(101, 102, 1, 1, 1, 'Offer', 'New', 999, 999, 999)
+    book.handle_update(101, 102, 1, 1, 1, OFFER, NEW, 5, 5, 5)
+    book.handle_update(101, 102, 1, 1, 1, OFFER, NEW, 999, 999, 999)
 
     assert book.offers[0].price == 5
     assert book.offers[0].size == 5
@@ -188,8 +192,8 @@ def test_update_book_duplicate_sequence(book):
     assert book.offers[2].size == 7
     assert book.offers[2].num_orders == 7
 
-    book.handle_update(101, 102, 2, 2, 1, 'Bid', 'New', 4, 4, 4)
-    book.handle_update(101, 102, 2, 2, 1, 'Bid', 'New', 999, 999, 999)
+    book.handle_update(101, 102, 2, 2, 1, BID, NEW, 4, 4, 4)
+    book.handle_update(101, 102, 2, 2, 1, BID, NEW, 999, 999, 999)
 
     assert book.bids[0].price == 4
     assert book.bids[0].size == 4
@@ -202,10 +206,10 @@ def test_update_book_duplicate_sequence(book):
 
 def test_update_book_gapped(book):
     """
-    book.handle_update(101, 102, 1, 1, 3, 'Offer', 'Change', 8, 8, 8)
-    book.handle_update(101, 102, 1, 2, 2, 'Offer', 'Change', 7, 7, 7)
-    book.handle_update(101, 102, 1, 3, 1, 'Offer', 'Change', 6, 6, 6)
-    book.handle_update(101, 102, 99, 99, 1, 'Offer', 'Change', 999, 999, 999)
+    book.handle_update(101, 102, 1, 1, 3, OFFER, CHANGE, 8, 8, 8)
+    book.handle_update(101, 102, 1, 2, 2, OFFER, CHANGE, 7, 7, 7)
+    book.handle_update(101, 102, 1, 3, 1, OFFER, CHANGE, 6, 6, 6)
+    book.handle_update(101, 102, 99, 99, 1, OFFER, CHANGE, 999, 999, 999)
 
     assert_equals(book.offers[0].price, 999)
     assert_equals(book.offers[0].size, 999)
@@ -221,3 +225,35 @@ def test_update_book_gapped(book):
     """
 
     pass  # not ready for testing gaps until we handle more messages
+
+
+def test_array_orderbook_levels():
+    book = ArrayOrderBook(9999, 3, 'TEST')
+    book.add(1, BID, 3.5, 3, None)
+    book.add(5, BID, 1, 1, 1)  # beyond the depth of the book
+    assert [(entry.price, entry.size, entry.num_orders) for entry in book.bids] == \
+        [(3.5, 3, None), (None, None, None), (None, None, None)]
+
+    book.add(2, BID, 2.5, 2, 2)
+    book.add(3, BID, 1.5, 1, 1)
+    book.delete(5, BID)  # beyond the depth of the book
+    assert [entry.price for entry in book.bids] == [3.5, 2.5, 1.5]
+    book.delete(1, BID)
+    assert [(entry.price, entry.size, entry.num_orders) for entry in book.bids] == \
+        [(2.5, 2, 2), (1.5, 1, 1), (None, None, None)]
+
+    bids = book.bids
+    book.invalidate()
+    assert book.bids is bids
+    assert book.bids[0].price is None
+    assert len(book.offers) == 3
+
+
+def test_array_orderbook_integer_prices():
+    book = ArrayOrderBook(9999, 2, 'TEST', integer_prices=True)
+    book.add(1, OFFER, 98890000000, 3, 1)
+    assert book.offers.prices.typecode == INT64_TYPECODE
+    assert book.offers[0].price == 98890000000
+    if INT64_TYPECODE != 'd':
+        assert isinstance(book.offers[0].price, six.integer_types)
+    assert book.offers[1].price is None
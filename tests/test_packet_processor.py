@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+from struct import pack
+
+from mdp.orderbook import PacketProcessor
+from mdp.orderbook import NEW, CHANGE, DELETE
+from mdp.orderbook import StreamSequence
+
+
+class RecordingParser(object):
+    def __init__(self):
+        self.packets = []
+
+    def parse(self, mdp_packet, offset=0, template_ids=None):
+        self.packets.append(bytes(bytearray(mdp_packet[:4])))
+        return []
+
+
+class GapRecorder(object):
+    def __init__(self):
+        self.gaps = []
+
+    def on_gap(self, channel, first_sequence_number, last_sequence_number):
+        self.gaps.append((channel, first_sequence_number, last_sequence_number))
+
+
+def packet(sequence_number):
+    return pack('<iQ', sequence_number, 1000 + sequence_number)
+
+
+def test_stream_sequence():
+    stream = StreamSequence(window=4)
+    assert stream.accept(10, 'a') == ([(10, 'a')], ())
+    assert stream.accept(10, 'b') == ((), ())
+    assert stream.accept(12, 'a') == ([], [])  # held until 11 arrives
+    assert stream.accept(11, 'b') == ([(11, 'b'), (12, 'a')], ())  # filled in within the window
+    assert stream.accept(15, 'a') == ([], [])
+    assert stream.accept(16, 'a') == ([], [])
+    assert stream.accept(17, 'a') == ([], [(13, 13)])  # never received
+    assert stream.accept(18, 'a') == ([(15, 'a'), (16, 'a'), (17, 'a'), (18, 'a')], [(14, 14)])
+    assert stream.accept(13, 'b') == ((), ())  # too late, outside the window
+    assert stream.accept(30, 'a') == ([], [(19, 26)])
+    assert stream.flush() == ([(30, 'a')], [(27, 29)])
+    assert stream.duplicates == 2
+
+
+def test_arbitrate_feeds():
+    parser = RecordingParser()
+    gaps = GapRecorder()
+    channels = {('224.0.31.1', 14310): 310, ('224.0.32.1', 15310): 310}
+    processor = PacketProcessor(parser, None, channels=channels, window=4)
+    processor.orderbook_handler = gaps
+
+    feed_a = [1, 2, 4, 5, 9]
+    feed_b = [1, 2, 3, 5, 6, 9]
+    for sequence_number in sorted(feed_a + feed_b):
+        destination = ('224.0.31.1', 14310) if sequence_number in feed_a else ('224.0.32.1', 15310)
+        processor.handle_packet(0, packet(sequence_number), destination)
+    processor.handle_packet(0, packet(1), ('224.0.33.1', 16310))  # another channel
+    processor.flush()
+
+    # 9 is held until 7 and 8 are given up on, when flushing
+    assert [pack('<i', n) for n in [1, 2, 3, 4, 5, 6, 1, 9]] == parser.packets
+    assert gaps.gaps == [(310, 7, 8)]
+    assert processor.stream_sequences[310].duplicates == 4
+
+
+def test_single_stream():
+    parser = RecordingParser()
+    processor = PacketProcessor(parser, None)
+    for sequence_number in [1, 2, 2, 3]:
+        processor.handle_packet(0, packet(sequence_number))
+    assert len(parser.packets) == 3
+    assert processor.stream_sequence_number == 3
+    assert processor.sending_time == 1003
+
+
+def test_fill_in_after_later_packet():
+    parser = RecordingParser()
+    channels = {'A': 310, 'B': 310}
+    processor = PacketProcessor(parser, None, channels=channels, window=4)
+    processor.orderbook_handler = gaps = GapRecorder()
+
+    stream_sequence_numbers = []
+    buffer = bytearray(12)  # reused for every packet, like the ring of a receiver
+    for sequence_number, feed in [(1, 'A'), (2, 'A'), (4, 'A'), (5, 'A'), (3, 'B'), (4, 'B'), (6, 'A')]:
+        buffer[:] = packet(sequence_number)
+        processor.handle_packet(0, memoryview(buffer), feed)
+        stream_sequence_numbers.append(processor.stream_sequence_number)
+
+    # 4 and 5 are held until B fills in 3, then all of them are processed in order
+    assert [pack('<i', n) for n in [1, 2, 3, 4, 5, 6]] == parser.packets
+    assert stream_sequence_numbers == [1, 2, 2, 2, 5, 5, 6]
+    assert processor.sending_time == 1006
+    assert gaps.gaps == []
+
+    for sequence_number in [8, 9, 10, 11]:
+        processor.handle_packet(0, packet(sequence_number), 'A')
+    # 7 is given up on once 4 packets were received past it, before 8 is processed
+    assert gaps.gaps == [(310, 7, 7)]
+    assert [pack('<i', n) for n in [8, 9, 10, 11]] == parser.packets[6:]
+
+
+class EnumField(object):
+    name = 'md_update_action'
+
+    def __init__(self, code_to_enum_description):
+        self.code_to_enum_description = code_to_enum_description
+
+
+def test_enum_values():
+    processor = PacketProcessor(RecordingParser(), None)
+    book_v1 = type('BookV1', (object,), {})
+    book_v2 = type('BookV2', (object,), {})
+    actions_v1 = processor.enum_values(book_v1, EnumField({0: 'New', 1: 'Change', 5: 'Overlay'}),
+                                       processor.update_actions)
+    assert actions_v1 == {0: NEW, 1: CHANGE}
+    # a field of the same name in another message type (e.g. of another schema version) has its own codes
+    actions_v2 = processor.enum_values(book_v2, EnumField({3: 'New', 4: 'Delete'}), processor.update_actions)
+    assert actions_v2 == {3: NEW, 4: DELETE}
+    assert processor.enum_values(book_v1, EnumField({}), processor.update_actions) is actions_v1
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+import gzip
+from struct import pack
+
+from mdp.parallel import parallel_decode
+from mdp.pcap import PcapReader, udp_datagrams, udp_payloads
+
+
+def udp_frame(payload, vlan=False, fragment=0):
+    udp = pack('!HHHH', 1234, 14310, 8 + len(payload), 0) + payload
+    ip = pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(udp), 0, fragment, 64, 17, 0, b'\x0a\0\0\x01', b'\xe0\0\0\x01') + udp
+    ethernet = b'\x01\0\x5e\0\0\x01' + b'\0\x1b\x21\0\0\x01'
+    if vlan:
+        ethernet += pack('!HH', 0x8100, 42)
+    frame = ethernet + pack('!H', 0x0800) + ip
+    return frame + b'\0' * max(0, 60 - len(frame))  # short frames are padded on the wire
+
+
+def tcp_frame():
+    ip = pack('!BBHHHBBH4s4s', 0x45, 0, 40, 0, 0, 64, 6, 0, b'\x0a\0\0\x01', b'\x0a\0\0\x02') + b'\0' * 20
+    return b'\0' * 12 + pack('!H', 0x0800) + ip
+
+
+def pcap_file(frames, endian='<', magic=0xa1b2c3d4):
+    data = pack(endian + 'IHHiIII', magic, 2, 4, 0, 0, 65535, 1)
+    for i, frame in enumerate(frames):
+        data += pack(endian + 'IIII', 1500000000 + i, 250000, len(frame), len(frame)) + frame
+    return data
+
+
+def pcapng_block(block_type, body):
+    body += b'\0' * (-len(body) % 4)
+    return pack('<II', block_type, len(body) + 12) + body + pack('<I', len(body) + 12)
+
+
+def pcapng_file(frames):
+    data = pcapng_block(0x0a0d0d0a, pack('<IHHq', 0x1a2b3c4d, 1, 0, -1))
+    options = pack('<HHB3x', 9, 1, 9) + pack('<HH', 0, 0)  # nanosecond timestamps
+    data += pcapng_block(1, pack('<HHI', 1, 0, 65535) + options)
+    for i, frame in enumerate(frames):
+        timestamp = (1500000000 + i) * 1000000000 + 5
+        data += pcapng_block(6, pack('<IIIII', 0, timestamp >> 32, timestamp & 0xffffffff, len(frame), len(frame)) + frame)
+    data += pcapng_block(3, pack('<I', len(frames[0])) + frames[0])
+    return data
+
+
+frames = [udp_frame(b'first'), tcp_frame(), udp_frame(b'second packet', vlan=True), udp_frame(b'frag', fragment=0x2000)]
+
+
+def test_pcap_udp_payloads():
+    for data in (pcap_file(frames), pcap_file(frames, endian='>')):
+        payloads = list(udp_payloads(data))
+        assert [bytes(payload) for _, payload in payloads] == [b'first', b'second packet']
+        assert [timestamp for timestamp, _ in payloads] == [1500000000.25, 1500000002.25]
+        assert all(isinstance(payload, memoryview) for _, payload in payloads)
+
+    nanoseconds = list(udp_payloads(pcap_file(frames, magic=0xa1b23c4d)))
+    assert abs(nanoseconds[0][0] - 1500000000.00025) < 1e-6
+
+
+def test_udp_datagrams():
+    datagrams = list(udp_datagrams(pcap_file(frames)))
+    assert [(destination, bytes(payload)) for _, destination, payload in datagrams] == \
+        [(('224.0.0.1', 14310), b'first'), (('224.0.0.1', 14310), b'second packet')]
+
+
+def test_pcapng_udp_payloads():
+    payloads = list(udp_payloads(pcapng_file(frames)))
+    assert [bytes(payload) for _, payload in payloads] == [b'first', b'second packet', b'first']
+    assert abs(payloads[0][0] - 1500000000.000000005) < 1e-6
+    assert payloads[2][0] is None  # simple packet blocks have no timestamp
+
+
+def test_pcap_reader(tmpdir):
+    filename = str(tmpdir.join('capture.pcap'))
+    with open(filename, 'wb') as pcap:
+        pcap.write(pcap_file(frames))
+    with PcapReader(filename) as reader:
+        assert [bytes(payload) for _, payload in reader] == [b'first', b'second packet']
+
+    gzip_filename = str(tmpdir.join('capture.pcapng.gz'))
+    with gzip.open(gzip_filename, 'wb') as pcap:
+        pcap.write(pcapng_file(frames))
+    with PcapReader(gzip_filename) as reader:
+        assert len(list(reader)) == 3
+
+    empty_filename = str(tmpdir.join('empty.pcap'))
+    open(empty_filename, 'wb').close()
+    with PcapReader(empty_filename) as reader:
+        assert list(reader) == []
+
+
+def packet_parser():
+    return 'parser'
+
+
+def packet_handler(parser, timestamp, packet):
+    return parser, timestamp, bytes(packet)
+
+
+def test_parallel_decode(tmpdir):
+    filename = str(tmpdir.join('capture.pcap'))
+    packets = [udp_frame(('packet %d' % i).encode('ascii')) for i in range(50)]
+    with open(filename, 'wb') as pcap:
+        pcap.write(pcap_file(packets + frames))
+
+    results = list(parallel_decode(filename, packet_parser, packet_handler, processes=3, batch_size=4, max_pending=2))
+    assert [packet for _, _, packet in results] == \
+        [('packet %d' % i).encode('ascii') for i in range(50)] + [b'first', b'second packet']
+    assert all(parser == 'parser' for parser, _, _ in results)
+    assert results[0][1] == 1500000000.25
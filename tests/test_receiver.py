@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import asyncio
+import socket
+from struct import pack
+
+import pytest
+
+from mdp.orderbook import PacketProcessor
+from mdp.receiver import DatagramReader, MDPReceiver
+from mdp import receiver as receiver_module
+
+
+class RecordingHandler(object):
+    def __init__(self):
+        self.packets = []
+
+    def __call__(self, received_time, packet, destination):
+        self.packets.append((packet, destination))
+
+
+def packet(sequence_number):
+    return pack('<iQ', sequence_number, 1000 + sequence_number)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def send_and_wait(receiver, packets, expected):
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for destination, packet_data in packets:
+            sender.sendto(packet_data, destination)
+        for _ in range(200):
+            if receiver.packets_received >= expected:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        sender.close()
+
+
+def test_receiver():
+    handler = RecordingHandler()
+
+    async def receive():
+        receiver = MDPReceiver(handler, [('127.0.0.1', 0), ('127.0.0.1', 0)])
+        await receiver.start()
+        feed_a, feed_b = receiver.destinations
+        await send_and_wait(receiver, [(feed_a, packet(1)), (feed_b, packet(1)), (feed_b, packet(2))], 3)
+        receiver.close()
+        return receiver, feed_a, feed_b
+
+    receiver, feed_a, feed_b = run(receive())
+    assert sorted(handler.packets) == sorted([(packet(1), feed_a), (packet(1), feed_b), (packet(2), feed_b)])
+    assert (receiver.packets_received, receiver.bytes_received, receiver.packets_dropped) == (3, 36, 0)
+
+
+class RecordingParser(object):
+    def __init__(self):
+        self.sequence_numbers = []
+
+    def parse(self, mdp_packet, offset=0, template_ids=None):
+        self.sequence_numbers.append(bytes(mdp_packet[:4]))
+        return []
+
+
+def test_receiver_queue():
+    parser = RecordingParser()
+
+    async def receive():
+        def handle_packet(received_time, mdp_packet, destination):
+            processor.handle_packet(received_time, mdp_packet, destination)
+
+        processor = PacketProcessor(parser, None)
+        receiver = MDPReceiver(handle_packet, [('127.0.0.1', 0)], max_queue=4, batch_size=2)
+        await receiver.start()
+        feed = receiver.destinations[0]
+        # the packets are queued as the sockets are read, before any is handled
+        receiver.packet_received(packet(1), feed)
+        receiver.packet_received(packet(2), feed)
+        assert receiver.queue_depth == 2
+        await send_and_wait(receiver, [(feed, packet(3))], 3)
+        await receiver.drain()
+        assert receiver.queue_depth == 0
+        for sequence_number in range(4, 10):
+            receiver.packet_received(packet(sequence_number), feed)
+        await receiver.drain()
+        receiver.close()
+        return receiver
+
+    receiver = run(receive())
+    assert parser.sequence_numbers == [packet(n)[:4] for n in range(1, 8)]
+    assert (receiver.packets_received, receiver.packets_dropped, receiver.max_queue_depth) == (9, 2, 4)
+
+
+def test_receiver_multicast():
+    handler = RecordingHandler()
+
+    async def receive():
+        receiver = MDPReceiver(handler, [('239.255.31.1', 0)], interface='127.0.0.1')
+        try:
+            await receiver.start()
+        except OSError:
+            pytest.skip('no multicast on the loopback interface')
+        feed = receiver.destinations[0]
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton('127.0.0.1'))
+        sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        try:
+            sender.sendto(packet(1), feed)
+        except OSError:
+            receiver.close()
+            pytest.skip('no multicast on the loopback interface')
+        finally:
+            sender.close()
+        for _ in range(100):
+            if handler.packets:
+                break
+            await asyncio.sleep(0.01)
+        receiver.close()
+        return feed
+
+    feed = run(receive())
+    if not handler.packets:
+        pytest.skip('multicast is not looped back here')
+    assert handler.packets == [(packet(1), feed)]
+
+
+@pytest.mark.parametrize('use_recvmmsg', [True, False], ids=['recvmmsg', 'recv_into'])
+def test_datagram_reader(use_recvmmsg):
+    if use_recvmmsg and receiver_module._recvmmsg is None:
+        pytest.skip('recvmmsg is not available')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.setblocking(False)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        reader = DatagramReader(sock, slots=4, slot_size=16, use_recvmmsg=use_recvmmsg)
+        assert reader.read() == []
+        for sequence_number in range(1, 7):
+            sender.sendto(packet(sequence_number), sock.getsockname())
+        sender.sendto(b'x' * 20, sock.getsockname())
+
+        packets = reader.read()
+        assert all(isinstance(p, memoryview) for p in packets)
+        assert [bytes(p) for p in packets] == [packet(n) for n in range(1, 5)]
+        assert reader.position == 0
+        # the ring wrapped around, the slots of the first packets are read into again
+        packets = reader.read(1)
+        assert [bytes(p) for p in packets] == [packet(5)]
+        assert reader.discard(1) == [12]
+        packets = reader.read()
+        assert [bytes(p) for p in packets] == [b'x' * 16]
+        assert (reader.position, reader.reads, reader.truncated) == (2, 3, 1)
+        assert reader.read() == []
+        assert reader.discard(10) == []
+    finally:
+        sock.close()
+        sender.close()
+
+
+def test_receiver_ring():
+    handler = RecordingHandler()
+
+    async def receive():
+        def handle_packet(received_time, mdp_packet, destination):
+            handler(received_time, bytes(mdp_packet), destination)
+
+        receiver = MDPReceiver(handle_packet, [('127.0.0.1', 0)], ring_slots=4, slot_size=64)
+        await receiver.start()
+        feed = receiver.destinations[0]
+        await send_and_wait(receiver, [(feed, packet(n)) for n in range(1, 11)], 10)
+        receiver.close()
+        return receiver, feed
+
+    receiver, feed = run(receive())
+    assert handler.packets == [(packet(n), feed) for n in range(1, 11)]
+    assert (receiver.packets_received, receiver.packets_dropped) == (10, 0)
+    assert receiver.readers == []
+
+
+def test_receiver_ring_queue():
+    handled = []
+
+    async def receive():
+        receiver = MDPReceiver(lambda received_time, mdp_packet, destination: handled.append(bytes(mdp_packet)),
+                               [('127.0.0.1', 0)], max_queue=2, batch_size=1, ring_slots=2, slot_size=64)
+        await receiver.start()
+        await send_and_wait(receiver, [(receiver.destinations[0], packet(n)) for n in range(1, 21)], 20)
+        await receiver.drain()
+        receiver.close()
+        return receiver
+
+    receiver = run(receive())
+    # packets are dropped rather than read over the queued packets in the ring
+    assert len(handled) == receiver.packets_received - receiver.packets_dropped
+    assert handled == sorted(set(handled))
+    assert set(handled) <= set(packet(n) for n in range(1, 21))
+
+    with pytest.raises(ValueError):
+        MDPReceiver(None, [], max_queue=8, ring_slots=4)
@@ -1,16 +1,23 @@
 #!/usr/bin/env python
 
 import binascii
+import copy
+from decimal import Decimal
 import os
 import tempfile
+from struct import pack, unpack_from
 
 import pytest
+import six
+from six.moves import cPickle as pickle
 from six.moves import urllib
 
 from sbedecoder import MDPMessageFactory
 from sbedecoder import SBEMessage
+from sbedecoder import SBEMessageFactory
 from sbedecoder import SBEParser
 from sbedecoder import SBESchema
+from sbedecoder import SBESchemaRegistry
 
 schema_url = 'ftp://ftp.cmegroup.com/SBEFix/Production/Templates/templates_FixBinary.xml'
 
@@ -303,3 +310,889 @@ def test_sbemessage_parse_message(mdp_schema):
     assert recorded_message.halt_reason.value == 'Group Schedule'
     assert recorded_message.halt_reason.enumerant == 'GroupSchedule'
     assert recorded_message.security_id.value is None
+
+
+def test_block_struct_matches_field_unpacking(mdp_parser):
+
+    msg_buffer = binascii.a2b_hex(
+        'c30fa90082dd3f8b069bd91478000b0020000100080095ab3d8b069bd914840000200002009bb1203602000002000000805d00003e2d140001000000010030000000000080e8ca113602000002000000805d00003f2d140001000000020130000000000018000000000000019c53980a9600000024131444010000000200000001010000')
+    offset = 12
+
+    for message in mdp_parser.parse(msg_buffer, offset):
+        assert message.block_struct is not None
+        for field in message.fields:
+            assert field.block_values is not None
+            assert field.raw_value == unpack_from(field.unpack_fmt, msg_buffer, offset + field.field_offset)[0]
+
+        for entry in message.no_md_entries:
+            entry_offset = offset + entry.relative_offset
+            assert entry.security_id.raw_value == unpack_from('<i', msg_buffer, entry_offset + 12)[0]
+            assert entry.md_entry_px.mantissa.raw_value == unpack_from('<q', msg_buffer, entry_offset)[0]
+            assert entry.md_entry_type.raw_value == '0'
+
+
+def test_parse_records_can_be_stored(mdp_parser):
+
+    msg_buffer = binascii.a2b_hex('c90fa9008a15428b069bd91458000b00200001000800e7c43d8b069bd91484000020000180b2654d360200008e0000000a610000f62fac003000000007013000000000001800000000000001e44c980a960000002b13144401000000010000000101000058000b002000010008006f203f8b069bd9148400002000018017336b3602000004000000805d0000402d140002000000020131000000000018000000000000016153980a960000002c131444010000000200000001010000')
+    offset = 12
+
+    records = list(mdp_parser.parse_records(msg_buffer, offset))
+    assert len(records) == 2
+
+    first, second = records
+    assert first.message_type.message_id == 32
+    assert first.template_id == 32
+    assert first.match_event_indicator == 'LastQuoteMsg, EndOfEvent'
+    assert len(first.no_md_entries) == 1
+    assert first.no_md_entries[0].md_entry_px == 243225.0
+    assert first.no_md_entries[0].md_entry_size == 142
+    assert first.no_md_entries[0].md_entry_type == 'Bid'
+    assert second.no_md_entries[0].md_entry_px == 243275.0
+    assert second.no_md_entries[0].md_entry_size == 4
+    assert second.no_order_id_entries[0].order_id == 644422849377
+
+    with pytest.raises(AttributeError):
+        first.template_id = 42
+
+
+nested_groups_schema_xml = b'''<?xml version="1.0" encoding="UTF-8"?>
+<sbe:messageSchema xmlns:sbe="http://fixprotocol.io/2016/sbe" package="test" id="7" version="1" byteOrder="littleEndian">
+    <types>
+        <composite name="messageHeader">
+            <type name="blockLength" primitiveType="uint16"/>
+            <type name="templateId" primitiveType="uint16"/>
+            <type name="schemaId" primitiveType="uint16"/>
+            <type name="version" primitiveType="uint16"/>
+        </composite>
+        <composite name="groupSizeEncoding">
+            <type name="blockLength" primitiveType="uint16"/>
+            <type name="numInGroup" primitiveType="uint16"/>
+        </composite>
+    </types>
+    <sbe:message name="Outer" id="1" blockLength="4">
+        <field name="Id" id="1" type="uint32" offset="0"/>
+        <group name="Entries" id="2" blockLength="4" dimensionType="groupSizeEncoding">
+            <field name="Qty" id="3" type="uint32" offset="0"/>
+            <group name="Legs" id="4" blockLength="2" dimensionType="groupSizeEncoding">
+                <field name="Ratio" id="5" type="uint16" offset="0"/>
+            </group>
+        </group>
+        <group name="Trailer" id="6" blockLength="2" dimensionType="groupSizeEncoding">
+            <field name="Check" id="7" type="uint16" offset="0"/>
+        </group>
+    </sbe:message>
+</sbe:messageSchema>
+'''
+
+
+@pytest.fixture(scope="module")
+def nested_groups_schema():
+    with tempfile.NamedTemporaryFile(suffix='.xml', delete=False) as schema_file:
+        schema_file.write(nested_groups_schema_xml)
+    schema = SBESchema()
+    schema.parse(schema_file.name)
+    os.remove(schema_file.name)
+    return schema
+
+
+def test_nested_repeating_groups(nested_groups_schema):
+    msg_buffer = pack('<HHHHI', 4, 1, 7, 1, 99)
+    msg_buffer += pack('<HH', 4, 2)  # two entries
+    msg_buffer += pack('<I', 10) + pack('<HH', 2, 2) + pack('<HH', 1, 2)  # first entry has two legs
+    msg_buffer += pack('<I', 20) + pack('<HH', 2, 1) + pack('<H', 3)  # second entry has one leg
+    msg_buffer += pack('<HH', 2, 1) + pack('<H', 0xbeef)
+
+    message = SBEMessage.parse_message(nested_groups_schema, msg_buffer)
+    assert message.id.value == 99
+    assert message.entries.num_groups == 2
+    assert len(message.entries) == 2
+
+    legs = [(entry.qty.value, [leg.ratio.value for leg in entry.legs]) for entry in message.entries]
+    assert legs == [(10, [1, 2]), (20, [3])]
+
+    assert message.entries[-1].qty.value == 20
+    assert message.entries[0].legs[1].ratio.value == 2
+    with pytest.raises(IndexError):
+        message.entries[2]
+
+    assert [trailer.check.value for trailer in message.trailer] == [0xbeef]
+
+    record = message.to_record()
+    assert [(entry.qty, [leg.ratio for leg in entry.legs]) for entry in record.entries] == [(10, [1, 2]), (20, [3])]
+    assert record.trailer[0].check == 0xbeef
+
+
+def test_parse_to_columns(mdp_parser):
+    numpy = pytest.importorskip('numpy')
+
+    msg_buffers = [
+        binascii.a2b_hex('c90fa9008a15428b069bd91458000b00200001000800e7c43d8b069bd91484000020000180b2654d360200008e0000000a610000f62fac003000000007013000000000001800000000000001e44c980a960000002b13144401000000010000000101000058000b002000010008006f203f8b069bd9148400002000018017336b3602000004000000805d0000402d140002000000020131000000000018000000000000016153980a960000002c131444010000000200000001010000'),
+        binascii.a2b_hex('2f0aa9007decc6d2059bd91460000b002a000100080085b89fd2059bd91401000020000100f981d336020000020000000a610000fe2aac00020000000100ffffffff000010000000000000023051980a960000000200000000000000ad50980a960000000200000000000000'),
+    ]
+
+    columns = mdp_parser.parse_to_columns(msg_buffers, offset=12, template_ids={32})
+    assert list(columns.keys()) == [32]
+
+    book = columns[32]
+    assert book.message_type.message_id == 32
+    assert list(book.messages['transact_time']) == [1502402403112961255, 1502402403113050223]
+    assert list(book.messages['match_event_indicator']) == [132, 132]
+
+    entries = book.groups['no_md_entries']
+    assert list(entries['message_index']) == [0, 1]
+    assert list(entries['md_entry_px_mantissa']) == [2432250000000, 2432750000000]
+    assert list(entries['security_id']) == [24842, 23936]
+    assert list(entries['md_entry_type']) == [b'0', b'1']
+    assert entries['md_entry_size'].dtype == numpy.dtype('<i4')
+
+    columns = mdp_parser.parse_to_columns(msg_buffers, offset=12)
+    trades = columns[42].groups['no_order_id_entries']
+    assert list(trades['message_index']) == [0, 0]
+    assert list(trades['order_id']) == [644422848816, 644422848685]
+
+
+def test_parse_to_columns_nested_groups(nested_groups_schema):
+    pytest.importorskip('numpy')
+    from sbedecoder.columns import ColumnBuilder
+
+    msg_buffer = pack('<HHHHI', 4, 1, 7, 1, 99)
+    msg_buffer += pack('<HH', 4, 2)
+    msg_buffer += pack('<I', 10) + pack('<HH', 2, 2) + pack('<HH', 1, 2)
+    msg_buffer += pack('<I', 20) + pack('<HH', 2, 1) + pack('<H', 3)
+    msg_buffer += pack('<HH', 2, 0)
+
+    builder = ColumnBuilder(SBEMessage.parse_message(nested_groups_schema, msg_buffer))
+    builder.add(SBEMessage.parse_message(nested_groups_schema, msg_buffer))
+    columns = builder.build()
+
+    assert list(columns.messages['id']) == [99]
+    assert list(columns.groups['entries']['qty']) == [10, 20]
+    legs = columns.groups['entries.legs']
+    assert list(legs['ratio']) == [1, 2, 3]
+    assert list(legs['parent_index']) == [0, 0, 1]
+    assert list(legs['message_index']) == [0, 0, 0]
+    assert len(columns.groups['trailer']) == 0
+
+
+def test_parse_to_columns_reused_buffer(nested_groups_schema):
+    pytest.importorskip('numpy')
+
+    # e.g. the payloads of a capture or the ring of a receiver, read one after another into the same buffer
+    def packets():
+        msg_buffer = bytearray(28)
+        for id in (1, 2, 3):
+            msg_buffer[:] = pack('<HHHHI', 4, 1, 7, 1, id) + pack('<HH', 4, 1) + pack('<I', 10 * id) + \
+                pack('<HH', 2, 0) + pack('<HH', 2, 0)
+            yield memoryview(msg_buffer)
+
+    columns = SBEParser(SBEMessageFactory(nested_groups_schema)).parse_to_columns(packets())
+    assert list(columns[1].messages['id']) == [1, 2, 3]
+    assert list(columns[1].groups['entries']['qty']) == [10, 20, 30]
+
+
+def test_schema_cache(tmpdir, monkeypatch):
+    schema_filename = str(tmpdir.join('schema.xml'))
+    with open(schema_filename, 'wb') as schema_file:
+        schema_file.write(nested_groups_schema_xml)
+    cache_dir = str(tmpdir.join('cache'))
+
+    SBESchema().parse(schema_filename, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # the second parse must come from the cache, without reading the xml
+    def fail(*args, **kwargs):
+        raise AssertionError('schema xml should not be parsed')
+    monkeypatch.setattr(SBESchema, '_parse_definitions', fail)
+    cached_schema = SBESchema()
+    cached_schema.parse(schema_filename, cache_dir=cache_dir)
+    monkeypatch.undo()
+
+    msg_buffer = pack('<HHHHI', 4, 1, 7, 1, 99) + pack('<HH', 4, 1) + pack('<I', 10) + pack('<HH', 2, 1)
+    msg_buffer += pack('<H', 3) + pack('<HH', 2, 0)
+    message = SBEMessage.parse_message(cached_schema, msg_buffer)
+    assert message.block_struct is not None
+    assert message.id.value == 99
+    assert [(entry.qty.value, [leg.ratio.value for leg in entry.legs]) for entry in message.entries] == [(10, [3])]
+
+    # a different set of options (or a changed schema) gets its own cache entry
+    SBESchema(include_message_size_header=True).parse(schema_filename, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+
+    # a schema that fails to pickle is still parsed, without leaving a partial cache behind
+    def unpicklable(*args, **kwargs):
+        raise pickle.PicklingError('unpicklable')
+    monkeypatch.setattr(pickle, 'dump', unpicklable)
+    schema = SBESchema(include_message_size_header=True)
+    schema.parse(schema_filename, cache_dir=str(tmpdir.join('failed')))
+    assert schema.get_message_type(1) is not None
+    assert os.listdir(str(tmpdir.join('failed'))) == []
+
+
+def test_schema_from_bytes_and_file_object():
+    msg_buffer = pack('<HHHHI', 4, 1, 7, 1, 99) + pack('<HH', 4, 0) + pack('<HH', 2, 0)
+
+    for schema_source in (nested_groups_schema_xml, six.BytesIO(nested_groups_schema_xml)):
+        schema = SBESchema()
+        schema.parse(schema_source)
+        message = SBEMessage.parse_message(schema, msg_buffer)
+        assert message.name == 'Outer'
+        assert message.id.value == 99
+        assert message.entries.num_groups == 0
+
+
+def test_compiled_schema_matches_records(mdp_schema):
+    from sbedecoder.codegen import compile_messages
+
+    compiled_schema = SBESchema(include_message_size_header=True, use_description_as_message_name=True)
+    compiled_schema.load(compile_messages(mdp_schema))
+    parser = SBEParser(MDPMessageFactory(mdp_schema))
+    compiled_parser = SBEParser(MDPMessageFactory(compiled_schema))
+
+    msg_buffer = binascii.a2b_hex('c90fa9008a15428b069bd91458000b00200001000800e7c43d8b069bd91484000020000180b2654d360200008e0000000a610000f62fac003000000007013000000000001800000000000001e44c980a960000002b13144401000000010000000101000058000b002000010008006f203f8b069bd9148400002000018017336b3602000004000000805d0000402d140002000000020131000000000018000000000000016153980a960000002c131444010000000200000001010000')
+    offset = 12
+
+    records = list(parser.parse_records(msg_buffer, offset))
+    messages = list(compiled_parser.parse(msg_buffer, offset))
+    assert len(messages) == 2
+    for record, message in zip(records, messages):
+        assert type(message).__name__ == 'MDIncrementalRefreshBook'
+        assert message.to_record() is message
+        for name in record._fields:
+            if name in ('no_md_entries', 'no_order_id_entries'):
+                continue
+            assert getattr(message, name) == getattr(record, name)
+        for group_name in ('no_md_entries', 'no_order_id_entries'):
+            entries = getattr(message, group_name)
+            assert len(entries) == len(getattr(record, group_name))
+            for entry_record, entry in zip(getattr(record, group_name), entries):
+                assert tuple(getattr(entry, name) for name in entry_record._fields) == entry_record
+
+    assert messages[0].match_event_indicator == 'LastQuoteMsg, EndOfEvent'
+    assert messages[0].no_md_entries[0].md_entry_px == 243225.0
+    assert messages[0].no_md_entries[0].md_entry_type == 'Bid'
+
+
+def test_compiled_nested_groups():
+    msg_buffer = pack('<HHHHI', 4, 1, 7, 1, 99)
+    msg_buffer += pack('<HH', 4, 2)
+    msg_buffer += pack('<I', 10) + pack('<HH', 2, 2) + pack('<HH', 1, 2)
+    msg_buffer += pack('<I', 20) + pack('<HH', 2, 1) + pack('<H', 3)
+    msg_buffer += pack('<HH', 2, 1) + pack('<H', 0xbeef)
+
+    schema = SBESchema()
+    schema.parse(nested_groups_schema_xml, compiled=True)
+    message = SBEMessage.parse_message(schema, msg_buffer)
+    assert message.id == 99
+    assert [(entry.qty, [leg.ratio for leg in entry.legs]) for entry in message.entries] == [(10, [1, 2]), (20, [3])]
+    assert message.trailer[0].check == 0xbeef
+    with pytest.raises(AttributeError):
+        message.unknown_field = 1
+
+
+def test_compiled_schema_rejected_by_field_object_tools():
+    from mdp.orderbook.packet_processor import PacketProcessor
+
+    schema = SBESchema()
+    schema.parse(nested_groups_schema_xml, compiled=True)
+    parser = SBEParser(SBEMessageFactory(schema))
+    assert schema.compiled and parser.compiled
+    with pytest.raises(ValueError):
+        parser.parse_to_columns([pack('<HHHHI', 4, 1, 7, 1, 99) + pack('<HH', 4, 0) + pack('<HH', 2, 0)])
+    with pytest.raises(ValueError):
+        PacketProcessor(parser, None)
+    with pytest.raises(ValueError):
+        schema.project(1, root=['id'])
+
+
+def test_decode_packet_output_stream(mdp_schema, capsys):
+    import mdp.decode
+
+    packet = binascii.a2b_hex('c90fa9008a15428b069bd91458000b00200001000800e7c43d8b069bd91484000020000180b2654d360200008e0000000a610000f62fac003000000007013000000000001800000000000001e44c980a960000002b13144401000000010000000101000058000b002000010008006f203f8b069bd9148400002000018017336b3602000004000000805d0000402d140002000000020131000000000018000000000000016153980a960000002c131444010000000200000001010000')
+    parser = SBEParser(MDPMessageFactory(mdp_schema))
+    for pretty, message_line in ((False, '(tid:32)'), (True, 'Message 2 of 2: TID 32')):
+        output = six.StringIO()
+        mdp.decode.decode_packet(parser, None, packet, set(), False, pretty, None, 1, out=output)
+        assert output.getvalue().startswith(':packet 1 - timestamp: None sequence_number: 11079625 ')
+        assert message_line in output.getvalue()
+    assert capsys.readouterr().out == ''
+
+
+def test_parse_template_id_filter(mdp_schema, monkeypatch):
+    security_status = binascii.a2b_hex('5603a9009c16d545349ad91428001e001e000100080003259845349ad914455300000000000000000000ffffff7fed4380150004')
+    book = binascii.a2b_hex('c90fa9008a15428b069bd91458000b00200001000800e7c43d8b069bd91484000020000180b2654d360200008e0000000a610000f62fac003000000007013000000000001800000000000001e44c980a960000002b13144401000000010000000101000058000b002000010008006f203f8b069bd9148400002000018017336b3602000004000000805d0000402d140002000000020131000000000018000000000000016153980a960000002c131444010000000200000001010000')
+    msg_buffer = security_status + book[12:]
+    offset = 12
+
+    parser = SBEParser(MDPMessageFactory(mdp_schema))
+    assert [m.message_id for m in parser.parse(msg_buffer, offset)] == [30, 32, 32]
+
+    # skipped messages are never built
+    built_template_ids = []
+    get_message_type = mdp_schema.get_message_type
+    monkeypatch.setattr(mdp_schema, 'get_message_type',
+                        lambda template_id, *args: built_template_ids.append(template_id) or
+                        get_message_type(template_id, *args))
+    messages = [m.transact_time.value for m in parser.parse(msg_buffer, offset, template_ids={32})]
+    assert messages == [1502402403112961255, 1502402403113050223]
+    assert built_template_ids == [32, 32]
+
+    assert [r.template_id for r in parser.parse_records(msg_buffer, offset, template_ids={30})] == [30]
+    assert list(parser.parse(msg_buffer, offset, template_ids=())) == []
+
+
+def test_projections(mdp_schema):
+    msg_buffer = binascii.a2b_hex('c90fa9008a15428b069bd91458000b00200001000800e7c43d8b069bd91484000020000180b2654d360200008e0000000a610000f62fac003000000007013000000000001800000000000001e44c980a960000002b13144401000000010000000101000058000b002000010008006f203f8b069bd9148400002000018017336b3602000004000000805d0000402d140002000000020131000000000018000000000000016153980a960000002c131444010000000200000001010000')
+    offset = 12
+
+    schema = SBESchema(include_message_size_header=True, use_description_as_message_name=True)
+    schema.load(list(mdp_schema.message_map.values()))
+    schema.project(32, root=['transact_time'],
+                   groups={'no_md_entries': ['security_id', 'md_entry_px', 'md_entry_type'],
+                           'no_order_id_entries': ['order_id']})
+    parser = SBEParser(MDPMessageFactory(schema))
+
+    projections = list(parser.parse_projections(msg_buffer, offset))
+    assert [template_id for template_id, values in projections] == [32, 32]
+    first = projections[0][1]
+    assert first.transact_time == 1502402403112961255
+    assert first.no_md_entries == ((24842, 243225.0, 'Bid'),)
+    assert first.no_md_entries[0].md_entry_px == 243225.0
+    assert projections[1][1].no_order_id_entries[0].order_id == 644422849377
+
+    # an unnamed projection of a later group skips over the groups before it
+    decode = schema.project(32, groups={'no_order_id_entries': ['order_id']}, named=False)
+    assert decode(msg_buffer, offset) == (((644422847716,),),)
+
+    with pytest.raises(ValueError):
+        schema.project(32, root=['no_such_field'])
+    with pytest.raises(ValueError):
+        schema.project(32, groups={'no_such_group': []})
+
+
+def test_projections_nested_groups(nested_groups_schema):
+    msg_buffer = pack('<HHHHI', 4, 1, 7, 1, 99)
+    msg_buffer += pack('<HH', 4, 2)
+    msg_buffer += pack('<I', 10) + pack('<HH', 2, 2) + pack('<HH', 1, 2)
+    msg_buffer += pack('<I', 20) + pack('<HH', 2, 1) + pack('<H', 3)
+    msg_buffer += pack('<HH', 2, 1) + pack('<H', 0xbeef)
+
+    decode = nested_groups_schema.project(1, root=['id'], groups={'trailer': ['check']})
+    assert decode(msg_buffer, 0) == (99, ((0xbeef,),))
+
+    decode = nested_groups_schema.project(1, groups={'entries.legs': ['ratio']})
+    assert decode(msg_buffer, 0) == (((((1,), (2,)),), (((3,),),)),)
+    assert decode(msg_buffer, 0).entries[0].legs[1].ratio == 2
+
+
+enum_schema_xml = b'''<?xml version="1.0" encoding="UTF-8"?>
+<sbe:messageSchema xmlns:sbe="http://fixprotocol.io/2016/sbe" package="test" id="8" version="1" byteOrder="littleEndian">
+    <types>
+        <composite name="messageHeader">
+            <type name="blockLength" primitiveType="uint16"/>
+            <type name="templateId" primitiveType="uint16"/>
+            <type name="schemaId" primitiveType="uint16"/>
+            <type name="version" primitiveType="uint16"/>
+        </composite>
+        <enum name="MDEntryType" encodingType="char">
+            <validValue name="Bid" description="Bid">0</validValue>
+            <validValue name="Offer" description="Offer">1</validValue>
+        </enum>
+        <enum name="MDUpdateAction" encodingType="uint8">
+            <validValue name="New" description="New">0</validValue>
+            <validValue name="Delete" description="Delete">2</validValue>
+        </enum>
+    </types>
+    <sbe:message name="Entry" id="1" blockLength="2">
+        <field name="MDEntryType" id="269" type="MDEntryType" offset="0"/>
+        <field name="MDUpdateAction" id="279" type="MDUpdateAction" offset="1"/>
+    </sbe:message>
+</sbe:messageSchema>
+'''
+
+
+def test_enum_codes():
+    schema = SBESchema()
+    schema.parse(enum_schema_xml)
+    message = SBEMessage.parse_message(schema, pack('<HHHHcB', 2, 1, 8, 1, b'1', 2))
+
+    assert message.md_entry_type.codes == {'Bid': ord('0'), 'Offer': ord('1')}
+    assert message.md_entry_type.code == ord('1')
+    assert message.md_entry_type.value == 'Offer'
+    assert message.md_entry_type.enumerant == 'Offer'
+    assert message.md_entry_type.raw_value == '1'
+    assert message.md_update_action.code == 2
+    assert message.md_update_action.value == 'Delete'
+
+    MDUpdateAction = message.md_update_action.enum_type()
+    assert message.md_update_action.code == MDUpdateAction.Delete
+    assert MDUpdateAction(0) is MDUpdateAction.New
+
+    message = SBEMessage.parse_message(schema, pack('<HHHHcB', 2, 1, 8, 1, b'9', 1))
+    assert message.md_entry_type.value is None
+    assert message.md_update_action.enumerant is None
+
+
+price_schema_xml = b'''<?xml version="1.0" encoding="UTF-8"?>
+<sbe:messageSchema xmlns:sbe="http://fixprotocol.io/2016/sbe" package="test" id="9" version="1" byteOrder="littleEndian">
+    <types>
+        <composite name="messageHeader">
+            <type name="blockLength" primitiveType="uint16"/>
+            <type name="templateId" primitiveType="uint16"/>
+            <type name="schemaId" primitiveType="uint16"/>
+            <type name="version" primitiveType="uint16"/>
+        </composite>
+        <composite name="PRICE" semanticType="Price">
+            <type name="mantissa" primitiveType="int64"/>
+            <type name="exponent" presence="constant" primitiveType="int8">-7</type>
+        </composite>
+        <composite name="PRICENULL" semanticType="Price">
+            <type name="mantissa" presence="optional" nullValue="9223372036854775807" primitiveType="int64"/>
+            <type name="exponent" presence="constant" primitiveType="int8">-7</type>
+        </composite>
+        <composite name="Decimal">
+            <type name="mantissa" primitiveType="int64"/>
+            <type name="exponent" primitiveType="int8"/>
+        </composite>
+    </types>
+    <sbe:message name="Prices" id="1" blockLength="25">
+        <field name="Px" id="1" type="PRICE" offset="0"/>
+        <field name="NullPx" id="2" type="PRICENULL" offset="8"/>
+        <field name="Qty" id="3" type="Decimal" offset="16"/>
+    </sbe:message>
+</sbe:messageSchema>
+'''
+
+
+def test_price_modes():
+    msg_buffer = pack('<HHHHqqqb', 25, 1, 9, 1, 98890000001, 0x7fffffffffffffff, 15, -1)
+
+    expected = {
+        'float': (98890000001 * 1e-7, 1.5),
+        'fixed': (98890000001, 1.5),
+        'decimal': (Decimal('9889.0000001'), Decimal('1.5')),
+    }
+    for price_mode, (price, quantity) in expected.items():
+        for compiled in (False, True):
+            schema = SBESchema(price_mode=price_mode)
+            schema.parse(price_schema_xml, compiled=compiled)
+            message = SBEMessage.parse_message(schema, msg_buffer)
+            values = (message.px, message.null_px, message.qty) if compiled else \
+                (message.px.value, message.null_px.value, message.qty.value)
+            assert values == (price, None, quantity)
+            assert type(values[0]) is type(price)
+
+    schema = SBESchema(price_mode='fixed')
+    schema.parse(price_schema_xml)
+    assert schema.get_message_type(1)().px.price_exponent == -7
+
+    with pytest.raises(ValueError):
+        SBESchema(price_mode='double')
+
+
+set_schema_xml = b'''<?xml version="1.0" encoding="UTF-8"?>
+<sbe:messageSchema xmlns:sbe="http://fixprotocol.io/2016/sbe" package="test" id="10" version="1" byteOrder="littleEndian">
+    <types>
+        <composite name="messageHeader">
+            <type name="blockLength" primitiveType="uint16"/>
+            <type name="templateId" primitiveType="uint16"/>
+            <type name="schemaId" primitiveType="uint16"/>
+            <type name="version" primitiveType="uint16"/>
+        </composite>
+        <set name="MatchEventIndicator" encodingType="uint8">
+            <choice name="LastTradeMsg">0</choice>
+            <choice name="LastQuoteMsg">2</choice>
+            <choice name="EndOfEvent">7</choice>
+        </set>
+    </types>
+    <sbe:message name="Event" id="1" blockLength="1">
+        <field name="MatchEventIndicator" id="5799" type="MatchEventIndicator" offset="0"/>
+    </sbe:message>
+</sbe:messageSchema>
+'''
+
+
+def test_set_choices():
+    schema = SBESchema()
+    schema.parse(set_schema_xml)
+    message = SBEMessage.parse_message(schema, pack('<HHHHB', 1, 1, 10, 1, 0x81))
+
+    indicator = message.match_event_indicator
+    assert indicator.is_set('EndOfEvent')
+    assert not indicator.is_set('LastQuoteMsg')
+    assert indicator.flags & indicator.masks['LastTradeMsg']
+    assert indicator.value == 'LastTradeMsg, EndOfEvent'
+    assert indicator.values[0x81] == indicator.value  # cached by raw value
+
+    message = SBEMessage.parse_message(schema, pack('<HHHHB', 1, 1, 10, 1, 0x00))
+    assert message.match_event_indicator.value == ''
+
+    schema.compile()
+    message = SBEMessage.parse_message(schema, pack('<HHHHB', 1, 1, 10, 1, 0x85))
+    assert message.match_event_indicator == 'LastTradeMsg, LastQuoteMsg, EndOfEvent'
+
+
+def test_encode(nested_groups_schema):
+    msg_buffer = pack('<HHHHI', 4, 1, 7, 1, 99)
+    msg_buffer += pack('<HH', 4, 2)
+    msg_buffer += pack('<I', 10) + pack('<HH', 2, 2) + pack('<HH', 1, 2)
+    msg_buffer += pack('<I', 20) + pack('<HH', 2, 1) + pack('<H', 3)
+    msg_buffer += pack('<HH', 2, 1) + pack('<H', 0xbeef)
+
+    groups = {'entries': [{'qty': 10, 'legs': [{'ratio': 1}, {'ratio': 2}]}, {'qty': 20, 'legs': [{'ratio': 3}]}],
+              'trailer': [{'check': 0xbeef}]}
+    assert nested_groups_schema.schema_id == 7
+    assert nested_groups_schema.encode(1, {'id': 99}, groups) == msg_buffer
+    assert nested_groups_schema.encode(1) == pack('<HHHHI', 4, 1, 7, 1, 0) + pack('<HHHH', 4, 0, 2, 0)
+
+    # messages are written over whatever the preallocated buffer holds
+    preallocated = bytearray(b'\xff' * 64)
+    assert nested_groups_schema.encode_into(preallocated, 3, 1, {'id': 99}, groups) == len(msg_buffer)
+    assert preallocated[3:3 + len(msg_buffer)] == msg_buffer
+    with pytest.raises(ValueError):
+        nested_groups_schema.encode_into(preallocated, 40, 1, {'id': 99}, groups)
+
+    with pytest.raises(ValueError):
+        nested_groups_schema.encode(1, {'no_such_field': 1})
+    with pytest.raises(ValueError):
+        nested_groups_schema.encode(1, groups={'no_such_group': []})
+    with pytest.raises(ValueError):
+        nested_groups_schema.encode(2)
+
+
+def test_encode_values():
+    schema = SBESchema()
+    schema.parse(enum_schema_xml)
+    for md_entry_type in ('Offer', '1', ord('1')):
+        message = SBEMessage.parse_message(schema, schema.encode(1, {'md_entry_type': md_entry_type,
+                                                                     'md_update_action': 'Delete'}))
+        assert (message.md_entry_type.value, message.md_update_action.value) == ('Offer', 'Delete')
+    with pytest.raises(ValueError):
+        schema.encode(1, {'md_update_action': 'Change'})
+
+    schema = SBESchema()
+    schema.parse(set_schema_xml)
+    for indicator in (['LastTradeMsg', 'EndOfEvent'], 'LastTradeMsg, EndOfEvent', 0x81):
+        message = SBEMessage.parse_message(schema, schema.encode(1, {'match_event_indicator': indicator}))
+        assert message.match_event_indicator.raw_value == 0x81
+
+    for price_mode, price in (('float', 98890000001 * 1e-7), ('fixed', 98890000001), ('decimal', Decimal('9889.0000001'))):
+        schema = SBESchema(price_mode=price_mode)
+        schema.parse(price_schema_xml)
+        msg_buffer = schema.encode(1, {'px': price, 'qty': Decimal('1.5')})
+        assert msg_buffer == pack('<HHHHqqqb', 25, 1, 9, 1, 98890000001, 0x7fffffffffffffff, 15, -1)
+        message = SBEMessage.parse_message(schema, msg_buffer)
+        assert (message.px.value, message.null_px.value, message.qty.value) == (price, None, 1.5)
+
+
+def test_mdp_packet_builder():
+    from sbedecoder.encoder import MDPPacketBuilder
+
+    schema = SBESchema(include_message_size_header=True)
+    schema.parse(set_schema_xml)
+    builder = MDPPacketBuilder(schema, max_packet_size=40)
+    builder.start(5, 1500000000000000000)
+    assert builder.add(1, {'match_event_indicator': ['LastQuoteMsg']})
+    assert builder.add(1, {'match_event_indicator': ['EndOfEvent']})
+    assert not builder.add(1)  # a third 11 byte message doesn't fit
+
+    packet = builder.packet()
+    assert len(packet) == 12 + 2 * 11
+    assert unpack_from('<IQ', packet) == (5, 1500000000000000000)
+    parser = SBEParser(MDPMessageFactory(schema))
+    assert [m.match_event_indicator.value for m in parser.parse(packet, offset=12)] == ['LastQuoteMsg', 'EndOfEvent']
+
+    builder.start(6, 1500000000000000001)
+    assert len(builder.packet()) == 12
+
+    with pytest.raises(ValueError):
+        MDPPacketBuilder(SBESchema())
+
+
+var_data_schema_xml = b'''<?xml version="1.0" encoding="UTF-8"?>
+<sbe:messageSchema xmlns:sbe="http://fixprotocol.io/2016/sbe" package="test" id="3" version="1" byteOrder="littleEndian">
+    <types>
+        <composite name="messageHeader">
+            <type name="blockLength" primitiveType="uint16"/>
+            <type name="templateId" primitiveType="uint16"/>
+            <type name="schemaId" primitiveType="uint16"/>
+            <type name="version" primitiveType="uint16"/>
+        </composite>
+        <composite name="groupSizeEncoding">
+            <type name="blockLength" primitiveType="uint16"/>
+            <type name="numInGroup" primitiveType="uint16"/>
+        </composite>
+        <composite name="varDataEncoding">
+            <type name="length" primitiveType="uint8"/>
+            <type name="varData" primitiveType="uint8" length="0"/>
+        </composite>
+        <composite name="varStringEncoding">
+            <type name="length" primitiveType="uint16"/>
+            <type name="varData" primitiveType="uint8" length="0" characterEncoding="UTF-8"/>
+        </composite>
+    </types>
+    <sbe:message name="News" id="1" blockLength="4">
+        <field name="Id" id="1" type="uint32" offset="0"/>
+        <group name="Links" id="2" blockLength="2" dimensionType="groupSizeEncoding">
+            <field name="Kind" id="3" type="uint16" offset="0"/>
+            <data name="Url" id="4" type="varStringEncoding"/>
+        </group>
+        <group name="Trailer" id="5" blockLength="2" dimensionType="groupSizeEncoding">
+            <field name="Check" id="6" type="uint16" offset="0"/>
+        </group>
+        <data name="Headline" id="7" type="varStringEncoding"/>
+        <data name="Body" id="8" type="varDataEncoding"/>
+    </sbe:message>
+</sbe:messageSchema>
+'''
+
+
+def var_data_message(id, urls, headline, body):
+    msg_buffer = pack('<HHHHI', 4, 1, 3, 1, id)
+    msg_buffer += pack('<HH', 2, len(urls))
+    for kind, url in urls:
+        msg_buffer += pack('<HH', kind, len(url)) + url
+    msg_buffer += pack('<HH', 2, 1) + pack('<H', 0xbeef)
+    msg_buffer += pack('<H', len(headline)) + headline + pack('<B', len(body)) + body
+    return msg_buffer
+
+
+def test_var_data():
+    schema = SBESchema()
+    schema.parse(var_data_schema_xml)
+    msg_buffer = var_data_message(99, [(1, b'http://a'), (2, b'')], b'Caf\xc3\xa9', b'\x00\x01\x02')
+
+    message = SBEMessage.parse_message(schema, msg_buffer)
+    assert message.encoded_length == len(msg_buffer)
+    assert [(link.kind.value, link.url.text) for link in message.links] == [(1, 'http://a'), (2, '')]
+    assert message.trailer[0].check.value == 0xbeef
+    assert message.headline.text == u'Caf\xe9'
+    assert message.headline.length == 5
+    # payloads are zero-copy views of the message buffer
+    assert isinstance(message.body.value, memoryview)
+    assert message.body.value.obj is msg_buffer
+    assert message.body.tobytes() == b'\x00\x01\x02'
+
+    record = message.to_record()
+    assert (record.headline, record.body) == (b'Caf\xc3\xa9', b'\x00\x01\x02')
+    assert [(link.kind, link.url) for link in record.links] == [(1, b'http://a'), (2, b'')]
+
+    # without a message size header, messages are sized by walking their groups and var data
+    second_buffer = var_data_message(100, [], b'', b'x')
+    parser = SBEParser(SBEMessageFactory(schema))
+    assert [m.to_record().id for m in parser.parse(msg_buffer + second_buffer)] == [99, 100]
+    assert [m.id.value for m in parser.parse(msg_buffer + second_buffer, template_ids={2})] == []
+
+    compiled_schema = SBESchema()
+    compiled_schema.parse(var_data_schema_xml, compiled=True)
+    compiled = SBEMessage.parse_message(compiled_schema, msg_buffer)
+    assert (compiled.id, compiled.headline, compiled.body) == (99, b'Caf\xc3\xa9', b'\x00\x01\x02')
+    assert [(link.kind, link.url) for link in compiled.links] == [(1, b'http://a'), (2, b'')]
+    assert compiled.trailer[0].check == 0xbeef
+    assert compiled.encoded_length == len(msg_buffer)
+
+    # projections skip over the var data of the entries they don't decode
+    schema.project(1, root=['id'], groups={'trailer': ['check']})
+    assert schema.projections[1](msg_buffer, 0) == (99, ((0xbeef,),))
+
+    encoded = schema.encode(1, {'id': 99, 'headline': u'Caf\xe9', 'body': b'\x00\x01\x02'},
+                            {'links': [{'kind': 1, 'url': 'http://a'}, {'kind': 2}], 'trailer': [{'check': 0xbeef}]})
+    assert encoded == msg_buffer
+    assert schema.encode(1) == pack('<HHHHI', 4, 1, 3, 1, 0) + pack('<HHHHHB', 2, 0, 2, 0, 0, 0)
+
+
+versioned_schema_xml = b'''<?xml version="1.0" encoding="UTF-8"?>
+<sbe:messageSchema xmlns:sbe="http://fixprotocol.io/2016/sbe" package="test" id="4" version="2" byteOrder="littleEndian">
+    <types>
+        <composite name="messageHeader">
+            <type name="blockLength" primitiveType="uint16"/>
+            <type name="templateId" primitiveType="uint16"/>
+            <type name="schemaId" primitiveType="uint16"/>
+            <type name="version" primitiveType="uint16"/>
+        </composite>
+        <composite name="groupSizeEncoding">
+            <type name="blockLength" primitiveType="uint16"/>
+            <type name="numInGroup" primitiveType="uint16"/>
+        </composite>
+        <type name="uint32NULL" primitiveType="uint32" presence="optional" nullValue="4294967295"/>
+    </types>
+    <sbe:message name="Quote" id="1" blockLength="8">
+        <field name="Id" id="1" type="uint32" offset="0"/>
+        <field name="Flags" id="2" type="uint32" offset="4" sinceVersion="2"/>
+        <group name="Levels" id="3" blockLength="4" dimensionType="groupSizeEncoding">
+            <field name="Px" id="4" type="uint16" offset="0"/>
+            <field name="Qty" id="5" type="uint16" offset="2" sinceVersion="2"/>
+        </group>
+    </sbe:message>
+</sbe:messageSchema>
+'''
+
+
+def versioned_message(version, block_length, entry_length, id, flags, levels):
+    """ A Quote as sent by a producer of another version, the blocks are padded (or cut) to their length """
+    msg_buffer = pack('<HHHHI', block_length, 1, 4, version, id) + pack('<I', flags)
+    msg_buffer = msg_buffer[:8 + block_length] + b'\xee' * max(block_length - 8, 0)
+    msg_buffer += pack('<HH', entry_length, len(levels))
+    for px, qty in levels:
+        entry = pack('<HH', px, qty)
+        msg_buffer += entry[:entry_length] + b'\xee' * max(entry_length - 4, 0)
+    return msg_buffer
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_schema_versions(compiled):
+    schema = SBESchema()
+    schema.parse(versioned_schema_xml, compiled=compiled)
+
+    def decode(msg_buffer):
+        message = SBEMessage.parse_message(schema, msg_buffer)
+        assert message.encoded_length == len(msg_buffer)
+        record = message.to_record()
+        return record.id, record.flags, [(level.px, level.qty) for level in record.levels]
+
+    # an older producer sends shorter blocks, without the fields added since
+    assert decode(versioned_message(1, 4, 2, 7, 0, [(10, 0), (11, 0)])) == (7, None, [(10, None), (11, None)])
+    # the current version
+    assert decode(versioned_message(2, 8, 4, 7, 3, [(10, 1), (11, 2)])) == (7, 3, [(10, 1), (11, 2)])
+    # a newer producer may append fields to the blocks, they are skipped using the block lengths on the wire
+    assert decode(versioned_message(3, 12, 6, 7, 3, [(10, 1), (11, 2)])) == (7, 3, [(10, 1), (11, 2)])
+
+    if compiled:
+        return
+
+    # one layout per version and block length
+    message = SBEMessage.parse_message(schema, versioned_message(1, 4, 2, 7, 0, [(10, 0)]))
+    assert message.message_version == 1
+    assert [field.name for field in message.layout.fields] == ['block_length', 'template_id', 'schema_id',
+                                                               'version', 'id']
+    assert SBEMessage.parse_message(schema, versioned_message(1, 4, 2, 8, 0, [])).layout is message.layout
+
+    schema.project(1, root=['id', 'flags'], groups={'levels': ['px', 'qty']})
+    for msg_buffer, expected in ((versioned_message(1, 4, 2, 7, 0, [(10, 0)]), (7, None, ((10, None),))),
+                                 (versioned_message(3, 12, 6, 7, 3, [(10, 1)]), (7, 3, ((10, 1),)))):
+        assert tuple(schema.projections[1](msg_buffer, 0)) == expected
+
+
+def test_layouts_of_per_instance_fields():
+    schema = SBESchema()
+    schema.parse(versioned_schema_xml)
+    quote_type = schema.get_message_type(1)
+
+    class GeneratedQuote(quote_type):
+        """ Like the classes of sbe_class_generator.py, which build their fields per instance """
+        _layouts = {}
+        _instance_fields = True
+
+        def __init__(self):
+            super(GeneratedQuote, self).__init__()
+            self.fields = copy.deepcopy(quote_type.fields)
+            self.groups = copy.deepcopy(quote_type.groups)
+            for field in self.fields + self.groups:
+                setattr(self, field.name, field)
+
+    schema.message_map[1] = GeneratedQuote
+    for version, block_length, entry_length, id, flags, levels, expected in (
+            (1, 4, 2, 7, 0, [(10, 0)], (7, None, [(10, None)])),
+            (2, 8, 4, 8, 3, [(11, 1)], (8, 3, [(11, 1)])),
+            (1, 4, 2, 9, 0, [(12, 0)], (9, None, [(12, None)])),
+            (2, 8, 4, 10, 4, [(13, 2)], (10, 4, [(13, 2)]))):
+        message = SBEMessage.parse_message(schema, versioned_message(version, block_length, entry_length, id, flags,
+                                                                     levels))
+        record = message.to_record()
+        assert (record.id, record.flags, [(level.px, level.qty) for level in record.levels]) == expected
+    # one layout per version, built once for the class
+    assert len(GeneratedQuote._layouts) == 2
+    assert '_layouts' not in message.__dict__
+
+
+def test_projections_without_size_header():
+    schema = SBESchema()
+    schema.parse(versioned_schema_xml)
+    msg_buffer = versioned_message(2, 8, 4, 7, 3, [(10, 1), (11, 2)]) + versioned_message(1, 4, 2, 8, 0, [(12, 0)])
+
+    # messages are sized by wrapping them, without a message size header
+    parser = SBEParser(SBEMessageFactory(schema))
+    assert list(parser.parse_projections(msg_buffer)) == []
+    schema.project(1, root=['id', 'flags'], groups={'levels': ['px', 'qty']})
+    assert [(template_id, tuple(values)) for template_id, values in parser.parse_projections(msg_buffer)] == \
+        [(1, (7, 3, ((10, 1), (11, 2)))), (1, (8, None, ((12, None),)))]
+
+
+def test_parse_to_columns_versions():
+    pytest.importorskip('numpy')
+    from sbedecoder.columns import ColumnBuilder
+
+    schema = SBESchema()
+    schema.parse(versioned_schema_xml)
+    builder = None
+    for msg_buffer in (versioned_message(1, 4, 2, 7, 0, [(10, 0), (11, 0)]),
+                       versioned_message(2, 8, 4, 8, 3, [(12, 1)]),
+                       versioned_message(3, 12, 6, 9, 4, [(13, 2)])):
+        message = SBEMessage.parse_message(schema, msg_buffer)
+        builder = builder or ColumnBuilder(message)
+        builder.add(message)
+    columns = builder.build()
+
+    # the fields missing from the shorter blocks of version 1 are zeros, not the bytes that follow the blocks
+    assert list(columns.messages['id']) == [7, 8, 9]
+    assert list(columns.messages['flags']) == [0, 3, 4]
+    levels = columns.groups['levels']
+    assert list(levels['px']) == [10, 11, 12, 13]
+    assert list(levels['qty']) == [0, 0, 1, 2]
+    assert list(levels['message_index']) == [0, 0, 1, 2]
+
+
+def test_schema_registry():
+    nested_schema, var_data_schema, versioned_schema = SBESchema(), SBESchema(), SBESchema()
+    nested_schema.parse(nested_groups_schema_xml)
+    var_data_schema.parse(var_data_schema_xml)
+    versioned_schema.parse(versioned_schema_xml)
+    first_schema = SBESchema()
+    first_schema.parse(versioned_schema_xml.replace(b'version="2"', b'version="1"', 1))
+    registry = SBESchemaRegistry([nested_schema, var_data_schema, versioned_schema, first_schema])
+
+    # all schemas have a template 1, the schema id (and version) of the header pick the message type
+    assert registry.get_message_type(1, 7, 1) is nested_schema.get_message_type(1)
+    assert registry.get_message_type(1, 3, 1) is var_data_schema.get_message_type(1)
+    assert registry.get_message_type(1, 4, 1) is first_schema.get_message_type(1)
+    assert registry.get_message_type(1, 4, 2) is versioned_schema.get_message_type(1)
+    assert registry.get_message_type(1, 4, 3) is versioned_schema.get_message_type(1)  # newer than registered
+    assert registry.get_message_type(1, 5, 1) is None
+    assert registry.get_schema(4, 0) is first_schema and registry.get_schema(4) is versioned_schema
+
+    nested_message = pack('<HHHHI', 4, 1, 7, 1, 99) + pack('<HHHH', 4, 0, 2, 0)
+    msg_buffer = nested_message + var_data_message(98, [], b'x', b'') + \
+        versioned_message(2, 8, 4, 97, 3, [(10, 1)]) + versioned_message(1, 4, 2, 96, 0, [])
+    parser = SBEParser(SBEMessageFactory(registry))
+    messages = [message.to_record() for message in parser.parse(msg_buffer)]
+    assert [(type(message).__name__, message.schema_id, message.id) for message in messages] == \
+        [('Outer', 7, 99), ('News', 3, 98), ('Quote', 4, 97), ('Quote', 4, 96)]
+    assert messages[1].headline == b'x'
+    assert messages[2].flags == 3
+
+    with pytest.raises(ValueError):
+        registry.add(SBESchema(include_message_size_header=True), schema_id=8)
+    with pytest.raises(ValueError):
+        registry.add(SBESchema())  # no id
+
+
+def test_skipped_messages_sized_without_building(monkeypatch):
+    nested_schema, var_data_schema, versioned_schema = SBESchema(), SBESchema(), SBESchema()
+    nested_schema.parse(nested_groups_schema_xml)
+    var_data_schema.parse(var_data_schema_xml)
+    versioned_schema.parse(versioned_schema_xml)
+    registry = SBESchemaRegistry([nested_schema, var_data_schema, versioned_schema])
+    versioned_schema.project(1, root=['id'])
+
+    nested_message = pack('<HHHHI', 4, 1, 7, 1, 99) + pack('<HH', 4, 1) + pack('<I', 10) + \
+        pack('<HH', 2, 2) + pack('<HH', 1, 2) + pack('<HH', 2, 1) + pack('<H', 3)
+    msg_buffer = versioned_message(2, 8, 4, 97, 3, []) + nested_message + var_data_message(98, [], b'xy', b'z') + \
+        versioned_message(1, 4, 2, 96, 0, [(10, 1)])
+
+    # the messages without a projection (or filtered out) are sized from their group headers and var data
+    # lengths alone
+    def build(message):
+        raise AssertionError('%s was built' % message.__class__.__name__)
+    monkeypatch.setattr(SBEMessage, '__init__', build)
+    parser = SBEParser(SBEMessageFactory(registry))
+    assert [tuple(values) for _, values in parser.parse_projections(msg_buffer)] == [(97,), (96,)]
+    assert list(parser.parse(msg_buffer, template_ids={2})) == []
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import gzip
 import os
 import tempfile
 
@@ -6,7 +7,7 @@ import six
 from six.moves import urllib
 import pytest
 
-from mdp.secdef import SecDef
+from mdp.secdef import SecDef, SecDefIndex, SecurityDefinition
 
 secdef_url = 'ftp://ftp.cmegroup.com/SBEFix/Production/secdef.dat.gz'
 
@@ -37,3 +38,134 @@ def test_lookup_security_id_found(secdef):
     symbol, depth = value
     assert isinstance(symbol, six.text_type)
     assert isinstance(depth, six.integer_types)
+
+
+def write_secdef(filename, lines, compress=True):
+    with (gzip.open if compress else open)(filename, 'wb') as secdef_file:
+        for line in lines:
+            secdef_file.write(line.encode('UTF-8') + b'\n')
+
+
+secdef_lines = [
+    '35=d\x0148=20\x0155=ESZ7\x01207=XCME\x01969=25\x01462=5\x011022=GBX\x01264=10\x011022=GBI\x01264=2\x01',
+    '35=d\x0148=10\x0155=GEZ7-GEH8\x01207=XCME\x01969=0.5\x011022=GBX\x01264=5\x01',
+    '35=d\x0148=30\x0155=NODEPTH\x01207=XCME\x01',
+]
+
+
+def test_load(tmpdir):
+    secdef_filename = str(tmpdir.join('secdef.dat.gz'))
+    write_secdef(secdef_filename, secdef_lines)
+
+    secdef = SecDef()
+    secdef.load(secdef_filename)
+    assert secdef.lookup_security_id(20) == ('ESZ7', 10)
+    assert secdef.lookup(10).tick_size == 0.5
+    assert secdef.lookup(30).depth is None
+    assert secdef.lookup_security_id(40) is None
+    assert dict(secdef.definition_fields(10))['55'] == 'GEZ7-GEH8'
+
+    secdef = SecDef()
+    secdef.load(secdef_filename, security_ids=[10, 40])
+    assert list(secdef.info) == [10]
+
+
+def test_index(tmpdir):
+    secdef_filename = str(tmpdir.join('secdef.dat'))
+    index_filename = str(tmpdir.join('secdef.dat.index'))
+    write_secdef(secdef_filename, secdef_lines, compress=False)
+
+    secdef = SecDef()
+    secdef.load(secdef_filename, index_filename=index_filename)
+    assert list(secdef.index) == [10, 20, 30]
+    assert secdef.lookup_security_id(20) == ('ESZ7', 10)
+    assert secdef.lookup(20) == SecurityDefinition('ESZ7', 10, 25.0, 0)
+    assert secdef.lookup(30).depth is None
+    assert secdef.lookup(30).tick_size is None
+    assert secdef.lookup_security_id(15) is None
+    assert secdef.lookup_security_id(40) is None
+    assert dict(secdef.definition_fields(10))['969'] == '0.5'
+    secdef.close()
+
+    # the index is reused as long as the secdef file doesn't change
+    index_mtime = os.stat(index_filename).st_mtime
+    assert SecDefIndex.open(secdef_filename, index_filename).is_current(secdef_filename)
+    assert os.stat(index_filename).st_mtime == index_mtime
+
+    write_secdef(secdef_filename, secdef_lines[:1], compress=False)
+    index = SecDefIndex.open(secdef_filename, index_filename)
+    assert list(index) == [20]
+    assert index.lookup(20).symbol == 'ESZ7'
+    index.close()
+
+
+instrument_schema_xml = b'''<?xml version="1.0" encoding="UTF-8"?>
+<sbe:messageSchema xmlns:sbe="http://fixprotocol.io/2016/sbe" package="test" id="1" version="9" byteOrder="littleEndian">
+    <types>
+        <composite name="messageHeader">
+            <type name="blockLength" primitiveType="uint16"/>
+            <type name="templateId" primitiveType="uint16"/>
+            <type name="schemaId" primitiveType="uint16"/>
+            <type name="version" primitiveType="uint16"/>
+        </composite>
+        <composite name="groupSize">
+            <type name="blockLength" primitiveType="uint16"/>
+            <type name="numInGroup" primitiveType="uint8"/>
+        </composite>
+        <composite name="PRICE9">
+            <type name="mantissa" primitiveType="int64"/>
+            <type name="exponent" presence="constant" primitiveType="int8">-9</type>
+        </composite>
+        <type name="Symbol" primitiveType="char" length="20"/>
+        <type name="MDFeedType" primitiveType="char" length="3"/>
+        <enum name="SecurityUpdateAction" encodingType="char">
+            <validValue name="Add">A</validValue>
+            <validValue name="Delete">D</validValue>
+            <validValue name="Modify">M</validValue>
+        </enum>
+    </types>
+    <sbe:message name="SecurityStatus30" id="30" description="SecurityStatus" blockLength="4">
+        <field name="SecurityID" id="48" type="int32" offset="0"/>
+    </sbe:message>
+    <sbe:message name="MDInstrumentDefinitionFuture54" id="54" description="MDInstrumentDefinitionFuture" blockLength="33">
+        <field name="SecurityUpdateAction" id="980" type="SecurityUpdateAction" offset="0"/>
+        <field name="Symbol" id="55" type="Symbol" offset="1"/>
+        <field name="SecurityID" id="48" type="int32" offset="21"/>
+        <field name="MinPriceIncrement" id="969" type="PRICE9" offset="25"/>
+        <group name="NoMDFeedTypes" id="1141" blockLength="4" dimensionType="groupSize">
+            <field name="MDFeedType" id="1022" type="MDFeedType" offset="0"/>
+            <field name="MarketDepth" id="264" type="int8" offset="3"/>
+        </group>
+    </sbe:message>
+</sbe:messageSchema>
+'''
+
+
+def test_load_packets():
+    from sbedecoder import MDPMessageFactory, SBEParser, SBESchema
+    from sbedecoder.encoder import MDPPacketBuilder
+
+    schema = SBESchema(include_message_size_header=True, use_description_as_message_name=True)
+    schema.parse(instrument_schema_xml)
+    builder = MDPPacketBuilder(schema)
+    packets = []
+    for security_id, symbol, action in ((20, 'ESZ7', 'Add'), (10, 'GEZ7', 'Add'), (10, 'GEZ7', 'Delete')):
+        builder.start(len(packets) + 1, 0)
+        builder.add(30, {'security_id': 99})
+        builder.add(54, {'security_update_action': action, 'symbol': symbol, 'security_id': security_id,
+                         'min_price_increment': 0.25},
+                    {'no_md_feed_types': [{'md_feed_type': 'GBX', 'market_depth': 10},
+                                          {'md_feed_type': 'GBI', 'market_depth': 2}]})
+        packets.append(bytes(builder.packet()))
+
+    secdef = SecDef()
+    secdef.load_packets(SBEParser(MDPMessageFactory(schema)), packets[:2])
+    assert secdef.lookup_security_id(20) == ('ESZ7', 10)
+    assert secdef.lookup(10) == SecurityDefinition('GEZ7', 10, 0.25, None)
+    assert secdef.lookup_security_id(99) is None
+    assert secdef.definition_fields(10) is None
+
+    # definitions are maintained incrementally
+    secdef.load_packets(SBEParser(MDPMessageFactory(schema)), packets[2:])
+    assert secdef.lookup_security_id(10) is None
+    assert secdef.lookup_security_id(20) == ('ESZ7', 10)